@@ -0,0 +1,73 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Time the first page of a Catalog listing the newest articles, cut from a
+full sort of the index (the old behavior) against a heap top-k selection.
+
+Usage:
+    catalog_pages.py [-n COUNT] [-k PAGE_SIZE]
+
+Options:
+    -n --count=COUNT        Number of items in the index [default: 100000]
+    -k --page-size=SIZE     Items per page [default: 20]
+"""
+import random
+import time
+
+from docopt import docopt
+
+import webquills.query as query
+
+EXPRESSION = ("* | [?starts_with(itemtype, `Item/Page/Article`)]"
+              "| reverse(sort_by(@, &epoch.published))")
+
+
+def make_items(count):
+    rng = random.Random(42)
+    items = {}
+    for i in range(count):
+        guid = "urn:uuid:%d" % i
+        items[guid] = {"guid": guid, "itemtype": rng.choice(
+            ["Item/Page/Article", "Item/Page"]),
+            "epoch": {"published": rng.randrange(10 ** 9)}}
+    return query.Versioned(items, query_version="bench")
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print("%-28s %9.2f ms" % (label, (time.perf_counter() - start) * 1000))
+    return result
+
+
+def main():
+    args = docopt(__doc__)
+    size = int(args["--page-size"])
+    items = make_items(int(args["--count"]))
+
+    query.clear()
+    old = timed("full sort, first page",
+                lambda: query.search(EXPRESSION, items)[:size])
+    query.clear()
+    new = timed("top-k, first page",
+                lambda: query.search_slice(EXPRESSION, items, 0, size))
+    timed("count", lambda: query.count(EXPRESSION, items))
+    assert old == new
+
+
+if __name__ == "__main__":
+    main()
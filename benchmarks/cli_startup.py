@@ -0,0 +1,82 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Time how long the quick quill commands take to start, beyond starting a bare
+Python interpreter, and fail if any takes longer than its budget.
+
+Usage:
+    cli_startup.py [-n RUNS] [--budget=MS]
+
+Options:
+    -n --runs=RUNS      Runs of each command; the fastest counts [default: 10]
+    --budget=MS         Milliseconds allowed on top of a bare interpreter
+                        [default: 150]
+"""
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from docopt import docopt
+
+COMMANDS = [
+    ["config"],
+    ["config", "site.title"],
+    ["new", "article", "A title"],
+]
+
+QUILL = ("import sys; from webquills.quill import main; "
+         "sys.argv[0] = 'quill'; main()")
+
+
+def fastest(args, cwd, runs):
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    args = docopt(__doc__)
+    runs = int(args["--runs"])
+    budget = float(args["--budget"]) / 1000
+    with tempfile.TemporaryDirectory() as tmp:
+        Path(tmp, "webquills.yml").write_text(
+            "options:\n  root: build\n  source: content\n"
+            "site:\n  title: Startup\n")
+        bare = fastest([sys.executable, "-c", "pass"], tmp, runs)
+        print("%-28s %7.1f ms" % ("python -c pass", bare * 1000))
+        over = []
+        for command in COMMANDS:
+            elapsed = fastest([sys.executable, "-c", QUILL] + command, tmp,
+                              runs) - bare
+            label = "quill " + " ".join(command)
+            print("%-28s %+7.1f ms" % (label, elapsed * 1000))
+            if elapsed > budget:
+                over.append(label)
+    if over:
+        print("Over the %.0f ms budget: %s" % (budget * 1000,
+                                               ", ".join(over)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Time writing the sitemap and feeds of a large site straight from the stored
+index, for each index backend. The index is built first and not timed.
+
+Usage:
+    feeds.py [-n COUNT] [-k SIZE]
+
+Options:
+    -n --count=COUNT    Number of items in the index [default: 100000]
+    -k --size=SIZE      Entries in each feed [default: 20]
+"""
+import datetime
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from docopt import docopt
+
+from webquills.feeds import write_feeds
+from webquills.indexdb import open_store
+from webquills.indexer import IndexDelta
+from webquills.util import epoch_seconds
+
+EPOCH = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def make_delta(count):
+    rng = random.Random(42)
+    delta = IndexDelta()
+    for i in range(count):
+        dt = EPOCH + datetime.timedelta(seconds=rng.randrange(10 ** 8))
+        stamp = dt.isoformat().replace("+00:00", "Z")
+        delta.upsert({
+            "guid": "urn:uuid:%d" % i, "title": "Article %d" % i,
+            "itemtype": "Item/Page/Article",
+            "archetype": {"href": "/section-%d/article-%d.json" % (i % 50, i)},
+            "attributions": [{"name": "Author %d" % (i % 7),
+                              "role": "author"}],
+            "category": {"label": "section-%d" % (i % 50),
+                         "name": "Section %d" % (i % 50)},
+            "description": "What article %d is about." % i,
+            "published": stamp, "updated": stamp,
+            "epoch": {"published": epoch_seconds(dt),
+                      "updated": epoch_seconds(dt)}})
+    return delta
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print("%-36s %9.2f ms" % (label, (time.perf_counter() - start) * 1000))
+    return result
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args["--count"])
+    delta = make_delta(count)
+    print("%d items, %s per feed" % (count, args["--size"]))
+    for backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            store = open_store(root / "_index", backend)
+            store.apply(delta)
+            store.save()
+            config = {"options": {"root": tmp},
+                      "site": {"base": "http://www.example.net/",
+                               "title": "Example"},
+                      "feeds": {"sitemap": "sitemap.xml", "atom": "feed.atom",
+                                "json": "feed.json", "size": args["--size"]}}
+            # A fresh store, as a build that did not just index would have
+            store = open_store(root / "_index", backend, readonly=True)
+            written = timed("%s index, all feeds" % backend,
+                            lambda: write_feeds(config, store))
+            digests = {path: digest for path, digest, _ in written}
+            timed("%s index, again (unchanged)" % backend,
+                  lambda: write_feeds(config, open_store(
+                      root / "_index", backend, readonly=True),
+                      digest=lambda path: digests.get(path)))
+            print("    %d files, %d bytes" % (
+                len(written), sum(path.stat().st_size
+                                  for path, _, _ in written)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compare filtering and sorting the index by parsing ISO dates (the old
+behavior) against the epoch timestamps and date view kept with the index.
+
+Usage:
+    index_dates.py [-n COUNT] [-k NEWEST]
+
+Options:
+    -n --count=COUNT    Number of items in the index [default: 100000]
+    -k --newest=NEWEST  How many of the newest items a catalog lists
+                        [default: 20]
+"""
+import datetime
+import random
+import time
+
+import arrow
+import jmespath
+from docopt import docopt
+
+from webquills.indexer import DateView
+from webquills.util import epoch_seconds
+
+EPOCH = datetime.datetime(2010, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def make_items(count):
+    rng = random.Random(42)
+    items = {}
+    for i in range(count):
+        dt = EPOCH + datetime.timedelta(seconds=rng.randrange(10 ** 9))
+        stamp = dt.isoformat().replace("+00:00", "Z")
+        guid = "urn:uuid:%d" % i
+        items[guid] = {"guid": guid, "published": stamp, "updated": stamp,
+                       "epoch": {"published": epoch_seconds(dt),
+                                 "updated": epoch_seconds(dt)}}
+    return items
+
+
+def timed(label, func):
+    start = time.perf_counter()
+    result = func()
+    print("%-36s %9.2f ms" % (label, (time.perf_counter() - start) * 1000))
+    return result
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args["--count"])
+    k = int(args["--newest"])
+    items = make_items(count)
+    print("%d items, newest %d" % (count, k))
+
+    now = arrow.now()
+    timed("future filter, arrow.get", lambda: [
+        item for item in items.values()
+        if arrow.get(item["published"]) <= now])
+    cutoff = time.time()
+    timed("future filter, epoch", lambda: [
+        item for item in items.values()
+        if item["epoch"]["published"] <= cutoff])
+
+    query = jmespath.compile("reverse(sort_by(*, &updated))[:%d]" % k)
+    old = timed("newest N, sort_by ISO strings", lambda: query.search(items))
+
+    view = timed("build date view", lambda: DateView(
+        (item["epoch"]["updated"], guid) for guid, item in items.items()))
+    new = timed("newest N, date view", lambda: view.newest(k))
+    timed("newest N before now, date view", lambda: view.newest(k, cutoff))
+    timed("1000 upserts into date view", lambda: [
+        view.add(i, "urn:uuid:new-%d" % i) for i in range(1000)])
+    assert [item["guid"] for item in old] == new
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compare a typical catalog query against the JSON index store, which loads
+every Item, and the SQLite store, which runs it as SQL and loads only the
+Items it returns. Each store is opened fresh, as a render worker would.
+
+Usage:
+    index_pushdown.py [-n COUNT] [-k NEWEST]
+
+Options:
+    -n --count=COUNT    Number of items in the index [default: 50000]
+    -k --newest=NEWEST  How many of the newest articles a catalog lists
+                        [default: 20]
+"""
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from docopt import docopt
+
+import webquills.query as query
+from webquills.indexdb import BACKENDS, open_store
+from webquills.indexer import IndexDelta
+
+ITEMTYPES = ("Item/Page/Article", "Item/Page/Article", "Item/Page")
+
+
+def make_delta(count):
+    delta = IndexDelta()
+    for i in range(count):
+        delta.upsert({
+            "guid": "urn:uuid:%d" % i, "title": "Item %d" % i,
+            "itemtype": ITEMTYPES[i % len(ITEMTYPES)],
+            "published": "2016-09-29T18:00:00Z",
+            "epoch": {"published": 1475172000 + i * 60},
+            "category": {"name": "section-%d" % (i % 20)},
+            "archetype": {"href": "/item-%d.json" % i},
+            "text": "Body of item %d. " % i * 20})
+    return delta
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args["--count"])
+    expression = ("* | [?starts_with(itemtype, `Item/Page/Article`) && "
+                  "category.name == 'section-3'] | [:%s]" % args["--newest"])
+    print("%d items: %s" % (count, expression))
+    delta = make_delta(count)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in BACKENDS:
+            store = open_store(Path(tmp) / backend, backend)
+            store.apply(delta)
+            store.save()
+
+            query.clear()
+            tracemalloc.start()
+            start = time.perf_counter()
+            index = open_store(Path(tmp) / backend, backend).as_dict()
+            results.append(query.search(expression, index["Items"]))
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print("%-8s %9.2f ms  %9.1f MB peak Python heap" % (
+                backend, elapsed * 1000, peak / 2 ** 20))
+    assert results[0] == results[1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compare building a render context per item with copy.deepcopy of the config
+(the old behavior of quill build) against the layered RenderContext.
+
+Usage:
+    render_context.py [-n COUNT] [-l LINKS]
+
+Options:
+    -n --count=COUNT    Number of items to render [default: 10000]
+    -l --links=LINKS    Number of navigation links in the site config,
+                        to vary the config size [default: 200]
+"""
+import copy
+import time
+import tracemalloc
+
+import jinja2
+from docopt import docopt
+
+from webquills.context import RenderContext
+from webquills.j2 import absolute
+
+jinja = jinja2.Environment()
+jinja.filters["absolute"] = absolute
+template = jinja.from_string(
+    "<title>{{ Item.title }} | {{ site.title }}</title>"
+    "{% for link in site.nav[:5] %}"
+    "<a href='{{ link.href|absolute(site.base) }}'>{{ link.title }}</a>"
+    "{% endfor %}{{ Article.body }}")
+
+
+def make_config(links):
+    return {
+        "options": {"root": "build/html", "source": "content"},
+        "jinja2": {"templatedir": "templates"},
+        "item_defaults": {"license": "https://example.com/license",
+                          "attributions": [{"name": "A. Author",
+                                            "role": "author"}]},
+        "site": {"title": "Benchmark", "base": "http://example.com/",
+                 "nav": [{"href": "/section-%d/" % i,
+                          "title": "Section %d" % i} for i in range(links)]},
+    }
+
+
+def make_item(i):
+    return {
+        "Item": {"itemtype": "Item/Page/Article", "title": "Item %d" % i,
+                 "guid": "urn:uuid:%d" % i, "published": "2016-09-29"},
+        "Article": {"body": "<p>Body of item %d</p>" % i},
+        "Webquills": {"scribes": ["html"]},
+    }
+
+
+def deepcopy_context(config, item, index):
+    context = copy.deepcopy(config)
+    context.update(item)
+    context["Index"] = index
+    return context
+
+
+def layered_context(config, item, index):
+    context = RenderContext(item, config)
+    context["Index"] = index
+    return context
+
+
+def run(label, build_context, config, items, index):
+    start = time.perf_counter()
+    cpu = time.process_time()
+    for item in items:
+        template.render(build_context(config, item, index))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+
+    # Memory held by each context while it is alive, e.g. queued for render
+    sample = items[:1000]
+    tracemalloc.start()
+    contexts = [build_context(config, item, index) for item in sample]
+    size = tracemalloc.get_traced_memory()[0] / len(contexts)
+    tracemalloc.stop()
+    print("%-10s %6d renders  wall %6.3fs  cpu %6.3fs  %8.1f KiB/context" %
+          (label, len(items), elapsed, cpu, size / 1024))
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args["--count"])
+    config = make_config(int(args["--links"]))
+    items = [make_item(i) for i in range(count)]
+    index = {"Items": {item["Item"]["guid"]: item["Item"] for item in items},
+             "totalResults": count}
+    run("deepcopy", deepcopy_context, config, items, index)
+    run("layered", layered_context, config, items, index)
+
+
+if __name__ == "__main__":
+    main()
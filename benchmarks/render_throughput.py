@@ -0,0 +1,91 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compare render throughput of a fresh Jinja environment per render (the old
+behavior of j2.render) against the shared environment registry.
+
+Usage:
+    render_throughput.py [-n COUNT]
+
+Options:
+    -n --count=COUNT    Number of items to render [default: 2000]
+"""
+import tempfile
+import time
+from pathlib import Path
+
+import jinja2
+from docopt import docopt
+
+import webquills.j2 as j2
+
+base = """<!DOCTYPE html>
+<html><head><title>{{ Item.title }}</title></head>
+<body>{% block body %}{% endblock %}
+{% for link in Item.links %}<a href="{{ link.href|absolute(site.base) }}">
+{{ link.title }}</a>{% endfor %}</body></html>
+"""
+page = """{% extends "base.html.j2" %}
+{% block body %}<div class="page">{% block content %}{% endblock %}</div>
+{% endblock %}"""
+article = """{% extends "Item_Page.html.j2" %}
+{% block content %}<h1>{{ Item.title }}</h1>{{ Article.body }}{% endblock %}"""
+
+
+def uncached_render(config, context, templatenames):
+    jinja = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(config["jinja2"]["templatedir"]))
+    jinja.filters["jmes"] = j2.jmes
+    jinja.filters["absolute"] = j2.absolute
+    jinja.filters["with_suffix"] = j2.with_suffix
+    return jinja.get_or_select_template(templatenames).render(context)
+
+
+def run(label, render, config, count):
+    context = {
+        "site": {"base": "http://example.com/"},
+        "Webquills": {"scribes": ["html"]},
+        "Item": {"itemtype": "Item/Page/Article", "title": "Benchmark",
+                 "links": [{"href": "/about.html", "title": "About"}]},
+        "Article": {"body": "<p>Lorem ipsum dolor sit amet.</p>" * 20},
+    }
+    start = time.perf_counter()
+    for i in range(count):
+        outputs = j2.templates_from_context(context)
+        render(config, context, outputs["html"])
+    elapsed = time.perf_counter() - start
+    print("%-10s %6d renders in %6.3fs  %8.1f renders/s" %
+          (label, count, elapsed, count / elapsed))
+
+
+def main():
+    args = docopt(__doc__)
+    count = int(args["--count"])
+    with tempfile.TemporaryDirectory() as tmp:
+        templatedir = Path(tmp)
+        (templatedir / "base.html.j2").write_text(base)
+        (templatedir / "Item_Page.html.j2").write_text(page)
+        (templatedir / "Item.html.j2").write_text(page)
+        (templatedir / "Item_Page_Article.html.j2").write_text(article)
+        config = {"jinja2": {"templatedir": str(templatedir)}}
+        run("uncached", uncached_render, config, count)
+        j2.clear_caches()
+        run("cached", j2.render, config, count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Count the filesystem metadata calls of a no-op build, asking the filesystem
+at every stage (the old behavior) against answering from a TreeSnapshot.
+
+Usage:
+    tree_snapshot.py [-n COUNT] [-a ASSETS]
+
+Options:
+    -n --count=COUNT    Number of articles in the site [default: 500]
+    -a --assets=ASSETS  Number of non-markdown assets [default: 2000]
+"""
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from docopt import docopt
+
+import webquills.build as build
+import webquills.util as util
+
+article = """---
+Itemtype: Item/Page/Article
+GUID: urn:uuid:00000000-0000-0000-0000-%012d
+Attributions:
+- role: author
+  name: A. Author
+Copyright: 2016 A. Author
+Published: 2016-09-29T18:00:00-0700
+Title: Article %d
+...
+Body of article %d.
+"""
+
+
+class Counter(object):
+    """Counts stat and scandir calls, and stats of the entries scandir
+    returns, which are separate syscalls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def install(self):
+        self._stat, self._scandir = os.stat, os.scandir
+        counter = self
+
+        class Entry(object):
+            def __init__(self, entry):
+                self._entry = entry
+
+            def stat(self, **kwargs):
+                counter.calls += 1
+                return self._entry.stat(**kwargs)
+
+            def __getattr__(self, name):
+                return getattr(self._entry, name)
+
+            def __fspath__(self):
+                return self._entry.path
+
+        def stat(*args, **kwargs):
+            counter.calls += 1
+            return counter._stat(*args, **kwargs)
+
+        class Listing(list):
+            def __enter__(self):
+                return iter(self)
+
+            def __exit__(self, *exc):
+                pass
+
+        def scandir(*args, **kwargs):
+            counter.calls += 1
+            with counter._scandir(*args, **kwargs) as entries:
+                return Listing(Entry(entry) for entry in entries)
+
+        os.stat, os.scandir = stat, scandir
+
+    def uninstall(self):
+        os.stat, os.scandir = self._stat, self._scandir
+
+
+def make_site(root: Path, count, assets):
+    (root / "templates").mkdir()
+    (root / "templates" / "Item.html.j2").write_text("{{ Item.title }}")
+    for i in range(count):
+        src = root / "content" / ("section-%d" % (i % 20)) / (
+            "article-%d.md" % i)
+        src.parent.mkdir(parents=True, exist_ok=True)
+        src.write_text(article % (i, i, i))
+    for i in range(assets):
+        asset = root / "content" / "img" / ("asset-%d.png" % i)
+        asset.parent.mkdir(parents=True, exist_ok=True)
+        asset.write_bytes(b"\x89PNG")
+    return {"options": {"root": str(root / "build"),
+                        "source": str(root / "content")},
+            "jinja2": {"templatedir": str(root / "templates")},
+            "site": {}}
+
+
+def noop_build(label, config, snapshot):
+    builder = build.Builder(config)
+    if not snapshot:
+        builder.arch.scan = lambda: None
+    counter = Counter()
+    counter.install()
+    start = time.perf_counter()
+    try:
+        builder.build()
+    finally:
+        counter.uninstall()
+    elapsed = time.perf_counter() - start
+    print("%-10s no-op build %6.3fs  %7d stat/scandir calls" % (
+        label, elapsed, counter.calls))
+
+
+def main():
+    args = docopt(__doc__)
+    util.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        config = make_site(Path(tmp), int(args["--count"]),
+                           int(args["--assets"]))
+        build.Builder(config).build()
+        noop_build("live", config, snapshot=False)
+        noop_build("snapshot", config, snapshot=True)
+
+
+if __name__ == "__main__":
+    main()
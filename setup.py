@@ -26,6 +26,12 @@ import sys
 with open('requirements.txt') as f:
     requirements = [line for line in f.read().split('\n') if line]
 
+# Optional features, e.g. pip install webquills[watch]
+extras_requirements = {
+    'watch': ['watchdog'],
+    'brotli': ['brotli'],
+}
+
 test_requirements = [
     # TODO: put package test requirements here
 ]
@@ -55,6 +61,7 @@ setup(
     include_package_data=True,
     entry_points={'console_scripts': ['quill = webquills.quill:main']},
     install_requires=requirements,
+    extras_require=extras_requirements,
     license=about['__license__'],
     zip_safe=False,
     classifiers=[
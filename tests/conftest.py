@@ -0,0 +1,82 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Helpers shared by the tests: sources, sites and index Items to build from.
+"""
+import time
+
+import arrow
+
+from webquills.util import epoch_seconds
+
+# Item n is published n days after this, unless told otherwise
+FIRST_PUBLISHED = 1475000000
+
+mdoc = """---
+Itemtype: Item/Page/Article
+GUID: urn:uuid:25cf55b5-345e-48e3-86ae-bc6c186f0f%(n)02d
+Attributions:
+- role: author
+  name: Vince Veselosky
+Copyright: 2016 Vince Veselosky
+Published: 2016-09-%(day)02dT18:00:00-0700
+Title: Article %(n)d
+...
+Heading %(n)d
+==========
+
+Body of article %(n)d, with a footnote.[^1]
+
+[^1]: The footnote.
+"""
+
+
+def article(n, day=29) -> str:
+    """Markdown source of article `n`, published on September `day`."""
+    return mdoc % {"n": n, "day": day}
+
+
+def make_site(root, templates, numbers=range(3), dated=False) -> dict:
+    """Write a site of the articles `numbers` to root/content, and
+    `templates` (name: text) to root/templates. With `dated`, article n is
+    published on September n. Returns the config to build it with."""
+    (root / "content").mkdir()
+    (root / "templates").mkdir()
+    for name, text in templates.items():
+        (root / "templates" / name).write_text(text)
+    for n in numbers:
+        (root / "content" / ("article-%d.md" % n)).write_text(
+            article(n, n if dated else 29), encoding="utf-8")
+    return {"options": {"root": str(root / "build"),
+                        "source": str(root / "content")},
+            "jinja2": {"templatedir": str(root / "templates")},
+            "site": {}}
+
+
+def make_item(n, published=None, **fields) -> dict:
+    """Item `n` as it is indexed, with `fields` set over the defaults. Its
+    epoch always agrees with its `published` date."""
+    if published is None:
+        published = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(
+            FIRST_PUBLISHED + n * 86400))
+    item = {"guid": "urn:uuid:%d" % n, "title": "Item %d" % n,
+            "published": published,
+            "epoch": {"published": epoch_seconds(arrow.get(published)
+                                                 .datetime)},
+            "archetype": {"href": "/item-%d.json" % n}}
+    item.update(fields)
+    return item
@@ -0,0 +1,49 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import copy
+
+import webquills.bench as bench
+
+
+def test_bench_measures_each_stage(tmp_path):
+    config = bench.make_site(tmp_path, count=12, catalogs=3, depth=2)
+    cold = bench.timed_build(config)
+    warm = bench.timed_build(config)
+
+    assert set(cold) == set(bench.STAGES) | {"total"}
+    assert cold["md2archetype"]["wall"] > 0
+    assert cold["validate"]["wall"] > 0
+    assert cold["render"]["peak_rss"] > 0
+    assert warm["validate"]["wall"] == 0  # nothing to convert
+    assert len(list((tmp_path / "build").glob("section-*/article-*.html"))) \
+        == 12
+
+
+def test_regressions():
+    results = {"params": {"count": 10}, "runs": {"cold": {
+        "render": {"wall": 1.0}, "index": {"wall": 0.01}}}}
+    baseline = copy.deepcopy(results)
+    assert bench.regressions(results, baseline) == []
+
+    results["runs"]["cold"]["render"]["wall"] = 1.2
+    results["runs"]["cold"]["index"]["wall"] = 0.03  # below the noise floor
+    assert bench.regressions(results, baseline) == [
+        "cold render: 1.200s, was 1.000s (+20%)"]
+    assert bench.regressions(results, baseline, tolerance=0.25) == []
+
+    baseline["params"]["count"] = 20
+    assert len(bench.regressions(results, baseline)) == 1
@@ -0,0 +1,226 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+from pathlib import Path
+
+import webquills.build as build
+from webquills.mdcache import MarkdownCache
+
+from conftest import article
+
+
+def make_sources(root, count):
+    sources = []
+    for i in range(count):
+        src = root / "articles" / ("article-%d.md" % i)
+        src.parent.mkdir(parents=True, exist_ok=True)
+        src.write_text(article(i), encoding="utf-8")
+        sources.append(src)
+    return sources
+
+
+def test_convert_sources_parallel_matches_serial(tmp_path):
+    config = {"options": {"root": str(tmp_path)},
+              "site": {"timezone": "America/New_York"}}
+    sources = make_sources(tmp_path, 6)
+
+    serial = list(build.convert_sources(config, sources, jobs=1))
+    parallel = list(build.convert_sources(config, sources, jobs=3))
+
+    assert [r.source for r in parallel] == sources
+    assert serial == parallel
+    assert all(r.error is None for r in serial)
+    # Footnote state must not leak from one document into the next
+    body = serial[-1].archetype["Article"]["body"]
+    assert body.count('class="footnote-ref"') == 1
+
+
+def test_convert_sources_with_cache(tmp_path):
+    config = {"options": {"root": str(tmp_path)}}
+    sources = make_sources(tmp_path, 4)
+    cache = MarkdownCache(tmp_path / "cache")
+
+    first = list(build.convert_sources(config, sources, cache=cache))
+    again = list(build.convert_sources(config, sources, jobs=2, cache=cache))
+
+    assert [r.cached for r in first] == [False] * 4
+    assert [r.cached for r in again] == [True] * 4
+    assert [r.archetype for r in again] == [r.archetype for r in first]
+    uncached = list(build.convert_sources(config, sources))
+    assert [r.archetype for r in uncached] == [r.archetype for r in first]
+    assert {r.cached for r in uncached} == {None}
+
+
+def test_convert_source_reports_validation_error(tmp_path):
+    config = {"options": {"root": str(tmp_path)}}
+    src = tmp_path / "bad.md"
+    src.write_text("No metadata at all.", encoding="utf-8")
+
+    results = list(build.convert_sources(config, [src]))
+
+    assert len(results) == 1
+    description, message, path = results[0].error
+    assert "required" in message
+
+
+def test_index_archetypes_parallel_matches_serial(tmp_path):
+    config = {"options": {"root": str(tmp_path)}}
+    sources = make_sources(tmp_path, 6)
+    paths = []
+    for result in build.convert_sources(config, sources):
+        result.target.write_text(json.dumps(result.archetype))
+        paths.append(result.target)
+
+    serial = build.index_archetypes(paths)
+    parallel = build.index_archetypes(paths, jobs=3)
+
+    assert len(serial) == 6
+    assert serial.upserts == parallel.upserts
+    assert list(serial.upserts) == list(parallel.upserts)
+
+
+def test_render_archetypes_collects_errors(tmp_path):
+    templatedir = tmp_path / "templates"
+    templatedir.mkdir()
+    (templatedir / "Item.html.j2").write_text("{{ Item.title }}")
+    (templatedir / "Item_Page_Broken.html.j2").write_text("{{ nope() }}")
+    config = {"jinja2": {"templatedir": str(templatedir)}}
+    paths = []
+    for i, itemtype in enumerate(["Item/Page", "Item/Page/Broken",
+                                  "Item/Page", None]):
+        path = tmp_path / ("item-%d.json" % i)
+        item = {"Webquills": {"scribes": ["html"]},
+                "Item": {"itemtype": itemtype, "title": "Item %d" % i}}
+        path.write_text(json.dumps(item if itemtype else {"not": "an item"}))
+        paths.append(path)
+
+    serial = list(build.render_archetypes(config, paths, tmp_path / "_index"))
+    parallel = list(build.render_archetypes(config, paths, tmp_path / "_index",
+                                            jobs=2))
+
+    assert [r.source for r in parallel] == paths
+    assert [r.outputs for r in serial] == [r.outputs for r in parallel]
+    assert serial[0].outputs == [(paths[0].with_suffix(".html"), "Item 0")]
+    assert "UndefinedError" in serial[1].error
+    assert serial[2].templates == {"Item.html.j2", "Item_Page.html.j2"}
+    assert serial[3].outputs is None and serial[3].error is None
+
+
+def test_render_workers_share_the_index(tmp_path):
+    templatedir = tmp_path / "templates"
+    templatedir.mkdir()
+    (templatedir / "Item.html.j2").write_text("{{ Index.totalResults }}")
+    config = {"jinja2": {"templatedir": str(templatedir)}}
+    paths = []
+    for i in range(3):
+        path = tmp_path / ("catalog-%d.json" % i)
+        path.write_text(json.dumps({
+            "Webquills": {"scribes": ["html"]},
+            "Item": {"itemtype": "Item/Page/Catalog", "title": str(i)}}))
+        paths.append(path)
+    loads = []
+
+    def load_index():
+        loads.append(1)
+        return {"Items": {}, "totalResults": 42}
+
+    # Nothing is stored in _index, so only the shared index says 42
+    results = list(build.render_archetypes(
+        config, paths, tmp_path / "_index", jobs=2, load_index=load_index,
+        share_index=True))
+    assert [r.outputs[0][1] for r in results] == ["42"] * 3
+    assert loads == [1]
+    assert build._shared == {}
+
+
+def environments(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "Item.html.j2").write_text(
+        "{{ site.base }}{{ Item.archetype.href }}")
+    make_sources(tmp_path / "content", 3)
+    configs = []
+    for name in ("local", "staging"):
+        configs.append((name, {
+            "options": {"root": str(tmp_path / name),
+                        "source": str(tmp_path / "content")},
+            "jinja2": {"templatedir": str(tmp_path / "templates")},
+            "site": {"base": "http://%s" % name}}))
+    return configs
+
+
+def test_build_environments_render_each_from_one_conversion(tmp_path):
+    configs = environments(tmp_path)
+
+    assert build.build_environments(configs, include_future=True) == {
+        "local": [], "staging": []}
+
+    page = Path("articles", "article-1.html")
+    assert (tmp_path / "local" / page).read_text() == \
+        "http://local/articles/article-1.json"
+    assert (tmp_path / "staging" / page).read_text() == \
+        "http://staging/articles/article-1.json"
+    # Staging took its archetypes from local rather than converting
+    assert not (tmp_path / "staging" / ".webquills" / "markdown").exists()
+    assert (tmp_path / "staging" / "_index" / "_catalog.json").read_text() == \
+        (tmp_path / "local" / "_index" / "_catalog.json").read_text()
+
+    src = tmp_path / "content" / "articles" / "article-2.md"
+    src.unlink()
+    build.build_environments(configs, include_future=True)
+    assert not (tmp_path / "staging" / "articles" / "article-2.json").exists()
+    assert not (tmp_path / "staging" / "articles" / "article-2.html").exists()
+
+
+def test_build_environments_converting_differently(tmp_path):
+    configs = environments(tmp_path)
+    configs[1][1]["item_defaults"] = {"license": "CC0"}
+
+    build.build_environments(configs, include_future=True)
+
+    archetype = tmp_path / "staging" / "articles" / "article-0.json"
+    assert json.loads(archetype.read_text())["Item"]["license"] == "CC0"
+
+
+def test_unresolved_embeds_are_retried(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "Item.html.j2").write_text("{{ Item.body }}")
+    src, = make_sources(tmp_path / "content", 1)
+    url = "http://video.example.com/v/1"
+    src.write_text(src.read_text() + "\n[!embed](%s)\n" % url)
+    config = {"options": {"root": str(tmp_path / "site"),
+                          "source": str(tmp_path / "content"),
+                          "offline": True,
+                          "embed-fixtures": str(tmp_path / "fixtures")},
+              "jinja2": {"templatedir": str(tmp_path / "templates")}}
+    archetype = tmp_path / "site" / "articles" / "article-0.json"
+
+    def body():
+        return json.loads(archetype.read_text())["Article"]["body"]
+
+    build.Builder(config, include_future=True).build()
+    assert '<a href="%s">' % url in body()
+
+    # The response turns up later: the source is converted again
+    builder = build.Builder(config, include_future=True)
+    fixture = builder.embeds.key(url, None, None) + ".json"
+    (tmp_path / "fixtures").mkdir()
+    (tmp_path / "fixtures" / fixture).write_text(json.dumps({
+        "url": url, "fetched": 0, "response": {
+            "type": "video", "version": "1.0",
+            "html": '<iframe src="%s"></iframe>' % url}}))
+    builder.build()
+    assert '<iframe src="%s">' % url in body()
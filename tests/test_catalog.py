@@ -0,0 +1,95 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+from pathlib import Path
+
+import webquills.build as build
+import webquills.catalog as catalog
+import webquills.query as query
+
+from conftest import make_site
+
+home = """---
+Item:
+    itemtype: Item/Page/Catalog
+    guid: "urn:uuid:25cf55b5-345e-48e3-86ae-bc6c186f0f00"
+    attributions:
+    - role: author
+      name: Vince Veselosky
+    copyright: 2016 Vince Veselosky
+    published: 2016-09-01T00:00:00Z
+    title: Home
+Catalog:
+    page_size: 2
+    queries:
+        - "* | [?starts_with(itemtype, `Item/Page/Article`)]"
+...
+Welcome.
+"""
+
+page_template = ("{% for i in Pagination.Items %}{{ i.title }} {% endfor %}"
+                 "{{ Pagination.number }}/{{ Pagination.count }} "
+                 "{{ Pagination.next }}")
+
+
+def make_catalog_site(root):
+    config = make_site(root, {"Item.html.j2": "{{ Item.title }}",
+                              "Item_Page_Catalog.html.j2": page_template},
+                       numbers=range(1, 6), dated=True)
+    (root / "content" / "index.md").write_text(home)
+    return config
+
+
+def test_page_path():
+    src = Path("/build/news/index.json")
+    assert catalog.page_path(src, 1, "html") == Path("/build/news/index.html")
+    assert catalog.page_path(src, 2, "html") == Path("/build/news/page/2.html")
+    assert catalog.page_path(Path("/build/archive.json"), 3, "html") == \
+        Path("/build/archive/page/3.html")
+
+
+def test_listing_spans_queries():
+    items = query.Versioned({str(n): {"n": n, "odd": n % 2 == 1}
+                             for n in range(6)}, query_version="v")
+    queries = ["* | [?odd]", "* | [?!odd] | reverse(sort_by(@, &n))"]
+    query.clear()
+    assert catalog.listing_size(queries, items) == 6
+    assert [i["n"] for i in catalog.listing_slice(queries, items, 2, 5)] == \
+        [5, 4, 2]
+
+
+def test_unchanged_pages_are_not_rendered(tmp_path):
+    config = make_catalog_site(tmp_path)
+    assert build.Builder(config).build() == []
+    out = tmp_path / "build"
+    pages = [out / "index.html", out / "page" / "2.html",
+             out / "page" / "3.html"]
+    assert pages[0].read_text() == "Article 5 Article 4 1/3 /page/2.html"
+    assert pages[2].read_text() == "Article 1 3/3 None"
+
+    # Only the last page lists the oldest article
+    before = [page.stat().st_mtime_ns for page in pages[:2]]
+    src = tmp_path / "content" / "article-1.md"
+    src.write_text(src.read_text().replace("Article 1", "Changed"))
+    assert build.Builder(config).build() == []
+    assert pages[2].read_text() == "Changed 3/3 None"
+    assert [page.stat().st_mtime_ns for page in pages[:2]] == before
+
+    # Fewer pages: the old last page goes away
+    src.unlink()
+    assert build.Builder(config).build() == []
+    assert pages[1].read_text() == "Article 3 Article 2 2/2 None"
+    assert not pages[2].exists()
@@ -0,0 +1,48 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import jinja2
+import pytest
+
+import webquills.j2 as j2
+from webquills.context import RenderContext
+
+
+def test_layers_and_writes():
+    config = {"site": {"title": "Site"}, "Webquills": {"scribes": ["html"]}}
+    item = {"Item": {"title": "Item"}, "Webquills": {"scribes": ["atom"]}}
+    context = RenderContext(item, config)
+
+    assert context["Webquills"]["scribes"] == ["atom"]
+    assert context["site"]["title"] == "Site"
+    context["Index"] = {"Items": {}}
+    assert "Index" not in config and "Index" not in item
+
+
+def test_templates_cannot_mutate_shared_state(tmp_path):
+    j2.clear_caches()
+    (tmp_path / "t.j2").write_text(
+        "{{ site.links.append('x') }}{{ site|tojson }}")
+    config = {"jinja2": {"templatedir": str(tmp_path)},
+              "site": {"links": ["a"]}}
+
+    with pytest.raises(jinja2.UndefinedError):
+        j2.render(config, RenderContext({}, config), "t.j2")
+    assert config["site"]["links"] == ["a"]
+
+    (tmp_path / "u.j2").write_text("{{ site|tojson }}")
+    out = j2.render(config, RenderContext({}, config), "u.j2")
+    assert out == '{"links": ["a"]}'
@@ -0,0 +1,83 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+import pytest
+from webquills.copier import CopyEngine
+from webquills.localfs import LocalArchivist
+
+
+def make_tree(root):
+    (root / "img").mkdir(parents=True)
+    (root / "empty").mkdir()
+    (root / "a.md").write_text("Hello")
+    (root / "img" / "b.png").write_bytes(b"\x89PNG" * 1000)
+
+
+def test_mirror_copies_once(tmp_path):
+    make_tree(tmp_path / "src")
+    engine = CopyEngine()
+    results = engine.mirror(tmp_path / "src", tmp_path / "dest")
+
+    assert sorted(str(d.relative_to(tmp_path / "dest"))
+                  for d, st, written in results if written) == \
+        ["a.md", os.path.join("img", "b.png")]
+    assert (tmp_path / "dest" / "img" / "b.png").read_bytes() == \
+        b"\x89PNG" * 1000
+    assert (tmp_path / "dest" / "empty").is_dir()
+    assert engine.stats["copied"] == 2
+    assert engine.stats["copied_bytes"] == 4005
+
+    engine.reset_stats()
+    results = engine.mirror(tmp_path / "src", tmp_path / "dest")
+    assert not any(written for d, st, written in results)
+    assert engine.stats["skipped"] == 2
+    assert engine.stats["skipped_bytes"] == 4005
+    assert not [p for p in os.listdir(str(tmp_path / "dest"))
+                if p.endswith(".tmp")]
+
+
+def test_hardlink_mode_shares_storage(tmp_path):
+    make_tree(tmp_path / "src")
+    engine = CopyEngine(mode="hardlink")
+    engine.mirror(tmp_path / "src", tmp_path / "dest")
+
+    assert engine.stats["linked"] == 2
+    assert os.path.samefile(str(tmp_path / "src" / "a.md"),
+                            str(tmp_path / "dest" / "a.md"))
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        CopyEngine(mode="teleport")
+
+
+def test_gather_notices_linked_file_edited_in_place(tmp_path):
+    config = {"options": {"root": str(tmp_path / "build"),
+                          "source": str(tmp_path / "content"),
+                          "copy": "hardlink"}}
+    (tmp_path / "content").mkdir()
+    src = tmp_path / "content" / "a.md"
+    src.write_text("Hello")
+    arch = LocalArchivist(config)
+
+    assert arch.gather_sources() == [arch.root / "a.md"]
+    assert arch.gather_sources() == []
+    with open(str(src), "a") as f:
+        f.write(", world")
+    assert arch.gather_sources([src]) == [arch.root / "a.md"]
+    assert arch.copier.stats["skipped"] == 1
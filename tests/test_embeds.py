@@ -0,0 +1,96 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+import shutil
+
+from pyembed.core.error import PyEmbedError
+from webquills.embeds import EmbedCache, find_embeds
+from webquills.mdown import new_converter
+
+text = """
+A video:
+
+[!embed?max_width=400](http://video.example.com/v/1)
+
+[!embed](http://video.example.com/v/2)
+"""
+
+
+class Fetcher(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, url, max_width=None, max_height=None):
+        self.calls.append(url)
+        if url.endswith("/missing"):
+            raise PyEmbedError("404")
+        return {"type": "video", "version": "1.0", "width": max_width,
+                "html": '<iframe src="%s"></iframe>' % url}
+
+
+def test_find_embeds():
+    assert find_embeds(text) == [("http://video.example.com/v/1", 400, None),
+                                 ("http://video.example.com/v/2", None, None)]
+
+
+def test_prefetch_then_convert_offline(tmp_path):
+    fetch = Fetcher()
+    cache = EmbedCache(tmp_path / "embeds", fetch=fetch)
+    assert cache.prefetch(find_embeds(text) * 2) == []
+    assert sorted(fetch.calls) == ["http://video.example.com/v/1",
+                                   "http://video.example.com/v/2"]
+    assert cache.stats == {"cached": 0, "fetched": 2, "failed": 0}
+
+    html = new_converter({}, cache).convert(text)
+    assert '<iframe src="http://video.example.com/v/1"></iframe>' in html
+
+    cache.prefetch(find_embeds(text))
+    assert cache.stats == {"cached": 2, "fetched": 0, "failed": 0}
+
+    # Offline, from fixtures only: nothing is fetched
+    shutil.copytree(str(tmp_path / "embeds"), str(tmp_path / "fixtures"))
+    offline = EmbedCache(tmp_path / "empty", offline=True,
+                         fixtures=tmp_path / "fixtures", fetch=None)
+    assert offline.prefetch(find_embeds(text)) == []
+    assert new_converter({}, offline).convert(text) == html
+
+
+def test_unresolved_embed_becomes_link(tmp_path):
+    cache = EmbedCache(tmp_path, offline=True, fetch=None)
+    url = "http://video.example.com/v/1"
+    assert cache.prefetch([(url, None, None)]) == [
+        (url, "not cached, and offline")]
+    assert cache.embed(url) == '<a href="%s">%s</a>' % (url, url)
+
+    cache = EmbedCache(tmp_path, fetch=Fetcher())
+    failed = cache.prefetch([("http://video.example.com/missing", 1, 2)])
+    assert failed == [("http://video.example.com/missing", "404")]
+
+
+def test_expired_entries_are_fetched_again(tmp_path):
+    fetch = Fetcher()
+    cache = EmbedCache(tmp_path, ttl=60, fetch=fetch)
+    embed = ("http://video.example.com/v/1", None, None)
+    cache.prefetch([embed])
+    path = cache.path(cache.key(*embed))
+    entry = json.loads(path.read_text())
+    entry["fetched"] -= 120
+    path.write_text(json.dumps(entry))
+
+    cache.prefetch([embed])
+    assert cache.stats["fetched"] == 1
+    assert len(fetch.calls) == 2
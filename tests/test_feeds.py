@@ -0,0 +1,132 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+import re
+
+import webquills.build as build
+import webquills.feeds as feeds
+import webquills.indexdb as indexdb
+import webquills.indexer as indexer
+
+import conftest
+
+
+def make_item(n):
+    return conftest.make_item(
+        n, title="Item <%d>" % n, category={"name": "News"},
+        attributions=[{"name": "Author", "role": "author"}],
+        archetype={"href": "/news/item %d.json" % n})
+
+
+def make_store(directory, backend, count):
+    store = indexdb.open_store(directory, backend)
+    delta = indexer.IndexDelta()
+    for n in range(count):
+        delta.upsert(make_item(n))
+    store.apply(delta)
+    store.save()
+    return store
+
+
+def locs(path):
+    return re.findall(r"<loc>(.*?)</loc>", path.read_text())
+
+
+def test_sitemap_is_split_at_the_url_limit(tmp_path):
+    store = make_store(tmp_path / "_index", "json", 5)
+    path = tmp_path / "sitemap.xml"
+
+    results = feeds.write_sitemap(store, "http://example.net/", path,
+                                  "http://example.net/sitemap.xml",
+                                  max_urls=2)
+
+    assert [p.name for p, _, _ in results] == [
+        "sitemap.xml", "sitemap-1.xml", "sitemap-2.xml", "sitemap-3.xml"]
+    assert "<sitemapindex" in path.read_text()
+    assert locs(path) == ["http://example.net/sitemap-%d.xml" % n
+                          for n in (1, 2, 3)]
+    # Newest first, percent-encoded
+    assert locs(tmp_path / "sitemap-1.xml") == [
+        "http://example.net/news/item%204.html",
+        "http://example.net/news/item%203.html"]
+    assert len(locs(tmp_path / "sitemap-3.xml")) == 1
+
+    digests = {p: digest for p, digest, _ in results}
+    again = feeds.write_sitemap(store, "http://example.net/", path,
+                                "http://example.net/sitemap.xml",
+                                digest=digests.get, max_urls=2)
+    assert [written for _, _, written in again] == [False] * 4
+
+
+def test_feeds_are_the_same_from_either_backend(tmp_path):
+    config = {"options": {"root": str(tmp_path)},
+              "site": {"base": "http://example.net", "title": "A & B"},
+              "feeds": {"sitemap": "sitemap.xml", "atom": "feed.atom",
+                        "json": "feed.json", "size": "2"}}
+    outputs = []
+    for backend in indexdb.BACKENDS:
+        store = make_store(tmp_path / backend, backend, 3)
+        feeds.write_feeds(config, store)
+        outputs.append([(tmp_path / name).read_text()
+                        for name in ("sitemap.xml", "feed.atom",
+                                     "feed.json")])
+    assert outputs[0] == outputs[1]
+
+    sitemap, atom, feed = outputs[0]
+    assert sitemap.count("<url>") == 3
+    assert atom.count("<entry>") == 2
+    assert "<title>A &amp; B</title>" in atom
+    assert "<title>Item &lt;2&gt;</title>" in atom
+    feed = json.loads(feed)
+    assert [item["id"] for item in feed["items"]] == ["urn:uuid:2",
+                                                      "urn:uuid:1"]
+    assert feed["items"][0]["url"] == "http://example.net/news/item%202.html"
+
+
+def test_builder_writes_feeds_when_the_index_changes(tmp_path):
+    (tmp_path / "templates").mkdir()
+    (tmp_path / "templates" / "Item.html.j2").write_text("{{ Item.title }}")
+    (tmp_path / "content").mkdir()
+    src = tmp_path / "content" / "a.md"
+    src.write_text("---\nItemtype: Item/Page/Article\nTitle: A\n"
+                   "GUID: urn:uuid:1\nPublished: 2016-09-29T18:00:00-0700\n"
+                   "Attributions:\n- name: Author\n  role: author\n...\nA.\n")
+    config = {"options": {"root": str(tmp_path / "build"),
+                          "source": str(tmp_path / "content")},
+              "jinja2": {"templatedir": str(tmp_path / "templates")},
+              "site": {"base": "http://example.net"},
+              "feeds": {"sitemap": "sitemap.xml", "json": "feed.json"}}
+
+    assert build.Builder(config).build() == []
+    feed = tmp_path / "build" / "feed.json"
+    assert json.loads(feed.read_text())["items"][0]["title"] == "A"
+    before = feed.stat().st_mtime_ns
+
+    # The feed is not mistaken for an archetype
+    builder = build.Builder(config)
+    assert builder.arch.archetypes_needing_indexing() == []
+    assert builder.build() == []
+    assert feed.stat().st_mtime_ns == before
+
+    src.write_text(src.read_text().replace("Title: A", "Title: B"))
+    builder.build()
+    assert json.loads(feed.read_text())["items"][0]["title"] == "B"
+
+    del config["feeds"]
+    build.Builder(config).build()
+    assert not feed.exists()
+    assert not (tmp_path / "build" / "sitemap.xml").exists()
@@ -0,0 +1,72 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import webquills.highlight as highlight
+from webquills.mdcache import MarkdownCache
+from webquills.mdown import new_converter
+
+doc = """
+Indented:
+
+    :::python
+    def hello():
+        return "world"
+
+Fenced:
+
+```python
+def hello():
+    return "world"
+```
+
+Once more:
+
+    :::python
+    def hello():
+        return "world"
+"""
+
+
+def test_highlighting_is_memoized(tmp_path):
+    plain = new_converter({}).convert(doc)
+    store = MarkdownCache(tmp_path)
+    cache = highlight.HighlightCache(store)
+    try:
+        assert new_converter({}, highlights=cache).convert(doc) == plain
+        assert cache.stats["blocks"] == 3
+        assert cache.stats["hits"] == 1  # fenced blocks differ in lang line
+
+        # A later build finds them on disk
+        cache = highlight.HighlightCache(store)
+        assert new_converter({}, highlights=cache).convert(doc) == plain
+        assert cache.stats["hits"] == 3
+        assert cache.stats["saved"] > 0
+    finally:
+        highlight.install(None)
+
+
+def test_library_upgrades_miss_the_cache(tmp_path, monkeypatch):
+    store = MarkdownCache(tmp_path)
+    try:
+        cache = highlight.HighlightCache(store)
+        new_converter({}, highlights=cache).convert(doc)
+        monkeypatch.setattr(highlight, "library_versions",
+                            lambda: ["Markdown 99", "Pygments 99"])
+        cache = highlight.HighlightCache(store)
+        new_converter({}, highlights=cache).convert(doc)
+        assert cache.stats["hits"] == 1  # only the repeat within the doc
+    finally:
+        highlight.install(None)
@@ -0,0 +1,131 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import pytest
+
+import webquills.indexdb as indexdb
+import webquills.indexer as indexer
+import webquills.query as query
+
+import conftest
+
+
+def make_item(n, itemtype="Item/Page/Article", category="tech"):
+    item = conftest.make_item(n, itemtype=itemtype, title="Item %d" % (n % 4),
+                              category={"name": category})
+    if n % 3 == 0:
+        item["updated"] = "2016-12-01"
+        item["epoch"]["updated"] = item["epoch"]["published"] + 86400 * 90
+    return item
+
+
+def make_stores(tmp_path, items):
+    stores = []
+    for backend in indexdb.BACKENDS:
+        store = indexdb.open_store(tmp_path / backend, backend)
+        delta = indexer.IndexDelta()
+        for item in items:
+            delta.upsert(item)
+        store.apply(delta)
+        store.save()
+        stores.append(store)
+    return stores
+
+
+queries = [
+    "*",
+    "* | [?starts_with(itemtype, `Item/Page/Article`)]",
+    "* | [?starts_with(itemtype, `Item/Page/Article`)]"
+    "| reverse(sort_by(@, &epoch.published)) | [:5]",
+    "* | [?category.name == 'news' || epoch.published < `1475500000`]",
+    "* | [?!updated] | sort_by(@, &title) | [3:6]",
+    "* | [?updated > '2016-11' || title < 'Item 2'] | sort_by(@, &guid)",
+    "reverse(sort_by(*, &title))[1]",
+    "* | [?itemtype != 'Item/Page/Catalog'] | [0]",
+]
+
+
+@pytest.mark.parametrize("expression", queries)
+def test_pushdown_matches_jmespath(tmp_path, expression):
+    items = [make_item(n, category="news" if n % 5 == 0 else "tech")
+             for n in range(20)]
+    items.append(make_item(20, itemtype="Item/Page/Catalog"))
+    json_store, sqlite_store = make_stores(tmp_path, items)
+    query.clear()
+
+    pushed = query.search(expression, sqlite_store.as_dict()["Items"])
+    assert query.stats["pushed"] == 1
+    assert pushed == query.search(expression, json_store.as_dict()["Items"])
+
+
+def test_odd_values_fall_back_to_jmespath(tmp_path):
+    items = [make_item(n) for n in range(3)]
+    items[1]["title"] = ["not", "a", "string"]
+    json_store, sqlite_store = make_stores(tmp_path, items)
+    query.clear()
+
+    expression = "* | [?title] | sort_by(@, &guid)"
+    pushed = query.search(expression, sqlite_store.as_dict()["Items"])
+    assert query.stats["pushed"] == 0
+    assert pushed == query.search(expression, json_store.as_dict()["Items"])
+
+
+def test_stores_skip_items_that_are_not_indexable(tmp_path):
+    undated = make_item(1)
+    del undated["published"], undated["epoch"]
+    unlinked = make_item(2)
+    unlinked["archetype"] = None
+    for store in make_stores(tmp_path, [undated, unlinked, make_item(3)]):
+        assert list(store.as_dict()["Items"]) == ["urn:uuid:3"]
+
+
+def test_sqlite_store_versions_and_tombstones(tmp_path):
+    json_store, store = make_stores(tmp_path, [make_item(1), make_item(2)])
+    version = store.version
+
+    delta = indexer.IndexDelta()
+    delta.upsert(make_item(2))  # unchanged
+    store.apply(delta)
+    assert store.save() == [] and store.version == version
+
+    delta.delete("/item-1.json")
+    store.apply(delta)
+    assert store.save() == [store.indexfile] and store.version != version
+
+    index = indexdb.open_store(store.directory, "sqlite",
+                               readonly=True).as_dict()
+    assert list(index["Items"]) == ["urn:uuid:2"]
+    assert index["totalResults"] == 1
+
+
+def test_stores_hide_items_published_later(tmp_path):
+    items = [make_item(n) for n in range(10)]
+    json_store, sqlite_store = make_stores(tmp_path, items)
+    until = items[6]["epoch"]["published"]
+    query.clear()
+
+    expression = "* | [?starts_with(itemtype, `Item/Page`)] | [:5]"
+    results = []
+    for store in (json_store, sqlite_store):
+        index = store.as_dict(until)
+        results.append((list(index["Items"]), index["totalResults"],
+                        query.search(expression, index["Items"]),
+                        store.newest(3, until=until), store.count(until),
+                        list(store.hrefs("published", until))))
+    assert query.stats["pushed"] == 1
+    assert results[0] == results[1]
+    assert results[0][1] == 7
+    assert "urn:uuid:9" not in results[0][0]
@@ -0,0 +1,140 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+
+import webquills.indexer as indexer
+
+from conftest import make_item
+
+
+def test_store_upserts_and_tombstones(tmp_path):
+    store = indexer.IndexStore(tmp_path / "_index")
+    delta = indexer.IndexDelta()
+    delta.upsert(make_item(1))
+    delta.upsert(make_item(2, published="2016-10-01T00:00:00Z"))
+    store.apply(delta)
+    assert len(store.save()) == 3  # two shards and the catalog
+
+    store = indexer.IndexStore(tmp_path / "_index")
+    delta = indexer.IndexDelta()
+    delta.delete("/item-1.json")
+    store.apply(delta)
+    written = store.save()
+    assert store.shard_path("2016-10") not in written
+    assert not store.shard_path("2016-09").exists()
+
+    index = indexer.IndexStore(tmp_path / "_index").as_dict()
+    assert list(index["Items"]) == ["urn:uuid:2"]
+    assert index["totalResults"] == 1
+
+
+def test_store_moves_item_between_shards(tmp_path):
+    store = indexer.IndexStore(tmp_path / "_index")
+    delta = indexer.IndexDelta()
+    delta.upsert(make_item(1))
+    store.apply(delta)
+    store.save()
+
+    delta = indexer.IndexDelta()
+    delta.upsert(make_item(1, published="2017-01-01T00:00:00Z"))
+    store.apply(delta)
+    store.save()
+
+    store = indexer.IndexStore(tmp_path / "_index")
+    assert store.catalog["items"]["urn:uuid:1"][0] == "2017-01"
+    assert store.as_dict()["totalResults"] == 1
+
+
+def test_merged_deltas_later_wins():
+    first = indexer.IndexDelta()
+    first.upsert(make_item(1))
+    second = indexer.IndexDelta()
+    second.upsert(dict(make_item(1), title="Changed"))
+    second.delete("/gone.json")
+
+    merged = indexer.IndexDelta().merge(first).merge(second)
+    assert merged.upserts["urn:uuid:1"]["title"] == "Changed"
+    assert list(merged.tombstones) == ["/gone.json"]
+
+
+def test_date_view_newest_and_cutoff():
+    view = indexer.DateView([(30, "c"), (10, "a"), (20, "b")])
+    view.add(20, "b2")
+    view.remove(10, "a")
+
+    assert view.newest() == ["c", "b2", "b"]
+    assert view.newest(2) == ["c", "b2"]
+    assert view.newest(until=25) == ["b2", "b"]
+    assert view.count(until=19) == 0
+
+
+def test_store_orders_items_newest_first(tmp_path):
+    store = indexer.IndexStore(tmp_path / "_index")
+    delta = indexer.IndexDelta()
+    delta.upsert(make_item(1, published="2016-09-01T00:00:00Z"))
+    delta.upsert(make_item(2, published="2016-10-01T00:00:00Z"))
+    delta.upsert(dict(make_item(3, published="2016-08-01T00:00:00Z"),
+                      updated="2016-11-01T00:00:00Z"))
+    store.apply(delta)
+    store.save()
+
+    store = indexer.IndexStore(tmp_path / "_index")
+    assert store.newest(1, field="published") == ["urn:uuid:2"]
+    assert list(store.as_dict()["Items"]) == [
+        "urn:uuid:3", "urn:uuid:2", "urn:uuid:1"]
+    delta = indexer.IndexDelta()
+    delta.upsert(dict(make_item(1, published="2017-01-01T00:00:00Z")))
+    store.apply(delta)
+    assert store.newest(1) == ["urn:uuid:1"]
+
+
+def test_future_items_are_indexed_but_hidden(tmp_path):
+    path = tmp_path / "future.json"
+    item = make_item(1, published="2999-01-01T00:00:00Z")
+    item["epoch"] = {"published": 32472144000}
+    path.write_text(json.dumps({"Item": item}))
+    store = indexer.IndexStore(tmp_path / "_index")
+    delta = indexer.build_delta([path])
+    delta.upsert(make_item(2))
+    store.apply(delta)
+
+    now = 1500000000
+    assert list(store.as_dict()["Items"]) == ["urn:uuid:1", "urn:uuid:2"]
+    assert list(store.as_dict(now)["Items"]) == ["urn:uuid:2"]
+    assert store.newest(until=now) == ["urn:uuid:2"]
+    assert [href for href, _ in store.hrefs(until=now)] == ["/item-2.json"]
+    assert store.view_version(now) != store.view_version(32472144000)
+
+
+def test_files_that_are_not_indexable_items_are_skipped(tmp_path):
+    undated = make_item(1)
+    del undated["published"], undated["epoch"]
+    unlinked = make_item(2)
+    del unlinked["archetype"]
+    files = [{"Item": undated}, {"Item": unlinked}, {"Item": "text"},
+             {"not": "an item"}, [1, 2], {"Item": make_item(3)}]
+    paths = []
+    for n, data in enumerate(files):
+        paths.append(tmp_path / ("%d.json" % n))
+        paths[-1].write_text(json.dumps(data))
+
+    delta = indexer.build_delta(paths)
+    assert list(delta.upserts) == ["urn:uuid:3"]
+    assert delta.tombstones == {"/item-1.json": True}
+    store = indexer.IndexStore(tmp_path / "_index")
+    store.apply(delta)
+    assert list(store.as_dict()["Items"]) == ["urn:uuid:3"]
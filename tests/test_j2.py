@@ -25,3 +25,49 @@ def test_templates_from_context():
     result = j2.templates_from_context(context)
     assert result == {"html": ["Item_Page_Article.html.j2", "Item_Page.html.j2",
                       "Item.html.j2"]}
+
+
+def test_templates_from_context_result_is_not_shared():
+    context = {
+        "Item": {"itemtype": "Item/Page"},
+        "Webquills": {"scribes": ["html"]}
+    }
+    first = j2.templates_from_context(context)
+    first["html"].append("junk.html.j2")
+    assert j2.templates_from_context(context) == {
+        "html": ["Item_Page.html.j2", "Item.html.j2"]}
+
+
+def test_template_selection_is_cached(tmp_path):
+    j2.clear_caches()
+    (tmp_path / "Item.html.j2").write_text("{{ Item.title }}")
+    config = {"jinja2": {"templatedir": str(tmp_path)}}
+    context = {"Item": {"title": "Hello"}}
+    names = ["Item_Page.html.j2", "Item.html.j2"]
+
+    assert j2.render(config, context, names) == "Hello"
+    assert j2.get_environment(config) is j2.get_environment(config)
+
+    # The negative lookup is remembered even after the template appears
+    (tmp_path / "Item_Page.html.j2").write_text("Page")
+    assert j2.render(config, context, names) == "Hello"
+    j2.clear_caches()
+    assert j2.render(config, context, names) == "Page"
+
+
+def test_template_dependencies(tmp_path):
+    j2.clear_caches()
+    (tmp_path / "base.html.j2").write_text("{% block body %}{% endblock %}")
+    (tmp_path / "macros.html.j2").write_text("{% macro m() %}{% endmacro %}")
+    (tmp_path / "Item.html.j2").write_text(
+        '{% extends "base.html.j2" %}'
+        '{% import "macros.html.j2" as macros %}')
+    config = {"jinja2": {"templatedir": str(tmp_path)}}
+
+    deps = j2.template_dependencies(config, ["Item_Page.html.j2",
+                                             "Item.html.j2"])
+    assert deps == {"Item_Page.html.j2", "Item.html.j2", "base.html.j2",
+                    "macros.html.j2"}
+
+    (tmp_path / "dynamic.html.j2").write_text("{% include Item.name %}")
+    assert j2.template_dependencies(config, "dynamic.html.j2") is None
@@ -0,0 +1,130 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+from webquills.localfs import LocalArchivist
+
+
+def make_archivist(tmp_path):
+    config = {"options": {"root": str(tmp_path / "build"),
+                          "source": str(tmp_path / "content")}}
+    (tmp_path / "content").mkdir()
+    return LocalArchivist(config)
+
+
+def test_sources_follow_content_not_mtime(tmp_path):
+    arch = make_archivist(tmp_path)
+    src = arch.source_dir / "article.md"
+    src.write_text("Hello", encoding="utf-8")
+
+    arch.gather_sources()
+    built = arch.root / "article.md"
+    assert arch.sources_needing_update() == [built]
+    arch.write_json(built.with_suffix(".json"), {"Item": {}})
+    arch.mark_converted(built, built.with_suffix(".json"))
+    assert arch.sources_needing_update() == []
+
+    # A checkout that only changes timestamps is not a change
+    os.utime(str(src), ns=(1, 1))
+    arch.gather_sources()
+    assert arch.sources_needing_update() == []
+
+    # A real change is noticed even when the mtime goes backwards
+    src.write_text("Hello, world", encoding="utf-8")
+    os.utime(str(src), ns=(1, 1))
+    arch.gather_sources()
+    assert arch.sources_needing_update() == [built]
+
+
+def test_write_skips_identical_content(tmp_path):
+    arch = make_archivist(tmp_path)
+    target = arch.root / "out.html"
+    assert arch.write_text(target, "<p>Hi</p>")
+    mtime = target.stat().st_mtime_ns
+    assert not arch.write_text(target, "<p>Hi</p>")
+    assert target.stat().st_mtime_ns == mtime
+
+
+def test_write_does_not_change_a_hardlinked_source(tmp_path):
+    arch = make_archivist(tmp_path)
+    src = arch.source_dir / "page.html"
+    src.write_text("<p>Source</p>")
+    target = arch.root / "page.html"
+    target.parent.mkdir()
+    os.link(str(src), str(target))  # as the copier's link mode leaves it
+
+    assert arch.write_text(target, "<p>Built</p>")
+    assert target.read_text() == "<p>Built</p>"
+    assert src.read_text() == "<p>Source</p>"
+    assert list(arch.root.glob(".*.tmp")) == []
+
+
+def test_deleted_output_needs_render(tmp_path):
+    arch = make_archivist(tmp_path)
+    archetype = arch.root / "page.json"
+    arch.write_json(archetype, {"Item": {}})
+    output = archetype.with_suffix(".html")
+    arch.write_text(output, "<p>Hi</p>")
+    arch.mark_rendered(archetype, [output])
+    assert arch.archetypes_needing_render() == []
+
+    output.unlink()
+    assert arch.archetypes_needing_render() == [archetype]
+
+
+def test_render_tracks_template_dependencies(tmp_path):
+    arch = make_archivist(tmp_path)
+    templatedir = tmp_path / "templates"
+    templatedir.mkdir()
+    arch.config["jinja2"] = {"templatedir": str(templatedir)}
+    (templatedir / "article.html.j2").write_text("article")
+    (templatedir / "catalog.html.j2").write_text("catalog")
+    article = arch.root / "article.json"
+    catalog = arch.root / "catalog.json"
+    arch.write_json(article, {"Item": {}})
+    arch.write_json(catalog, {"Item": {}})
+    arch.write_json(arch.indexfile, {"Items": {}})
+    arch.mark_rendered(article, [], templates=["article.html.j2"])
+    arch.mark_rendered(catalog, [], templates=["catalog.html.j2"],
+                       uses_index=True)
+    assert arch.archetypes_needing_render() == []
+
+    (templatedir / "catalog.html.j2").write_text("new catalog")
+    arch.commit()
+    arch = LocalArchivist(arch.config)
+    assert arch.archetypes_needing_render() == [catalog]
+
+    arch.mark_rendered(catalog, [], templates=["catalog.html.j2"],
+                       uses_index=True)
+    arch.write_json(arch.indexfile, {"Items": {"x": {}}})
+    assert arch.archetypes_needing_render() == [catalog]
+
+
+def test_dependents_match_template_names_exactly(tmp_path):
+    arch = make_archivist(tmp_path)
+    templatedir = tmp_path / "templates"
+    templatedir.mkdir()
+    arch.config["jinja2"] = {"templatedir": str(templatedir)}
+    for name in ("Item_Page.html.j2", "ItemXPage.html.j2",
+                 "item_page.html.j2"):
+        (templatedir / name).write_text(name)
+        page = arch.root / (name + ".json")
+        arch.write_json(page, {"Item": {}})
+        arch.mark_rendered(page, [], templates=[name])
+
+    assert arch.dependents("template:Item_Page.html.j2") == [
+        arch.root / "Item_Page.html.j2.json"]
@@ -0,0 +1,50 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+
+from webquills.mdcache import MarkdownCache
+from webquills.mdown import converter_fingerprint, new_converter
+
+
+def test_cache_hit_needs_same_text_and_converter(tmp_path):
+    cache = MarkdownCache(tmp_path)
+    converter = new_converter({})
+    fingerprint = converter_fingerprint()
+
+    first = cache.convert(converter, "# Title\n\nText.", fingerprint)
+    assert '<h1 id="title">' in first["html"]
+    assert 'href="#title"' in first["toc"]
+    assert cache.convert(converter, "# Title\n\nText.", fingerprint) == first
+    assert cache.stats == {"hits": 1, "misses": 1}
+
+    cache.convert(converter, "# Title\n\nOther text.", fingerprint)
+    cache.convert(converter, "# Title\n\nText.", fingerprint + "x")
+    assert cache.stats == {"hits": 1, "misses": 3}
+
+
+def test_prune_removes_least_recently_used(tmp_path):
+    cache = MarkdownCache(tmp_path, max_bytes=0)
+    keys = [cache.key(str(i), "f") for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, {"html": "x" * 100, "toc": ""})
+        os.utime(str(cache.path(key)), (1000 + i, 1000 + i))
+    size = cache.path(keys[0]).stat().st_size
+    cache.max_bytes = 2 * size
+
+    assert cache.get(keys[0]) is not None  # now the most recently used
+    assert cache.prune() == 1
+    assert [cache.get(key) is not None for key in keys] == [True, False, True]
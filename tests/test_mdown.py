@@ -128,3 +128,5 @@ def test_md2archetype_override_defaults():
     assert testdata['Item']['updated'] == "2016-09-29T18:00:00-07:00"
     assert testdata['Item']['published'] == "2016-09-28T00:00:00-04:00"
     assert testdata['Item']['slug'] == "i-made-this-up"
+    assert testdata['Item']['epoch']['updated'] == 1475197200
+    assert testdata['Item']['epoch']['published'] == 1475035200
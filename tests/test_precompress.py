@@ -0,0 +1,54 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import webquills.precompress as precompress
+from webquills.localfs import LocalArchivist
+from webquills.util import gunzip, gzip
+
+
+def test_precompress_is_reproducible(tmp_path):
+    page = tmp_path / "page.html"
+    page.write_bytes(b"<p>Hello</p>" * 1000)
+
+    first = precompress.precompress(page, precompress.available_encodings())
+    assert first[0] == tmp_path / "page.html.gz"
+    data = first[0].read_bytes()
+    assert gunzip(data) == page.read_bytes()
+    assert data == gzip(page.read_bytes(), mtime=0)
+
+    precompress.precompress(page)
+    assert first[0].read_bytes() == data
+
+
+def test_only_changed_files_are_compressed(tmp_path):
+    config = {"options": {"root": str(tmp_path / "build"),
+                          "source": str(tmp_path / "content")}}
+    arch = LocalArchivist(config)
+    page = arch.root / "page.html"
+    arch.write_text(page, "<p>Hello</p>")
+    arch.write_text(arch.root / "photo.png", "not text")
+    arch.write_text(arch.indexdir / "2016-09.json", "{}")
+
+    assert arch.files_needing_compression(precompress.SUFFIXES) == [page]
+    arch.mark_compressed(page, precompress.precompress(page))
+    assert arch.files_needing_compression(precompress.SUFFIXES) == []
+
+    arch.write_text(page, "<p>Changed</p>")
+    assert arch.files_needing_compression(precompress.SUFFIXES) == [page]
+
+    page.unlink()
+    assert arch.prune_compressed() == [arch.root / "page.html.gz"]
+    assert not (arch.root / "page.html.gz").exists()
@@ -0,0 +1,91 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import time
+
+import pytest
+
+import webquills.bench as bench
+import webquills.build as build
+import webquills.j2 as j2
+import webquills.profile as profile
+
+
+def test_spans_and_counters():
+    with profile.span("ignored"):
+        profile.count("ignored")
+    profiler = profile.enable()
+    try:
+        with profile.span("outer", "stage"):
+            time.sleep(0.01)
+            for i in range(2):
+                with profile.span("inner", "step"):
+                    time.sleep(0.01)
+        profile.count("files", 3)
+    finally:
+        assert profile.disable() is profiler
+
+    (cat, name, calls, total, own), inner = profiler.totals()
+    assert (cat, name, calls) == ("step", "inner", 2)
+    assert inner[:3] == ("stage", "outer", 1)
+    assert inner[3] == pytest.approx(total + inner[4])
+    assert profiler.counters == {"files": 3}
+
+    trace = profiler.chrome_trace()["traceEvents"]
+    assert [e["name"] for e in trace] == ["inner", "inner", "outer", "files"]
+    assert trace[2]["ph"] == "X" and trace[2]["dur"] >= 30000
+    assert trace[3] == dict(trace[3], ph="C", args={"value": 3})
+
+
+def test_profiled_build(tmp_path):
+    config = bench.make_site(tmp_path, count=4, catalogs=2, depth=2)
+    profiler = profile.enable()
+    try:
+        build.Builder(config).build()
+    finally:
+        profile.disable()
+
+    spans = {(cat, name) for cat, name, *_ in profiler.totals()}
+    assert {("stage", "gather"), ("stage", "convert"), ("stage", "index"),
+            ("stage", "render"), ("step", "md2archetype"),
+            ("step", "validate"), ("template", "Item_Page_Article.html.j2"),
+            ("template", "layout-0.html.j2"),
+            ("filter", "absolute"), ("filter", "jmes")} <= spans
+    assert profiler.counters["sources converted"] == 6
+    assert "sources converted" in profiler.summary(top=5)
+
+
+def test_included_and_extended_templates_are_spans(tmp_path):
+    (tmp_path / "base.html.j2").write_text(
+        "<body>{% block body %}{% endblock %}</body>")
+    (tmp_path / "footer.html.j2").write_text("<footer></footer>")
+    (tmp_path / "page.html.j2").write_text(
+        '{% extends "base.html.j2" %}'
+        '{% block body %}{% include "footer.html.j2" %}{% endblock %}')
+    config = {"jinja2": {"templatedir": str(tmp_path)}}
+    j2.clear_caches()
+    profiler = profile.enable()
+    try:
+        html = j2.render(config, {}, "page.html.j2")
+    finally:
+        profile.disable()
+
+    assert html == "<body><footer></footer></body>"
+    assert [name for name, cat, *_ in profiler.events
+            if cat == "template"] == ["footer.html.j2", "base.html.j2",
+                                      "page.html.j2"]
+    # Without a profiler, templates render as before
+    assert j2.render(config, {}, "page.html.j2") == html
@@ -0,0 +1,105 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+import time
+
+from webquills.localfs import MANIFEST
+from webquills.manifest import BuildManifest
+from webquills.precompress import precompress
+from webquills.publish import LocalBucket, Publisher, open_bucket
+from webquills.util import gunzip
+
+
+def make_site(root):
+    (root / "css").mkdir(parents=True)
+    (root / "index.html").write_text("<p>Home</p>")
+    (root / "css" / "site.css").write_text("p {}")
+    (root / "logo.png").write_bytes(b"\x89PNG")
+    (root / "_index").mkdir()
+    (root / "_index" / "_catalog.json").write_text("{}")
+
+
+def precompress_recorded(root, key):
+    # As the build's compress stage does
+    manifest = BuildManifest(root / MANIFEST)
+    src = root / key
+    manifest.record("compress", key, manifest.digest(src), precompress(src))
+    manifest.close()
+
+
+def test_publish_uploads_only_changes(tmp_path):
+    root = tmp_path / "build"
+    make_site(root)
+    bucket = open_bucket(str(tmp_path / "bucket"))
+    assert isinstance(bucket, LocalBucket)
+
+    stats = Publisher(bucket, root, jobs=4).publish()
+    assert stats["uploaded"] == 3 and stats["unchanged"] == 0
+    assert "_index/_catalog.json" not in bucket.etags()
+    assert bucket.headers("index.html") == {
+        "ContentType": "text/html; charset=utf-8"}
+
+    (root / "index.html").write_text("<p>New home</p>")
+    stats = Publisher(bucket, root, jobs=4).publish()
+    assert stats["uploaded"] == 1 and stats["unchanged"] == 2
+
+
+def test_publish_gzip_is_deterministic(tmp_path):
+    root = tmp_path / "build"
+    make_site(root)
+    bucket = LocalBucket(tmp_path / "bucket")
+
+    Publisher(bucket, root, compress=True).publish()
+    assert bucket.headers("css/site.css") == {
+        "ContentEncoding": "gzip", "ContentType": "text/css; charset=utf-8"}
+    assert "ContentEncoding" not in bucket.headers("logo.png")
+    body = (tmp_path / "bucket" / "css" / "site.css").read_bytes()
+    assert gunzip(body) == b"p {}"
+
+    stats = Publisher(bucket, root, compress=True).publish()
+    assert stats["uploaded"] == 0 and stats["unchanged"] == 3
+
+
+def test_publish_gzip_uses_precompressed_siblings(tmp_path):
+    root = tmp_path / "build"
+    make_site(root)
+    precompress_recorded(root, "index.html")
+    precompress(root / "css" / "site.css")  # not recorded, so not used
+    (root / "css" / "site.css.gz").write_bytes(b"not gzip")
+    bucket = LocalBucket(tmp_path / "bucket")
+    publisher = Publisher(bucket, root, compress=True)
+
+    publisher.publish()
+    gz = root / "index.html.gz"
+    assert bucket.headers("index.html.gz")["ContentEncoding"] == "gzip"
+    assert (tmp_path / "bucket" / "index.html.gz").read_bytes() == \
+        gz.read_bytes()  # not gzipped twice
+    assert (tmp_path / "bucket" / "index.html").read_bytes() == \
+        gz.read_bytes()
+    assert gunzip((tmp_path / "bucket" / "css" / "site.css").read_bytes()) \
+        == b"p {}"
+
+    # A stale sibling is not used, however new; what is compared is
+    # uploaded as is
+    (root / "index.html").write_text("<p>New home</p>")
+    later = time.time() + 60
+    os.utime(str(gz), (later, later))
+    publisher = Publisher(bucket, root, compress=True)
+    uploads, unchanged = publisher.plan()
+    assert [upload.key for upload in uploads] == ["index.html"]
+    assert gunzip(uploads[0].body) == b"<p>New home</p>"
+    assert publisher.body(uploads[0]) is uploads[0].body
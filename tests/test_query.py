@@ -0,0 +1,81 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import webquills.j2 as j2
+import webquills.query as query
+from webquills.context import thaw
+
+items = {
+    "a": {"itemtype": "Item/Page/Article", "updated": "2016-09-01"},
+    "b": {"itemtype": "Item/Page/Article", "updated": "2016-09-03"},
+    "c": {"itemtype": "Item/Page/Catalog", "updated": "2016-09-02"},
+}
+newest = ("* | [?starts_with(itemtype, `Item/Page/Article`)]"
+          "| reverse(sort_by(@, &updated))")
+
+
+def test_versioned_results_are_shared():
+    query.clear()
+    index = query.Versioned(items, query_version="v1")
+
+    first = j2.jmes(index, newest)
+    second = j2.jmes(index, newest)
+    assert [i["updated"] for i in first] == ["2016-09-03", "2016-09-01"]
+    assert thaw(second) is thaw(first)
+    assert query.stats == {"compiled": 1, "hits": 1, "misses": 1,
+                           "pushed": 0}
+
+    # A new version of the data is a new question
+    j2.jmes(query.Versioned(items, query_version="v2"), newest)
+    assert query.stats["misses"] == 2
+
+
+def test_unversioned_data_is_not_cached():
+    query.clear()
+    assert j2.jmes(items, "a.updated") == "2016-09-01"
+    assert j2.jmes(items, "a.updated") == "2016-09-01"
+    assert query.stats == {"compiled": 1, "hits": 0, "misses": 0,
+                           "pushed": 0}
+
+
+def test_plan_of_catalog_query():
+    plan = query.plan(newest + " | [:10]")
+    assert plan.where == ("starts_with", "itemtype", "Item/Page/Article")
+    assert plan.order == (("updated", True), (None, True))
+    assert (plan.start, plan.stop, plan.single) == (0, 10, False)
+
+    plan = query.plan("* | [?category.name == 'tech' && !draft] | [2]")
+    assert plan.where == ("and", ("eq", "category.name", "tech"),
+                          ("not", ("truthy", "draft")))
+    assert (plan.start, plan.stop, plan.single) == (2, 3, True)
+
+
+def test_plan_refuses_other_shapes():
+    assert query.plan("Items.*") is None
+    assert query.plan("* | [:3] | reverse(@)") is None
+    assert query.plan("* | [?length(tags) > `2`]") is None
+
+
+def test_search_slice_and_count_match_full_search():
+    query.clear()
+    index = query.Versioned(items, query_version="v1")
+    assert query.search_slice(newest, index, 0, 1) == [items["b"]]
+    assert query.count(newest, index) == 2
+    assert newest not in query._results["v1"]  # no full sort
+
+    assert query.search_slice(newest, index, 1, 5) == [items["a"]]
+    assert query.search_slice("* | [?updated] | [0]", index, 0, 5) == \
+        [items["a"]]
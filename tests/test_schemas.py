@@ -33,3 +33,30 @@ def test_item_schema_is_valid():
 
     # raises ValidationError if not valid
     jsonschema.validate(testjson, schema)
+
+
+def test_inline_refs():
+    from webquills.util import inline_refs
+    schema = {
+        "definitions": {
+            "link": {"type": "object", "required": ["href"]},
+            "node": {"properties": {"next": {"$ref": "#/definitions/node"}}},
+        },
+        "properties": {"link": {"$ref": "#/definitions/link"},
+                       "node": {"$ref": "#/definitions/node"}},
+    }
+    resolved = inline_refs(schema)
+    assert resolved["properties"]["link"] == {"type": "object",
+                                              "required": ["href"]}
+    # Recursive references stay as references
+    assert resolved["properties"]["node"]["properties"]["next"] == {
+        "$ref": "#/definitions/node"}
+
+
+def test_validate_many():
+    from webquills.util import Schematist
+    schematist = Schematist({})
+    errors = schematist.validate_many([{"Item": {}}, {}])
+    assert len(errors) == 2
+    assert all(isinstance(e, jsonschema.ValidationError) for e in errors[0])
+    assert "'Item' is a required property" in [e.message for e in errors[1]]
@@ -0,0 +1,60 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import pytest
+from webquills.localfs import LocalArchivist
+from webquills.snapshot import TreeSnapshot
+
+
+def test_snapshot_answers_from_memory(tmp_path):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "one.md").write_text("one")
+    (tmp_path / "two.json").write_text("{}")
+    tree = TreeSnapshot(tmp_path)
+
+    assert tree.files(".md") == [tmp_path / "a" / "one.md"]
+    assert tree.stat(tmp_path / "a" / "one.md").st_size == 3
+    # Unnoticed changes are invisible until update() is called
+    (tmp_path / "a" / "one.md").unlink()
+    assert tree.is_file(tmp_path / "a" / "one.md")
+    tree.update(tmp_path / "a" / "one.md")
+    assert not tree.exists(tmp_path / "a" / "one.md")
+    with pytest.raises(FileNotFoundError):
+        tree.stat(tmp_path / "a" / "one.md")
+
+    (tmp_path / "b" / "c").mkdir(parents=True)
+    (tmp_path / "b" / "c" / "three.md").write_text("three")
+    tree.update(tmp_path / "b" / "c" / "three.md")
+    assert tree.exists(tmp_path / "b" / "c")
+    assert tree.files(".md") == [tmp_path / "b" / "c" / "three.md"]
+
+
+def test_archivist_keeps_snapshot_current(tmp_path):
+    config = {"options": {"root": str(tmp_path / "build"),
+                          "source": str(tmp_path / "content")}}
+    (tmp_path / "content").mkdir()
+    (tmp_path / "content" / "page.md").write_text("Hi")
+    arch = LocalArchivist(config)
+    arch.scan()
+
+    built = arch.root / "page.md"
+    assert arch.gather_sources() == [built]
+    assert arch.sources_needing_update() == [built]
+    target = built.with_suffix(".json")
+    arch.write_json(target, {"Item": {}})
+    arch.mark_converted(built, target)
+    assert arch.archetypes_needing_indexing() == [target]
+    assert arch.sources_needing_update() == []
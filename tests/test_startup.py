@@ -0,0 +1,53 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import json
+import subprocess
+import sys
+
+# Slow to import, and not needed to show config or write a new source
+HEAVY = ["boto3", "jinja2", "jmespath", "jsonschema", "markdown",
+         "pkg_resources", "pygments", "webquills.build", "webquills.util"]
+
+script = """
+import json, sys
+from webquills.quill import main
+sys.argv = ["quill"] + %r
+try:
+    main()
+finally:
+    sys.stderr.write(json.dumps(sorted(sys.modules)))
+"""
+
+
+def loaded_modules(tmp_path, args):
+    (tmp_path / "webquills.yml").write_text(
+        "options:\n  root: build\n  source: content\nsite:\n  title: T\n")
+    done = subprocess.run([sys.executable, "-c", script % (args,)],
+                          cwd=str(tmp_path), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          env={"PYTHONPATH": ":".join(sys.path)})
+    return done.stdout.decode(), set(json.loads(done.stderr.decode()))
+
+
+def test_quick_commands_stay_light(tmp_path):
+    out, modules = loaded_modules(tmp_path, ["config"])
+    assert "'site': {'title': 'T'}" in out
+    assert modules.isdisjoint(HEAVY)
+
+    out, modules = loaded_modules(tmp_path, ["new", "article", "Hello"])
+    assert 'title: "Hello"' in out
+    assert modules.isdisjoint(HEAVY)
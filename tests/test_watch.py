@@ -0,0 +1,115 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import os
+from pathlib import Path
+
+import pytest
+
+import webquills.build as build
+import webquills.watch as watch
+from webquills.watch import PollingWatcher, split_changes
+
+from conftest import make_site
+
+template = "<h1>{{ Item.title }}</h1>"
+
+
+def test_polling_watcher_reports_changes(tmp_path):
+    (tmp_path / "a.md").write_text("a")
+    (tmp_path / "b.md").write_text("b")
+    watcher = PollingWatcher([tmp_path])
+
+    (tmp_path / "a.md").write_text("changed")
+    (tmp_path / "b.md").unlink()
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "c.md").write_text("c")
+
+    assert watcher.poll() == {str(tmp_path / "a.md"), str(tmp_path / "b.md"),
+                              str(tmp_path / "sub" / "c.md")}
+    assert watcher.poll() == set()
+
+
+def test_split_changes(tmp_path):
+    sources, templates = split_changes(
+        [tmp_path / "content" / "a.md", tmp_path / "templates" / "x" / "y.j2",
+         tmp_path / "elsewhere.txt"],
+        tmp_path / "content", tmp_path / "templates")
+
+    assert sources == [tmp_path / "content" / "a.md"]
+    assert templates == ["x/y.j2"]
+
+
+def test_builder_update_renders_only_what_changed(tmp_path):
+    config = make_site(tmp_path, {"Item.html.j2": template})
+    builder = build.Builder(config)
+    assert builder.build() == []
+    out = tmp_path / "build" / "article-1.html"
+    assert out.read_text() == "<h1>Article 1</h1>"
+
+    src = tmp_path / "content" / "article-1.md"
+    src.write_text(src.read_text().replace("Article 1", "Changed"))
+    other = tmp_path / "build" / "article-2.html"
+    before = other.stat().st_mtime_ns
+    builder.update([src])
+    assert out.read_text() == "<h1>Changed</h1>"
+    assert other.stat().st_mtime_ns == before
+
+    (tmp_path / "templates" / "Item.html.j2").write_text(
+        "<h2>{{ Item.title }}</h2>")
+    builder.update(templates=["Item.html.j2"])
+    assert other.read_text() == "<h2>Article 2</h2>"
+
+    os.unlink(str(src))
+    builder.update([src])
+    assert not out.exists()
+    assert not Path(str(out)[:-5] + ".json").exists()
+
+
+class ScriptedWatcher(object):
+    """Reports each batch of changes in turn, after running its edit."""
+
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def wait(self):
+        if not self.batches:
+            raise KeyboardInterrupt()
+        edit, changed = self.batches.pop(0)
+        edit()
+        return changed
+
+    def stop(self):
+        pass
+
+
+def test_watch_survives_a_source_that_fails_to_convert(tmp_path,
+                                                       monkeypatch):
+    config = make_site(tmp_path, {"Item.html.j2": template})
+    src = tmp_path / "content" / "article-1.md"
+    good = src.read_text()
+    out = tmp_path / "build" / "article-1.html"
+
+    def save(text):
+        return lambda: src.write_text(text, encoding="utf-8")
+
+    watcher = ScriptedWatcher([
+        (save("---\nTitle: Half typed"), {src}),
+        (save(good.replace("Article 1", "Fixed")), {src})])
+    monkeypatch.setattr(watch, "make_watcher", lambda *args: watcher)
+    with pytest.raises(KeyboardInterrupt):
+        watch.watch(build.Builder(config))
+    assert out.read_text() == "<h1>Fixed</h1>"
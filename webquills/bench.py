@@ -0,0 +1,369 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+quill bench: build a synthetic site and time each stage of the pipeline.
+
+The site has `count` articles with full front matter, tables, footnotes
+and code blocks (drawn from a small pool, as real sites share snippets),
+spread over sections, each with its own paginated Catalog, plus a home
+page Catalog of everything. Templates extend each other `depth` deep.
+
+A cold build starts from an empty build directory, a warm one rebuilds it
+with nothing changed. For each, every stage gets its wall time, CPU time
+(including worker processes) and peak resident memory. Validation can only
+be told apart from Markdown conversion in a serial build; with workers it
+is counted in md2archetype.
+"""
+import json
+import os
+import platform
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import webquills.build as build
+from webquills.__about__ import __version__
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+STAGES = ("gather", "md2archetype", "validate", "index", "render")
+
+# Stages quicker than this (seconds) are too noisy to call regressions
+NOISE_FLOOR = 0.05
+
+article = """---
+Item:
+    itemtype: Item/Page/Article
+    guid: "urn:uuid:00000000-0000-4000-8000-%(number)012d"
+    title: "Article %(number)d: notes on %(topic)s"
+    description: "What we learned about %(topic)s, with examples."
+    published: 2016-%(month)02d-%(day)02dT09:30:00-0400
+    updated: 2016-%(month)02d-%(day)02dT17:45:00-0400
+    attributions:
+    - role: author
+      name: A. Author
+    copyright: "2016 A. Author"
+...
+%(topic_title)s
+%(underline)s
+
+Some prose about %(topic)s, with *emphasis*, a [link](/about.html) and a
+footnote.[^1] Then a list:
+
+* first point, about %(topic)s
+* second point
+* third point
+
+| Option  | Default | Meaning                     |
+|---------|---------|-----------------------------|
+| jobs    | 1       | worker processes            |
+| copy    | copy    | how assets are copied       |
+| index   | json    | where the index is kept     |
+
+```python
+%(code)s
+```
+
+More text after the code, long enough to look like a paragraph in an
+article that someone actually wrote, about %(topic)s and related things.
+
+[^1]: A footnote for article %(number)d.
+"""
+
+catalog = """---
+Item:
+    itemtype: Item/Page/Catalog
+    guid: "urn:uuid:00000000-0000-4000-9000-%(number)012d"
+    title: "%(title)s"
+    published: 2016-01-01T00:00:00Z
+Webquills:
+    scribes: [html, atom]
+Catalog:
+    page_size: 20
+    queries:
+        - "%(query)s"
+...
+The latest articles.
+"""
+
+snippets = [
+    "def handler(event, context):\n    return {'status': %d}",
+    "for item in items:\n    if item.ok:\n        yield item.value * %d",
+    "class Point(object):\n    def __init__(self, x, y):\n"
+    "        self.x, self.y = x, y + %d",
+    "import json\n\nprint(json.dumps({'answer': %d}, indent=2))",
+    "with open('data.txt') as f:\n    lines = f.readlines()[:%d]",
+]
+
+topics = ["caching", "indexing", "templates", "feeds", "deployment",
+          "markdown", "search", "images"]
+
+layouts = {
+    "html": """{%% extends "%(parent)s" %%}
+{%% block body %%}<div class="level-%(level)d">{%% block content %%}
+{%% endblock %%}</div>{%% endblock %%}""",
+    "base": """<!DOCTYPE html>
+<html><head><title>{{ Item.title }}</title>
+<link rel="canonical" href="{{ Item.archetype.href|absolute(site.base) }}">
+</head><body>{% block body %}{% endblock %}
+<footer>{{ Item.copyright }}</footer></body></html>
+""",
+    "article": """{%% extends "%(parent)s" %%}
+{%% block content %%}<article><h1>{{ Item.title }}</h1>
+<p>{{ Item.description }}</p>{{ Article.body }}</article>{%% endblock %%}""",
+    "page": """{%% extends "%(parent)s" %%}
+{%% block content %%}{{ Page.text }}{%% endblock %%}""",
+    "catalog": """{%% extends "%(parent)s" %%}
+{%% block content %%}{{ Page.text }}<ul>
+{%% for item in Pagination.Items %%}
+<li><a href="{{ item.archetype.href|with_suffix(".html") }}">
+{{ item.title }}</a> {{ item.published }}</li>{%% endfor %%}
+</ul>{%% if Pagination.next %%}<a href="{{ Pagination.next }}">Older</a>
+{%% endif %%}{%% endblock %%}""",
+    "atom": """<?xml version="1.0" encoding="utf-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom"><title>{{ Item.title }}</title>
+{% for item in Index.Items|jmes(Catalog.queries[0] ~ " | [:20]") %}
+<entry><title>{{ item.title }}</title><id>{{ item.guid }}</id>
+<updated>{{ item.updated }}</updated></entry>{% endfor %}</feed>
+""",
+}
+
+
+def make_site(root: Path, count=1000, catalogs=5, depth=3):
+    """Write a synthetic site under `root`. Returns its config."""
+    sections = ["section-%d" % i for i in range(max(catalogs - 1, 1))]
+    content = root / "content"
+    for i in range(count):
+        topic = topics[i % len(topics)]
+        title = "All about %s, part %d" % (topic, i)
+        src = content / sections[i % len(sections)] / ("article-%d.md" % i)
+        src.parent.mkdir(parents=True, exist_ok=True)
+        src.write_text(article % {
+            "number": i, "topic": topic,
+            "month": i % 12 + 1, "day": i % 28 + 1, "topic_title": title,
+            "underline": "=" * len(title),
+            "code": snippets[i % len(snippets)] % (i % 7)}, encoding="utf-8")
+    listings = [("Home", content / "index.md",
+                 "* | [?starts_with(itemtype, `Item/Page/Article`)]")]
+    for section in sections[:catalogs - 1]:
+        listings.append((section.title(), content / section / "index.md",
+                         "* | [?category.label == `%s`]" % section))
+    for number, (title, path, query) in enumerate(listings):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(catalog % {"number": number, "title": title,
+                                   "query": query}, encoding="utf-8")
+
+    templates = root / "templates"
+    templates.mkdir()
+    (templates / "layout-0.html.j2").write_text(layouts["base"])
+    for level in range(1, depth):
+        (templates / ("layout-%d.html.j2" % level)).write_text(
+            layouts["html"] % {"parent": "layout-%d.html.j2" % (level - 1),
+                               "level": level})
+    parent = "layout-%d.html.j2" % (depth - 1)
+    for name, layout in (("Item", "page"), ("Item_Page_Article", "article"),
+                         ("Item_Page_Catalog", "catalog")):
+        (templates / (name + ".html.j2")).write_text(
+            layouts[layout] % {"parent": parent})
+    (templates / "Item_Page_Catalog.atom.j2").write_text(layouts["atom"])
+
+    return {"options": {"root": str(root / "build"),
+                        "source": str(content)},
+            "jinja2": {"templatedir": str(templates)},
+            "markdown": {},
+            "item_defaults": {"attributions": [{"role": "author",
+                                                "name": "A. Author"}]},
+            "site": {"base": "http://www.example.com",
+                     "timezone": "America/New_York"}}
+
+
+def current_rss():
+    """Resident memory of this process in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is not None:
+        # Only the peak so far is available here; kB on Linux, bytes on Mac
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if platform.system() == "Darwin" else peak * 1024
+    return None
+
+
+def cpu_time() -> float:
+    """CPU time of this process and the worker processes it has reaped."""
+    if resource is None:
+        return time.process_time()
+    usage = [resource.getrusage(who) for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+class StageMeter(object):
+    """
+    Wall time, CPU time and peak memory of named stages. A stage may be
+    measured many times, and its figures add up (the peak is the largest).
+    Within `sampling`, a thread samples memory every `interval` seconds for
+    the stages running at the time.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stages = {}
+        self.running = {}
+
+    def _sample(self):
+        rss = current_rss() or 0
+        for stage in list(self.running):
+            self.running[stage] = max(self.running.get(stage, 0), rss)
+
+    @contextmanager
+    def sampling(self):
+        done = threading.Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                self._sample()
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        try:
+            yield
+        finally:
+            done.set()
+            sampler.join()
+
+    @contextmanager
+    def measure(self, stage):
+        self.running[stage] = 0
+        self._sample()
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+            self._sample()
+            peak = self.running.pop(stage)
+            totals = self.stages.setdefault(
+                stage, {"wall": 0.0, "cpu": 0.0, "peak_rss": 0})
+            totals["wall"] += wall
+            totals["cpu"] += cpu
+            totals["peak_rss"] = max(totals["peak_rss"], peak)
+
+    def wrap(self, obj, name, stage):
+        """Measure every call of the method `name` of `obj` as `stage`."""
+        method = getattr(obj, name)
+
+        def measured(*args, **kwargs):
+            with self.measure(stage):
+                return method(*args, **kwargs)
+        setattr(obj, name, measured)
+
+    def report(self) -> dict:
+        idle = {"wall": 0.0, "cpu": 0.0, "peak_rss": 0}
+        stages = {name: dict(self.stages.get(name) or idle) for name in STAGES}
+        # Validation happens inside conversion; report each on its own
+        for key in ("wall", "cpu"):
+            stages["md2archetype"][key] = max(
+                0.0, stages["md2archetype"][key] - stages["validate"][key])
+        return stages
+
+
+def timed_build(config):
+    """Build the site once, measuring each stage with a fresh Builder, as
+    a `quill build` would. Returns the report, with a "total" added."""
+    meter = StageMeter()
+    with meter.sampling(), meter.measure("total"):
+        builder = build.Builder(config)
+        arch = builder.arch
+        meter.wrap(arch, "scan", "gather")
+        meter.wrap(arch, "gather_sources", "gather")
+        meter.wrap(builder, "convert", "md2archetype")
+        meter.wrap(builder.schema, "validate", "validate")
+        meter.wrap(builder, "index", "index")
+        meter.wrap(builder, "render", "render")
+        failed = builder.build()
+    if failed:
+        raise RuntimeError("Benchmark build failed to render %d items" %
+                           len(failed))
+    report = meter.report()
+    report["total"] = meter.stages["total"]
+    return report
+
+
+def run(count=1000, catalogs=5, depth=3, jobs=1) -> dict:
+    """Build a synthetic site cold, then warm. Returns the results."""
+    params = {"count": count, "catalogs": catalogs, "depth": depth,
+              "jobs": jobs}
+    results = {"webquills": __version__,
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "params": params, "runs": {}}
+    with tempfile.TemporaryDirectory() as tmp:
+        config = make_site(Path(tmp), count, catalogs, depth)
+        config["options"]["jobs"] = str(jobs)
+        for label in ("cold", "warm"):
+            results["runs"][label] = timed_build(config)
+    return results
+
+
+def regressions(results, baseline, tolerance=0.1) -> list:
+    """Stages whose wall time grew by more than `tolerance` (a fraction)
+    over the `baseline` results, as messages."""
+    found = []
+    if results["params"] != baseline.get("params"):
+        found.append("Parameters differ from the baseline: %s vs %s" % (
+            results["params"], baseline.get("params")))
+        return found
+    for label, run in sorted(results["runs"].items()):
+        for stage, figures in sorted(run.items()):
+            before = baseline["runs"].get(label, {}).get(stage)
+            if not before or max(before["wall"],
+                                 figures["wall"]) < NOISE_FLOOR:
+                continue
+            if figures["wall"] > before["wall"] * (1 + tolerance):
+                found.append("%s %s: %.3fs, was %.3fs (+%.0f%%)" % (
+                    label, stage, figures["wall"], before["wall"],
+                    100 * (figures["wall"] / before["wall"] - 1)))
+    return found
+
+
+def format_results(results) -> str:
+    lines = ["%-6s %-13s %9s %9s %10s" % ("build", "stage", "wall (s)",
+                                          "cpu (s)", "peak MB")]
+    for label, run in results["runs"].items():
+        for stage in STAGES + ("total",):
+            figures = run[stage]
+            lines.append("%-6s %-13s %9.3f %9.3f %10.1f" % (
+                label, stage, figures["wall"], figures["cpu"],
+                figures["peak_rss"] / 2 ** 20))
+    return "\n".join(lines)
+
+
+def save(results, path):
+    Path(path).write_text(json.dumps(results, indent=2, sort_keys=True),
+                          encoding="utf-8")
+
+
+def load(path) -> dict:
+    return json.loads(Path(path).read_text(encoding="utf-8"))
@@ -0,0 +1,712 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import gc
+import json
+import multiprocessing
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import reduce
+from pathlib import Path
+
+import jsonschema
+
+import webquills.catalog as catalog
+import webquills.j2 as j2
+import webquills.precompress as precompress
+import webquills.profile as profile
+import webquills.query as query
+from webquills.context import RenderContext
+from webquills.embeds import embed_cache, find_embeds
+from webquills.feeds import write_feeds
+from webquills.highlight import HighlightCache
+from webquills.indexdb import index_backend, open_store
+from webquills.indexer import IndexDelta, build_delta
+from webquills.localfs import LocalArchivist
+from webquills.manifest import digest_parts
+from webquills.mdcache import markdown_cache
+from webquills.mdown import md2archetype, new_converter
+from webquills.util import Schematist, getLogger
+
+UTF8 = "utf-8"
+
+# Result of converting one markdown source. `error` is None on success, or a
+# (description, message, path) tuple taken from the ValidationError, which
+# keeps results picklable when they come back from a worker process.
+# `cached` says whether the Markdown cache had the body, or is None if no
+# cache was used. `highlights` holds the code blocks highlighted, how many
+# came from the HighlightCache and the seconds that saved, or is None.
+Conversion = namedtuple("Conversion",
+                        "source target archetype error cached highlights")
+
+# Result of rendering one archetype. `outputs` is a list of (path, text), or
+# None if the file is not an Item; text is None for a Catalog page that did
+# not change. `templates` is the set of template names used, or None if
+# unknown. `error` describes the exception that stopped the render, if any.
+# `queries` counts query cache activity in the worker. `pages` maps each
+# Catalog page path to a digest of what it lists.
+Rendering = namedtuple("Rendering", "source outputs templates uses_index "
+                                    "error queries pages")
+
+
+def get_jobs(config) -> int:
+    """Number of worker processes requested by config. 0 means one per CPU."""
+    jobs = int(config.get("options", {}).get("jobs") or 1)
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    return jobs
+
+
+def conversion_settings(config) -> list:
+    """The parts of a config that shape archetypes and the index. Builds
+    whose configs agree on these can share them."""
+    options = config.get("options", {})
+    return [options.get("source"), index_backend(config),
+            config.get("markdown"), config.get("item_defaults"),
+            config.get("site", {}).get("timezone")]
+
+
+def build_environments(configs, include_future=False) -> dict:
+    """Build the site once for each (name, config) in `configs`, each in its
+    own root. The first is built in full; the others take its archetypes
+    and index where their conversion settings agree, so they only render.
+    Returns the archetypes that failed to render, by environment name."""
+    logger = getLogger()
+    failed = {}
+    first = None
+    for name, config in configs:
+        logger.info("Building environment %s in %s" % (
+            name, config["options"]["root"]))
+        with profile.span(name, "environment"):
+            builder = Builder(config, include_future=include_future)
+            if first is None:
+                first = builder
+                failed[name] = builder.build()
+            elif conversion_settings(config) == \
+                    conversion_settings(first.config):
+                failed[name] = builder.build_from(first)
+            else:
+                logger.info("Environment %s converts differently, building "
+                            "it in full" % name)
+                failed[name] = builder.build()
+    return failed
+
+
+def convert_source(config, src: Path, schema: Schematist,
+                   converter=None, cache=None, highlights=None) -> Conversion:
+    """Convert one markdown source to a validated archetype."""
+    hits = cache.stats["hits"] if cache else None
+    before = dict(highlights.stats) if highlights else None
+    with profile.span("md2archetype", "step"):
+        archetype = md2archetype(config, src.read_text(encoding=UTF8),
+                                 converter=converter, cache=cache)
+    cached = None if cache is None else cache.stats["hits"] > hits
+    highlighted = None
+    if highlights is not None:
+        highlighted = tuple(highlights.stats[k] - before[k]
+                            for k in ("blocks", "hits", "saved"))
+    schema.apply_defaults(archetype, src)
+
+    # FIXME Because done before validation, category may not be right
+    # type. Gives confusing error message.
+    target = schema.root / archetype["Item"]["category"]["label"] / \
+        archetype["Item"]["slug"]
+    target = target.with_suffix(".json")
+    archetype["Item"]["archetype"] = {
+        "href": "/" + str(target.relative_to(schema.root)),
+        "rel": "wq:archetype"
+    }
+    archetype["Item"]["source"] = {
+        "href": "/" + str(src.relative_to(schema.root)),
+        "rel": "wq:source"
+    }
+
+    try:
+        with profile.span("validate", "step"):
+            schema.validate(archetype)
+    except jsonschema.ValidationError as e:
+        error = (str(e), e.message, list(e.path))
+        return Conversion(src, target, archetype, error, cached,
+                          highlighted)
+    return Conversion(src, target, archetype, None, cached, highlighted)
+
+
+# Per-process state for worker processes, set up by _init_worker.
+_worker = {}
+
+
+def _init_worker(config, cache=None, embeds=None, highlights=None):
+    _worker["config"] = config
+    _worker["schema"] = Schematist(config)
+    _worker["converter"] = new_converter(config, embeds, highlights)
+    _worker["cache"] = cache
+    _worker["highlights"] = highlights
+
+
+def _convert_in_worker(src):
+    return convert_source(_worker["config"], src, _worker["schema"],
+                          _worker["converter"], _worker["cache"],
+                          _worker["highlights"])
+
+
+def convert_sources(config, sources, jobs=1, schema=None, converter=None,
+                    cache=None, embeds=None, highlights=None):
+    """Convert markdown sources, yielding a Conversion for each.
+
+    With jobs > 1 the work fans out over a process pool. Results are always
+    yielded in the order of `sources`, so output is identical to a serial run.
+    A serial run uses `schema` and `converter` if given. Converted Markdown
+    is looked up in, and added to, the MarkdownCache `cache` if given.
+    Embeds are rendered from the EmbedCache `embeds` if given, which should
+    already hold them (see `EmbedCache.prefetch`). Code blocks are
+    highlighted through the HighlightCache `highlights` if given.
+    """
+    sources = list(sources)
+    if jobs <= 1 or len(sources) < 2:
+        schema = schema or Schematist(config)
+        converter = converter or new_converter(config, embeds, highlights)
+        for src in sources:
+            with profile.span(str(src), "convert"):
+                result = convert_source(config, src, schema, converter, cache,
+                                        highlights)
+            yield result
+        return
+
+    jobs = min(jobs, len(sources))
+    chunksize = max(1, len(sources) // (jobs * 4))
+    with ProcessPoolExecutor(jobs, initializer=_init_worker,
+                             initargs=(config, cache, embeds,
+                                       highlights)) as pool:
+        yield from pool.map(_convert_in_worker, sources, chunksize=chunksize)
+
+
+def index_archetypes(paths, jobs=1) -> IndexDelta:
+    """Collect the index changes for a list of archetype files.
+
+    With jobs > 1, partial deltas are built in a process pool and merged in
+    the order of `paths`, so the result matches a serial run.
+    """
+    paths = list(paths)
+    if jobs <= 1 or len(paths) < 2:
+        return build_delta(paths)
+
+    jobs = min(jobs, len(paths))
+    size = -(-len(paths) // (jobs * 4))  # ceiling division
+    batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+    with ProcessPoolExecutor(jobs) as pool:
+        deltas = pool.map(build_delta, batches)
+        return reduce(IndexDelta.merge, deltas, IndexDelta())
+
+
+class LazyIndex(object):
+    """Loads the stored index the first time a Catalog asks for it, leaving
+    out Items published after `until`."""
+
+    def __init__(self, indexdir: Path, backend="json", until=None):
+        self.indexdir = indexdir
+        self.backend = backend
+        self.until = until
+        self.index = None
+
+    def __call__(self):
+        if self.index is None:
+            self.index = open_store(self.indexdir, self.backend,
+                                    readonly=True).as_dict(self.until)
+        return self.index
+
+
+def render_archetype(config, src: Path, load_index, pages=None) -> Rendering:
+    """Render every output of one archetype. Never raises for a failed
+    template; the error is returned so the rest of the build can go on.
+
+    `pages` is what LocalArchivist.rendered_pages says about the last render
+    of a paginated Catalog; pages listing the same items as then are not
+    rendered again."""
+    before = dict(query.stats)
+    item = json.loads(src.read_text(encoding=UTF8))
+    if "Item" not in item:
+        return Rendering(src, None, None, False, None, {}, {})
+
+    # The config and index are shared by every render, not copied
+    context = RenderContext(item, config)
+    is_catalog = False
+    outputs = []
+    paged = {}
+    base, rendered = pages or (None, {})
+    templates = set()
+    try:
+        is_catalog = item["Item"]["itemtype"].startswith("Item/Page/Catalog")
+        if is_catalog:
+            index = context["Index"] = load_index()
+        with profile.span("templates_from_context", "step"):
+            templates_by_extension = j2.templates_from_context(context)
+        for extension, templatelist in templates_by_extension.items():
+            # Allows items to override output format, or request
+            # additional formats
+            if extension not in context["Webquills"]["scribes"]:
+                continue
+            if is_catalog and catalog.page_size(item):
+                for target, digest, pagination in catalog.paginate(
+                        item, src, Path(config["options"]["root"]),
+                        index, extension):
+                    # Other outputs (e.g. feeds) may show more than a page
+                    if extension not in catalog.PAGED_EXTENSIONS:
+                        digest = None
+                    else:
+                        paged[target] = digest
+                    if digest and base is not None and \
+                            rendered.get(target) == digest_parts(base, digest):
+                        outputs.append((target, None))
+                        continue
+                    context["Pagination"] = pagination
+                    outputs.append((target, j2.render(config, context,
+                                                      templatelist)))
+            else:
+                out = j2.render(config, context, templatelist)
+                outputs.append((src.with_suffix('.' + extension), out))
+            used = j2.template_dependencies(config, templatelist)
+            if templates is not None and used is not None:
+                templates.update(used)
+            else:
+                templates = None
+    except Exception as e:  # Reported by the caller, per file
+        error = "%s: %s" % (type(e).__name__, e)
+        return Rendering(src, None, None, is_catalog, error, {}, {})
+    queries = {key: query.stats[key] - before[key] for key in before}
+    return Rendering(src, outputs, templates, is_catalog, None, queries,
+                     paged)
+
+
+# The index loaded by render_archetypes before forking its workers, which
+# then share it rather than each loading a copy. Empty when not in use.
+_shared = {}
+
+
+def _init_render_worker(config, indexdir, until):
+    _worker["config"] = config
+    if "index" in _shared:
+        _worker["index"] = lambda: _shared["index"]
+    else:
+        _worker["index"] = LazyIndex(indexdir, index_backend(config), until)
+    j2.get_environment(config)
+
+
+def _render_in_worker(src, pages):
+    return render_archetype(_worker["config"], src, _worker["index"], pages)
+
+
+def render_archetypes(config, paths, indexdir: Path, jobs=1,
+                      load_index=None, rendered_pages=None, until=None,
+                      share_index=False):
+    """Render archetypes, yielding a Rendering for each, in order.
+
+    With jobs > 1, rendering runs in a process pool whose workers keep their
+    Jinja environments and their copy of the index warm between files. At
+    most two files per worker are in flight at once, so finished output
+    waiting to be written cannot pile up in memory. A serial run gets the
+    index from `load_index` if given, and otherwise leaves out of it the
+    Items published after `until`. `rendered_pages` is a function of an
+    archetype path, see render_archetype.
+
+    With `share_index`, a JSON index is loaded from `load_index` before the
+    workers fork, and they read that copy instead of each loading their
+    own, so memory does not grow with `jobs`. A SQLite index is always read
+    from the database as needed, and needs no sharing.
+    """
+    paths = list(paths)
+    rendered_pages = rendered_pages or (lambda src: None)
+    if jobs <= 1 or len(paths) < 2:
+        load_index = load_index or LazyIndex(
+            indexdir, index_backend(config), until)
+        for src in paths:
+            with profile.span(str(src), "render"):
+                result = render_archetype(config, src, load_index,
+                                          rendered_pages(src))
+            yield result
+        return
+
+    jobs = min(jobs, len(paths))
+    window = jobs * 2
+    if share_index and load_index is not None and \
+            index_backend(config) == "json" and \
+            multiprocessing.get_start_method() == "fork":
+        _shared["index"] = load_index()
+        # Keep the collector in the workers from writing to the shared
+        # objects, which would copy the pages they are on
+        gc.freeze()
+    try:
+        with ProcessPoolExecutor(jobs, initializer=_init_render_worker,
+                                 initargs=(config, indexdir, until)) as pool:
+            pending = deque()
+            for src in paths:
+                pending.append(pool.submit(_render_in_worker, src,
+                                           rendered_pages(src)))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        if _shared:
+            _shared.clear()
+            gc.unfreeze()
+
+
+class Builder(object):
+    """
+    Runs the build pipeline: copy sources into the build root, convert
+    markdown to archetypes, index them and render their outputs.
+
+    A Builder keeps its Markdown converter, compiled schema and index
+    loaded, so a long-running process can use one for many builds.
+    """
+
+    def __init__(self, config, include_future=False):
+        self.config = config
+        self.include_future = include_future
+        self.jobs = get_jobs(config)
+        self.arch = LocalArchivist(config)
+        self.store = open_store(self.arch.indexdir, index_backend(config))
+        self.schema = Schematist(config)
+        self.embeds = embed_cache(config)
+        self.arch.embeds = self.embeds
+        self.mdcache = markdown_cache(config)
+        self.highlights = HighlightCache(self.mdcache)
+        self.converter = new_converter(config, self.embeds, self.highlights)
+        self.logger = getLogger()
+        self.until = None
+        self._index = (None, None)
+
+    def scope_index(self):
+        """Fix the time Items must be published by to show on the site, for
+        the rest of this build. Future Items are indexed all the same, and
+        show once their time comes."""
+        self.until = None if self.include_future else time.time()
+        self.arch.index_view = self.store.view_version(self.until)
+
+    def load_index(self):
+        """The index for Catalogs, reloaded only when what it shows
+        changed."""
+        version = self.store.view_version(self.until)
+        if self._index[0] != version:
+            self._index = (version, self.store.as_dict(self.until))
+        return self._index[1]
+
+    def build(self):
+        """Scan the source and build trees and bring everything up to date.
+        Returns the archetypes that failed to render."""
+        arch = self.arch
+        # 1. cp any files from srcdir needing update to root
+        with profile.span("gather", "stage"):
+            arch.scan()
+            arch.gather_sources()
+        self._log_copied()
+        self._log_removed(arch.prune_sources())
+        # 2. find root sources needing JSON; md2json them. Embeds already
+        # converted are refreshed first, so new responses are picked up.
+        self.refresh_embeds()
+        self.convert(arch.sources_needing_update())
+        # 3. find json files needing indexing; index them
+        if not arch.index_is_current():
+            self.store.clear()
+        removed = arch.prune_archetypes()
+        self.index(arch.archetypes_needing_indexing(), removed)
+        self.scope_index()
+        # 4. find any json files needing outputs
+        failed = self.render(arch.archetypes_needing_render())
+        # 5. write the sitemap and feeds, if the index changed
+        self.syndicate()
+        # 6. optionally, precompress text files that changed
+        self.precompress()
+        return failed
+
+    def build_from(self, other):
+        """Like build, but take the archetypes and index from `other`, a
+        Builder for the same sources and conversion settings (see
+        conversion_settings) that has just built. Only gathering and
+        rendering happen here. Returns the archetypes that failed to
+        render."""
+        arch = self.arch
+        # Embed digests must agree with those other recorded
+        arch.embeds = other.embeds
+        with profile.span("gather", "stage"):
+            arch.scan()
+            arch.gather_sources()
+            self._log_copied()
+            self._log_removed(arch.prune_sources())
+            copied = arch.gather_products(other.arch)
+            removed = arch.prune_archetypes()
+            indexfiles = arch.gather_index(other.arch, other.store.files())
+            arch.mark_indexed(arch.archetypes_needing_indexing(), removed,
+                              indexfiles)
+            arch.commit()
+        self.logger.info("Took %d archetypes and the index from %s" % (
+            len(copied), other.arch.root))
+        # The copied index replaced whatever the store had loaded
+        self.store = open_store(arch.indexdir, index_backend(self.config))
+        self._index = (None, None)
+        self.scope_index()
+        failed = self.render(arch.archetypes_needing_render())
+        self.syndicate()
+        self.precompress()
+        return failed
+
+    def update(self, sources=(), templates=()):
+        """Bring the build up to date after changes to the given source
+        files and templates (names relative to the template dir), without
+        scanning the trees. Returns the archetypes that failed to render."""
+        arch = self.arch
+        if templates:
+            j2.forget_templates()
+            arch.forget_templates()
+        for src in sources:
+            arch.sources.update(src)
+        with profile.span("gather", "stage"):
+            copied = arch.gather_sources(sources)
+        self._log_copied()
+        removed = []
+        if any(not Path(src).exists() for src in sources):
+            self._log_removed(arch.prune_sources())
+            removed = arch.prune_archetypes()
+
+        converted = self.convert(arch.sources_needing_update(
+            [path for path in copied if path.suffix == ".md"]))
+        changed = converted + [path for path in copied
+                               if path.suffix == ".json"]
+        view = arch.index_view
+        self.index(arch.archetypes_needing_indexing(changed), removed)
+        self.scope_index()
+
+        candidates = list(changed)
+        if arch.index_view != view:
+            candidates += arch.dependents("index")
+        for name in templates:
+            candidates += arch.dependents("template:" + name)
+        if templates:
+            candidates += arch.dependents("templates")
+        candidates = sorted(set(candidates))
+        failed = self.render(arch.archetypes_needing_render(candidates))
+        self.syndicate()
+        self.precompress()
+        return failed
+
+    def _log_copied(self):
+        profile.count("files copied", self.arch.copier.stats["copied"])
+        profile.count("files linked", self.arch.copier.stats["linked"])
+        profile.count("files skipped", self.arch.copier.stats["skipped"])
+        self.logger.info(
+            "Copied %(copied)d files (%(copied_bytes)d bytes) and linked "
+            "%(linked)d; skipped %(skipped)d unchanged (%(skipped_bytes)d "
+            "bytes)" % self.arch.copier.stats)
+
+    def _log_removed(self, paths):
+        for path in paths:
+            self.logger.info("Removing %s" % path)
+
+    @profile.spanned("convert", "stage")
+    def convert(self, sources):
+        """Convert markdown sources. Returns the archetypes written."""
+        arch = self.arch
+        sources = list(sources)
+        found = self.prefetch_embeds(sources)
+        self.highlights.reset()
+        written = []
+        cached = {True: 0, False: 0, None: 0}
+        highlighted = [0, 0, 0.0]
+        start = time.perf_counter()
+        for result in convert_sources(self.config, sources, jobs=self.jobs,
+                                      schema=self.schema,
+                                      converter=self.converter,
+                                      cache=self.mdcache,
+                                      embeds=self.embeds,
+                                      highlights=self.highlights):
+            self.logger.info("Updating source: %s" % result.source)
+            cached[result.cached] += 1
+            if result.highlights:
+                highlighted = [a + b for a, b in zip(highlighted,
+                                                     result.highlights)]
+            if result.error:
+                description, message, path = result.error
+                self.logger.info(description)
+                self.logger.error("%s: %s at %s" % (result.source, message,
+                                                    path))
+                self.logger.debug(result.archetype)
+                continue
+            arch.write_json(result.target, result.archetype)
+            arch.mark_converted(result.source, result.target,
+                                found.get(result.source, ()))
+            written.append(result.target)
+        elapsed = time.perf_counter() - start
+        arch.commit()
+        blocks, hits, saved = highlighted
+        profile.count("sources converted", len(sources))
+        profile.count("markdown cache hits", cached[True])
+        profile.count("code blocks highlighted", blocks - hits)
+        profile.count("code blocks cached", hits)
+        if blocks:
+            # Share of the time conversion would have taken without the cache
+            self.logger.info(
+                "Highlighting: %d code blocks, %d from cache, saving %.2fs "
+                "(%.0f%% of conversion time)" % (
+                    blocks, hits, saved, 100 * saved / (elapsed + saved)))
+        if cached[True] or cached[False]:
+            self.logger.info("Markdown cache: %d hits, %d misses" % (
+                cached[True], cached[False]))
+        if cached[False]:
+            evicted = self.mdcache.prune()
+            if evicted:
+                self.logger.info("Markdown cache: evicted %d entries" %
+                                 evicted)
+        return written
+
+    def prefetch_embeds(self, sources) -> dict:
+        """Resolve the oEmbed lookups of the sources about to be converted,
+        so conversion never waits on the network. Returns the embeds found
+        in each source that has any."""
+        found = {}
+        for src in sources:
+            embeds = find_embeds(src.read_text(encoding=UTF8))
+            if embeds:
+                found[src] = embeds
+        self._prefetch([embed for embeds in found.values()
+                        for embed in embeds])
+        return found
+
+    def refresh_embeds(self):
+        """Look up again the embeds of converted sources that are expired
+        or were never resolved. Sources whose responses change as a result
+        need converting again."""
+        self._prefetch(self.arch.converted_embeds())
+
+    def _prefetch(self, embeds):
+        if not embeds:
+            return
+        for url, error in self.embeds.prefetch(embeds):
+            self.logger.warning("Embed %s not resolved (%s), linking to it "
+                                "instead" % (url, error))
+        self.logger.info("Embeds: %(cached)d cached, %(fetched)d fetched, "
+                         "%(failed)d failed" % self.embeds.stats)
+
+    @profile.spanned("index", "stage")
+    def index(self, archetypes, removed=()):
+        """Index archetypes and drop the `removed` archetype keys."""
+        arch = self.arch
+        for file in archetypes:
+            self.logger.info("Indexing %s" % file)
+        delta = index_archetypes(archetypes, jobs=self.jobs)
+        for key in removed:
+            self.logger.info("Removing %s from index" % key)
+            delta.delete("/" + key)
+        profile.count("archetypes indexed", len(archetypes))
+        self.store.apply(delta)
+        self.store.save()
+        arch.mark_indexed(archetypes, removed, self.store.files())
+        arch.commit()
+
+    @profile.spanned("feeds", "stage")
+    def syndicate(self):
+        """Write the sitemap and feeds asked for in the "feeds" section of
+        the config, unless the index and config are as they were when they
+        were last written."""
+        arch = self.arch
+        if not self.config.get("feeds"):
+            self._log_removed(arch.mark_syndicated(None, []))
+            arch.commit()
+            return
+        if not self.config.get("site", {}).get("base"):
+            self.logger.error("Sitemap and feeds need an absolute site base "
+                              "URL, base under site in webquills.yml")
+            return
+        version = arch.index_view
+        if arch.feeds_are_current(version):
+            return
+        results = write_feeds(self.config, self.store,
+                              digest=arch.manifest.digest, until=self.until)
+        for path, _, written in results:
+            if written:
+                self.logger.info("Writing %s" % path)
+        self._log_removed(arch.mark_syndicated(version, results))
+        arch.commit()
+
+    @profile.spanned("compress", "stage")
+    def precompress(self):
+        """Write .gz (and, with brotli installed, .br) siblings of changed
+        text files, if the "precompress" option is set."""
+        if not self.config["options"].get("precompress"):
+            return
+        arch = self.arch
+        self._log_removed(arch.prune_compressed())
+        encodings = precompress.available_encodings()
+        paths = arch.files_needing_compression(precompress.SUFFIXES)
+        # zlib and brotli release the GIL, so threads use every core
+        with ThreadPoolExecutor(os.cpu_count()) as pool:
+            jobs = [(path, pool.submit(precompress.precompress, path,
+                                       encodings)) for path in paths]
+            profile.count("files compressed", len(paths))
+            for path, job in jobs:
+                self.logger.info("Compressing %s" % path)
+                arch.mark_compressed(path, job.result())
+        arch.commit()
+
+    @profile.spanned("render", "stage")
+    def render(self, archetypes):
+        """Render archetypes. Returns those that failed."""
+        arch = self.arch
+        failed = []
+        queries = dict.fromkeys(query.stats, 0)
+        kept = 0
+        # Worker processes share one copy of the index, if any need it
+        share = self.jobs > 1 and arch.may_use_index(archetypes)
+        for result in render_archetypes(self.config, archetypes,
+                                        arch.indexdir, jobs=self.jobs,
+                                        load_index=self.load_index,
+                                        rendered_pages=arch.rendered_pages,
+                                        until=self.until, share_index=share):
+            self.logger.info("Rendering %s" % result.source)
+            if result.error:
+                self.logger.error("%s: %s" % (result.source, result.error))
+                failed.append(result.source)
+                continue
+            if result.outputs is None:
+                self.logger.warning("Skipping non-Item JSON file: %s" %
+                                    result.source)
+                arch.mark_rendered(result.source, [])
+                continue
+            for key, count in result.queries.items():
+                queries[key] += count
+            for target, text in result.outputs:
+                if text is None:
+                    kept += 1
+                else:
+                    arch.write_text(target, text)
+            arch.mark_rendered(result.source,
+                               [target for target, _ in result.outputs],
+                               templates=result.templates,
+                               uses_index=result.uses_index,
+                               pages=result.pages)
+        arch.commit()
+        profile.count("archetypes rendered", len(archetypes) - len(failed))
+        profile.count("catalog pages kept", kept)
+        profile.count("query cache hits", queries["hits"])
+        self.logger.info("Query cache: %(hits)d hits, %(misses)d misses, "
+                         "%(compiled)d expressions compiled, %(pushed)d "
+                         "pushed down to the index" % queries)
+        if kept:
+            self.logger.info("Kept %d unchanged Catalog pages" % kept)
+        if failed:
+            self.logger.error("%d files failed to render" % len(failed))
+        return failed
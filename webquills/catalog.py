@@ -0,0 +1,102 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Paginated Catalogs.
+
+A Catalog with a `page_size` lists the results of its queries, one query
+after another, over as many pages as it takes: index.html, then page/2.html
+and so on beside it (or, for a Catalog named e.g. archive.json, under
+archive/page/). Each page's template finds its share of the listing, as
+`Pagination.Items`, and links to its neighbours. Only the html output is
+paginated; other outputs, such as feeds, are rendered once with the first
+page in `Pagination`.
+
+Pages are taken from the query results with `query.search_slice`, so the
+first page of a large listing is picked with a heap (or by the index
+store) instead of sorting everything. Each html page comes with a digest of
+what it lists, so a page whose slice did not change is not rendered again.
+Templates for those pages should therefore list `Pagination.Items` rather
+than query the `Index` themselves.
+"""
+import json
+
+import webquills.query as query
+from webquills.manifest import digest_bytes, digest_parts
+from webquills.util import SmartJSONEncoder
+
+# Output formats rendered for every page, not just the first
+PAGED_EXTENSIONS = ("html",)
+
+
+def page_size(archetype) -> int:
+    """Items per page for a Catalog archetype, or 0 if not paginated."""
+    return int(archetype.get("Catalog", {}).get("page_size") or 0)
+
+
+def page_path(src, number, extension):
+    """Where page `number` of the Catalog archetype `src` is written."""
+    if number == 1:
+        return src.with_suffix("." + extension)
+    base = src.parent if src.stem == "index" else src.parent / src.stem
+    return base / "page" / ("%d.%s" % (number, extension))
+
+
+def listing_size(queries, items) -> int:
+    return sum(query.count(expression, items) for expression in queries)
+
+
+def listing_slice(queries, items, start, stop) -> list:
+    """Items start:stop of the results of `queries`, one after another."""
+    found = []
+    offset = 0
+    for expression in queries:
+        if offset >= stop:
+            break
+        total = query.count(expression, items)
+        if start < offset + total:
+            found += query.search_slice(expression, items,
+                                        max(0, start - offset), stop - offset)
+        offset += total
+    return found
+
+
+def paginate(archetype, src, root, index, extension):
+    """Yield (path, digest, Pagination) for each page of a Catalog's output
+    with `extension`. The digest covers everything the page shows from the
+    index. `root` is the build root, for making hrefs."""
+    queries = archetype.get("Catalog", {}).get("queries", [])
+    size = page_size(archetype)
+    items = index["Items"]
+    total = listing_size(queries, items)
+    count = max(1, -(-total // size))  # ceiling division
+    if extension not in PAGED_EXTENSIONS:
+        count = 1
+
+    def href(number):
+        if number < 1 or number > count:
+            return None
+        return "/" + str(page_path(src, number, extension).relative_to(root))
+
+    for number in range(1, count + 1):
+        start = (number - 1) * size
+        shown = listing_slice(queries, items, start, start + size)
+        digest = digest_parts(number, count, total, digest_bytes(json.dumps(
+            shown, cls=SmartJSONEncoder, sort_keys=True).encode("utf-8")))
+        yield page_path(src, number, extension), digest, {
+            "number": number, "count": count, "size": size, "total": total,
+            "Items": shown, "href": href(number),
+            "previous": href(number - 1), "next": href(number + 1)}
@@ -0,0 +1,102 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Layered, read-only render contexts.
+
+A RenderContext stacks the item being rendered on top of the shared config
+(and, for Catalogs, the shared index) without copying any of them. Values
+read from it are wrapped in read-only views, so a template cannot change
+what the next render sees.
+"""
+from collections import ChainMap
+from collections.abc import Mapping, Sequence
+
+
+def freeze(value):
+    """Wrap dicts and lists in read-only views. Other values pass through."""
+    if isinstance(value, dict):
+        return FrozenDict(value)
+    elif isinstance(value, (list, tuple)):
+        return FrozenList(value)
+    return value
+
+
+def thaw(value):
+    """Return the object underneath a read-only view. Only for code that
+    needs real dicts and lists (e.g. JMESPath) and promises not to mutate."""
+    if isinstance(value, (FrozenDict, FrozenList)):
+        return value._data
+    return value
+
+
+class FrozenDict(Mapping):
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return freeze(self._data[key])
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return "FrozenDict(%r)" % (self._data,)
+
+
+class FrozenList(Sequence):
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return FrozenList(self._data[index])
+        return freeze(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, FrozenList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return "FrozenList(%r)" % (self._data,)
+
+
+class RenderContext(ChainMap):
+    """
+    Context for one render: a private, writable top layer over any number of
+    shared layers, most specific first. Assignments only ever land in the
+    top layer. Everything read back is a read-only view.
+    """
+
+    def __init__(self, *layers):
+        super(RenderContext, self).__init__({}, *layers)
+
+    def __getitem__(self, key):
+        return freeze(super(RenderContext, self).__getitem__(key))
@@ -0,0 +1,213 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Copy a tree of files, fast.
+
+The source tree is walked once with os.scandir, and a file is only copied if
+its size or modification time differs from the copy already in place (or,
+with `checksum`, its content). Copies keep the source's modification time,
+so an unchanged file is recognized from a single stat.
+
+Copies are made in a thread pool, by the kernel where the platform allows
+(copy_file_range, which can also copy server-side on network filesystems).
+In "hardlink" or "reflink" mode an unchanged asset costs no extra bytes at
+all; where links are not possible (e.g. across filesystems) the engine
+quietly falls back to copying.
+"""
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+MODES = ("copy", "hardlink", "reflink")
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# Errors meaning "this filesystem can't do that", not "something is wrong"
+_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EPERM,
+                errno.EOPNOTSUPP, errno.ENOTTY, errno.EMLINK}
+
+
+def scan(directory, skip=None):
+    """Walk a tree with os.scandir. Yields (path relative to `directory`,
+    DirEntry) for every file and directory below it. `skip` is a function
+    of a DirEntry; matching directories are not entered."""
+    pending = [("", str(directory))]
+    while pending:
+        prefix, path = pending.pop()
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if skip and skip(entry):
+                continue
+            relpath = prefix + entry.name
+            yield relpath, entry
+            if entry.is_dir(follow_symlinks=False):
+                pending.append((relpath + os.sep, entry.path))
+
+
+def _copy_data(src, dest):
+    """Copy file content, in the kernel if possible."""
+    copy_range = getattr(os, "copy_file_range", None)
+    if copy_range is not None:
+        with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+            try:
+                size = os.fstat(fsrc.fileno()).st_size
+                while size > 0:
+                    sent = copy_range(fsrc.fileno(), fdest.fileno(),
+                                      min(size, 1 << 30))
+                    if sent == 0:
+                        break
+                    size -= sent
+                return
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+    # shutil uses sendfile where it can
+    shutil.copyfile(src, dest)
+
+
+def _reflink(src, dest):
+    import fcntl  # Unix only
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+
+
+class CopyEngine(object):
+    """
+    Mirrors files from one tree into another. `mode` is one of "copy",
+    "hardlink" or "reflink". With `checksum`, files whose size matches are
+    compared by `digest` (a function of a path) rather than by mtime.
+    """
+
+    def __init__(self, mode="copy", threads=8, checksum=False, digest=None):
+        if mode not in MODES:
+            raise ValueError("Unknown copy mode %r, expected one of %s" % (
+                mode, ", ".join(MODES)))
+        self.mode = mode
+        self.threads = threads
+        self.checksum = checksum
+        self.digest = digest
+        self.stats = {}
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats.update(copied=0, copied_bytes=0, linked=0, skipped=0,
+                          skipped_bytes=0)
+
+    def unchanged(self, src, src_stat, dest, dest_stat) -> bool:
+        if dest_stat is None or src_stat.st_size != dest_stat.st_size:
+            return False
+        if os.path.samestat(src_stat, dest_stat):  # hard linked
+            return True
+        if self.checksum:
+            return self.digest(src) == self.digest(dest)
+        return src_stat.st_mtime_ns == dest_stat.st_mtime_ns
+
+    def copy(self, src, dest) -> bool:
+        """Copy one file, replacing `dest` atomically. Returns True if a
+        link was made rather than a copy."""
+        tmp = os.path.join(os.path.dirname(dest), ".%s.%d.tmp" % (
+            os.path.basename(dest), threading.get_ident()))
+        linked = False
+        try:
+            if self.mode == "hardlink":
+                try:
+                    os.link(src, tmp)
+                    linked = True
+                except OSError as e:
+                    if e.errno not in _UNSUPPORTED:
+                        raise
+            elif self.mode == "reflink":
+                try:
+                    _reflink(src, tmp)
+                    linked = True
+                except (ImportError, OSError) as e:
+                    if getattr(e, "errno", errno.ENOSYS) not in _UNSUPPORTED:
+                        raise
+            if not linked:
+                _copy_data(src, tmp)
+            if self.mode != "hardlink" or not linked:
+                shutil.copystat(src, tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return linked
+
+    def sync(self, files, stat=os.stat):
+        """Bring destinations up to date. `files` holds (src, dest, stat)
+        triples, where stat is the source's os.stat_result if already known,
+        or None. Destinations are checked with `stat`, e.g. a snapshot's.
+        Missing sources are ignored. Returns a (dest, stat, written)
+        triple for each file, in order. Counts of files and bytes copied and
+        skipped accumulate in `stats`."""
+        results = []
+        work = []
+        made = set()
+        for src, dest, src_stat in files:
+            try:
+                src_stat = src_stat or os.stat(src)
+            except FileNotFoundError:
+                continue
+            try:
+                dest_stat = stat(dest)
+            except FileNotFoundError:
+                dest_stat = None
+            if self.unchanged(src, src_stat, dest, dest_stat):
+                self.stats["skipped"] += 1
+                self.stats["skipped_bytes"] += src_stat.st_size
+                results.append((Path(dest), src_stat, False))
+                continue
+            parent = os.path.dirname(dest)
+            if parent not in made:
+                os.makedirs(parent, exist_ok=True)
+                made.add(parent)
+            results.append((Path(dest), src_stat, True))
+            work.append((src, dest, src_stat.st_size))
+
+        with ThreadPoolExecutor(self.threads) as pool:
+            jobs = [(size, pool.submit(self.copy, src, dest))
+                    for src, dest, size in work]
+            for size, job in jobs:
+                if job.result():
+                    self.stats["linked"] += 1
+                else:
+                    self.stats["copied"] += 1
+                    self.stats["copied_bytes"] += size
+        return results
+
+    def mirror(self, srcdir, destdir):
+        """Sync every file under `srcdir` into `destdir`, creating any empty
+        directories too. Returns what `sync` does."""
+        srcdir, destdir = str(srcdir), str(destdir)
+        files = []
+        for relpath, entry in scan(srcdir):
+            dest = os.path.join(destdir, relpath)
+            if entry.is_dir():
+                os.makedirs(dest, exist_ok=True)
+            else:
+                files.append((entry.path, dest, entry.stat()))
+        return self.sync(files)
@@ -0,0 +1,224 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+oEmbed lookups for ``[!embed](url)`` in Markdown, resolved ahead of time.
+
+The pyembed extension fetches each embed over HTTP in the middle of
+converting a document, and again on every build. Instead, the sources about
+to be converted are scanned for embeds first, the ones not already cached are
+fetched concurrently, and conversion only ever reads the cache.
+
+Cached responses are JSON files, one per URL and size, and are fetched again
+once older than the TTL. Offline, nothing is fetched: responses come from a
+fixture directory (which holds files laid out like the cache, so a cache
+directory can be copied there) or from the cache whatever their age. An
+embed that can't be resolved becomes a plain link to its URL.
+"""
+import json
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html import escape
+from pathlib import Path
+from types import SimpleNamespace
+from urllib.parse import parse_qs
+
+from markdown.extensions import Extension
+from pyembed.core import consumer
+from pyembed.core.discovery import DefaultDiscoverer
+from pyembed.core.error import PyEmbedError
+from pyembed.core.render import DefaultRenderer
+from pyembed.markdown.pattern import REMBED_PATTERN, PyEmbedPattern
+
+from webquills.manifest import digest_parts
+
+DEFAULT_TTL = 30  # days
+
+_embed_re = re.compile(REMBED_PATTERN)
+_discoverer = None
+
+
+def embed_cache(config):
+    """The EmbedCache the config asks for: options "embed-dir" (by default,
+    under the build root), "embed-ttl" in days, "embed-fixtures" and
+    "offline"."""
+    options = config["options"]
+    directory = options.get("embed-dir") or \
+        Path(options["root"]) / ".webquills" / "embeds"
+    ttl = float(options.get("embed-ttl") or DEFAULT_TTL)
+    offline = options.get("offline") in (True, "true", "yes", "1")
+    return EmbedCache(directory, ttl=ttl * 86400, offline=offline,
+                      fixtures=options.get("embed-fixtures"))
+
+
+def find_embeds(text) -> list:
+    """(url, max_width, max_height) for each embed in Markdown `text`, in
+    order, parsed as the pyembed extension parses them."""
+    embeds = []
+    for m in _embed_re.finditer(text):
+        params = parse_qs(m.group(2) or "")
+        size = [int(params[name][0]) if name in params else None
+                for name in ("max_width", "max_height")]
+        embeds.append((m.group(3), size[0], size[1]))
+    return embeds
+
+
+def fetch_oembed(url, max_width=None, max_height=None) -> dict:
+    """Look up the oEmbed response for `url`, as a dict."""
+    global _discoverer
+    if _discoverer is None:
+        _discoverer = DefaultDiscoverer()
+    try:
+        response = consumer.get_first_oembed_response(
+            _discoverer.get_oembed_urls(url), max_width=max_width,
+            max_height=max_height)
+    except Exception as e:  # requests raises many things
+        raise PyEmbedError(e)
+    return dict(response.__dict__)
+
+
+class EmbedCache(object):
+    """
+    oEmbed responses by URL and size, kept in `directory`. `fetch` is a
+    function of (url, max_width, max_height) returning the response as a
+    dict. Only `prefetch` ever calls it.
+    """
+
+    def __init__(self, directory, ttl=DEFAULT_TTL * 86400, offline=False,
+                 fixtures=None, fetch=fetch_oembed, threads=8):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.offline = offline
+        self.fixtures = Path(fixtures) if fixtures else None
+        self.fetch = fetch
+        self.threads = threads
+        self.stats = {}
+
+    def key(self, url, max_width=None, max_height=None) -> str:
+        return digest_parts(url, max_width, max_height)
+
+    def path(self, key) -> Path:
+        return self.directory / (key + ".json")
+
+    def _read(self, path):
+        try:
+            return json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+
+    def lookup(self, key, stale=False):
+        """The stored entry for `key`: from the fixtures, else from the
+        cache if it is fresh (or `stale` is allowed). Otherwise None."""
+        if self.fixtures is not None:
+            entry = self._read(self.fixtures / (key + ".json"))
+            if entry is not None:
+                return entry
+        entry = self._read(self.path(key))
+        if entry is None:
+            return None
+        if stale or self.offline or \
+                time.time() - entry.get("fetched", 0) < self.ttl:
+            return entry
+        return None
+
+    def _store(self, key, url, response):
+        entry = {"url": url, "fetched": int(time.time()),
+                 "response": response}
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(".%s.%d.tmp" % (path.name, os.getpid()))
+        try:
+            tmp.write_text(json.dumps(entry, sort_keys=True),
+                           encoding="utf-8")
+            os.replace(str(tmp), str(path))
+        except OSError:
+            if tmp.exists():
+                tmp.unlink()
+        return entry
+
+    def _resolve(self, embed):
+        """Fetch and store one embed. Returns an error message, or None."""
+        try:
+            response = self.fetch(*embed)
+        except PyEmbedError as e:
+            return str(e) or "lookup failed"
+        self._store(self.key(*embed), embed[0], response)
+        return None
+
+    def prefetch(self, embeds):
+        """Make sure every (url, max_width, max_height) in `embeds` is in
+        the cache, fetching what is missing or expired concurrently. Returns
+        a list of (url, error) for the embeds that could not be resolved.
+        Counts of embeds found cached, fetched and failed are in `stats`."""
+        self.stats.update(cached=0, fetched=0, failed=0)
+        failed = []
+        missing = []
+        for embed in dict.fromkeys(embeds):
+            if self.lookup(self.key(*embed)) is not None:
+                self.stats["cached"] += 1
+            elif self.offline:
+                failed.append((embed[0], "not cached, and offline"))
+            else:
+                missing.append(embed)
+        if missing:
+            with ThreadPoolExecutor(min(self.threads, len(missing))) as pool:
+                for embed, error in zip(missing,
+                                        pool.map(self._resolve, missing)):
+                    if error is None:
+                        self.stats["fetched"] += 1
+                    elif self.lookup(self.key(*embed), stale=True):
+                        self.stats["cached"] += 1  # serve the stale copy
+                    else:
+                        failed.append((embed[0], error))
+        self.stats["failed"] = len(failed)
+        return failed
+
+    def embed(self, url, max_width=None, max_height=None) -> str:
+        """HTML for an embed, as pyembed would render it. Never fetches."""
+        entry = self.lookup(self.key(url, max_width, max_height), stale=True)
+        if entry is None:
+            return '<a href="%s">%s</a>' % (escape(url), escape(url))
+        return DefaultRenderer().render(
+            url, SimpleNamespace(**entry["response"]))
+
+    def digest(self, text) -> str:
+        """Digest of the responses the embeds in `text` would render, so
+        cached conversions of it go stale when they change."""
+        return self.digest_embeds(find_embeds(text))
+
+    def digest_embeds(self, embeds) -> str:
+        """Digest of the responses for a list of (url, max_width,
+        max_height), None for those not resolved."""
+        parts = []
+        for embed in embeds:
+            entry = self.lookup(self.key(*embed), stale=True)
+            parts.append(entry and entry["response"])
+        return digest_parts(json.dumps(parts, sort_keys=True))
+
+
+class EmbedExtension(Extension):
+    """Stands in for the pyembed Markdown extension, rendering embeds from
+    an EmbedCache."""
+
+    def __init__(self, embeds):
+        super(EmbedExtension, self).__init__()
+        self.embeds = embeds
+
+    def extendMarkdown(self, md, md_globals):
+        md.inlinePatterns.add(
+            'pyembed', PyEmbedPattern(self.embeds, md), '_begin')
@@ -0,0 +1,360 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Sitemaps and feeds, written straight from the index.
+
+Rendering a feed from a template puts the whole Index in its context. These
+are written a piece at a time instead, in date order, without templates:
+
+* The sitemap lists the page of every Item, newest first, using only the
+  href and date each Item has in the index catalog, so no Items are loaded.
+  Past 50,000 URLs or 50MB, the protocol's limits, it is split into
+  sitemap-1.xml, sitemap-2.xml and so on, and sitemap.xml becomes the
+  sitemap index listing them.
+* The Atom and JSON feeds load only the newest Items they show.
+
+Each file is written under a temporary name and only replaces the old one
+if its content changed. They are set up in the "feeds" section of the
+config, and need "base" in the "site" section for absolute URLs.
+"""
+import functools
+import hashlib
+import itertools
+import json
+import os
+import posixpath
+import re
+import time
+import urllib.parse as uri
+from pathlib import Path
+from xml.sax.saxutils import escape, quoteattr
+
+UTF8 = "utf-8"
+
+# Sitemap protocol limits, per file
+SITEMAP_URLS = 50000
+SITEMAP_BYTES = 50 * 1024 * 1024
+# Entries in a feed, unless the config says otherwise
+FEED_SIZE = 20
+# Sitemap URLs formatted at once; SITEMAP_URLS should be a multiple of it
+SITEMAP_BATCH = 1000
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SITEMAP_NS = "http://www.sitemaps.org/schemas/sitemap/0.9"
+URLSET_START = XML_DECLARATION + '<urlset xmlns="%s">\n' % SITEMAP_NS
+URLSET_END = "</urlset>\n"
+URL = "<url><loc>%s</loc><lastmod>%s</lastmod></url>\n"
+JSON_FEED_VERSION = "https://jsonfeed.org/version/1.1"
+
+
+class StreamedFile(object):
+    """
+    A file written a piece at a time under a temporary name. On `close` it
+    replaces `path` (which may be changed until then), unless that already
+    has the same content, according to `digest`, a function of a path
+    returning the SHA-1 hex digest of the file or None.
+    """
+
+    buffer_size = 1 << 16
+
+    def __init__(self, path: Path, digest=None):
+        self.path = Path(path)
+        self.digest = digest
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = self.path.with_name(".%s.%d.tmp" % (self.path.name,
+                                                       os.getpid()))
+        self.file = open(str(self.tmp), "wb")
+        self.hash = hashlib.sha1()
+        self.size = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def write(self, data: bytes):
+        self._pending.append(data)
+        self._pending_size += len(data)
+        self.size += len(data)
+        if self._pending_size >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        chunk = b"".join(self._pending)
+        self.hash.update(chunk)
+        self.file.write(chunk)
+        self._pending = []
+        self._pending_size = 0
+
+    def close(self):
+        """Put the file in place. Returns (path, digest, written)."""
+        self._flush()
+        self.file.close()
+        digest = self.hash.hexdigest()
+        if self.digest is not None and self.digest(self.path) == digest:
+            os.unlink(str(self.tmp))
+            return self.path, digest, False
+        os.replace(str(self.tmp), str(self.path))
+        return self.path, digest, True
+
+    def abort(self):
+        self.file.close()
+        if self.tmp.exists():
+            self.tmp.unlink()
+
+
+# Paths that need no percent-encoding, the usual case
+_plain_path = re.compile(r"[A-Za-z0-9/._~-]*\Z").match
+
+
+@functools.lru_cache()
+def _origin(base) -> str:
+    return uri.urljoin(base, "/")[:-1]
+
+
+def page_url(base, href) -> str:
+    """Absolute URL of the html page rendered from the archetype `href`."""
+    # Archetype hrefs are absolute paths, so this is what urljoin would
+    # make of them, without its cost for every Item of a large site.
+    if href.endswith(".json"):
+        page = href[:-5] + ".html"
+    else:
+        page = posixpath.splitext(href)[0] + ".html"
+    if not _plain_path(page):
+        page = uri.quote(page)
+    return _origin(base) + page
+
+
+def w3c_time(seconds) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+
+def sitemap_part(path: Path, number) -> Path:
+    """Where part `number` of a split sitemap is written."""
+    return path.with_name("%s-%d%s" % (path.stem, number, path.suffix))
+
+
+def write_sitemap(store, base, path: Path, url, digest=None,
+                  max_urls=SITEMAP_URLS, max_bytes=SITEMAP_BYTES,
+                  until=None) -> list:
+    """Write the sitemap of every Item in `store`, an IndexStore or
+    SqliteIndexStore, published at or before `until`, to `path`, whose URL
+    is `url`, split into parts if need be. Returns (path, digest, written)
+    for each file."""
+    start = URLSET_START.encode(UTF8)
+    end = URLSET_END.encode(UTF8)
+    # page_url percent-encodes paths, so only the base could need escaping
+    plain = escape(base) == base
+    parts = []  # (StreamedFile, time of its newest URL)
+    current = None
+    count = 0
+
+    def new_part(when):
+        part = StreamedFile(sitemap_part(path, len(parts) + 1), digest)
+        part.write(start)
+        parts.append((part, when))
+        return part
+
+    rows = iter(store.hrefs(until=until))
+    try:
+        while True:
+            # URLs are formatted a batch at a time, and the batch written
+            # whole unless it would take the part over a limit
+            batch = list(itertools.islice(rows, SITEMAP_BATCH))
+            if not batch:
+                break
+            locs = [page_url(base, href) for href, _ in batch]
+            if not plain:
+                locs = [escape(loc) for loc in locs]
+            entries = [URL % (loc, w3c_time(when))
+                       for loc, (_, when) in zip(locs, batch)]
+            data = "".join(entries).encode(UTF8)
+            if current is not None and count + len(batch) <= max_urls and \
+                    current.size + len(data) + len(end) <= max_bytes:
+                current.write(data)
+                count += len(batch)
+                continue
+            for entry, (_, when) in zip(entries, batch):
+                entry = entry.encode(UTF8)
+                if current is None or count == max_urls or \
+                        current.size + len(entry) + len(end) > max_bytes:
+                    if current is not None:
+                        current.write(end)
+                    current = new_part(when)
+                    count = 0
+                current.write(entry)
+                count += 1
+        if current is None:  # nothing indexed yet
+            current = new_part(None)
+        current.write(end)
+    except BaseException:
+        for part, _ in parts:
+            part.abort()
+        raise
+
+    if len(parts) == 1:
+        parts[0][0].path = path
+        return [parts[0][0].close()]
+    results = [part.close() for part, _ in parts]
+    index = StreamedFile(path, digest)
+    header = '<sitemapindex xmlns="%s">\n' % SITEMAP_NS
+    index.write((XML_DECLARATION + header).encode(UTF8))
+    for part, when in parts:
+        loc = uri.urljoin(url, uri.quote(part.path.name))
+        index.write(("<sitemap><loc>%s</loc><lastmod>%s</lastmod>"
+                     "</sitemap>\n" % (escape(loc), w3c_time(when))
+                     ).encode(UTF8))
+    index.write(b"</sitemapindex>\n")
+    return [index.close()] + results
+
+
+def authors(attributions) -> list:
+    return [person["name"] for person in attributions or ()
+            if person.get("role") == "author" and person.get("name")]
+
+
+def newest_items(store, size, until=None):
+    for guid in store.newest(size, until=until):
+        yield store.item(guid)
+
+
+def write_atom(store, site, path: Path, url, size=FEED_SIZE,
+               digest=None, until=None) -> tuple:
+    """Write an Atom feed of the newest `size` Items in `store` published
+    at or before `until` to `path`, whose URL is `url`. `site` is the
+    "site" section of the config. Returns (path, digest, written)."""
+    base = site.get("base", "")
+    items = newest_items(store, size, until)
+    first = next(items, None)
+    if first is None:
+        updated = w3c_time(0)
+    else:
+        updated = first.get("updated") or first["published"]
+        items = itertools.chain([first], items)
+    out = StreamedFile(path, digest)
+    try:
+        head = [XML_DECLARATION,
+                '<feed xmlns="http://www.w3.org/2005/Atom">\n',
+                "<id>%s</id>\n" % escape(url),
+                "<title>%s</title>\n" % escape(site.get("title", "")),
+                "<updated>%s</updated>\n" % escape(updated),
+                "<link rel=\"self\" href=%s/>\n" % quoteattr(url),
+                "<link rel=\"alternate\" href=%s/>\n" % quoteattr(base)]
+        if site.get("description"):
+            head.append("<subtitle>%s</subtitle>\n" % escape(
+                site["description"]))
+        head.extend("<author><name>%s</name></author>\n" % escape(name)
+                    for name in authors(site.get("attributions")))
+        out.write("".join(head).encode(UTF8))
+        for item in items:
+            out.write(_atom_entry(item, base).encode(UTF8))
+        out.write(b"</feed>\n")
+    except BaseException:
+        out.abort()
+        raise
+    return out.close()
+
+
+def _atom_entry(item, base) -> str:
+    published = item["published"]
+    updated = item.get("updated") or published
+    parts = ["<entry>",
+             "<id>%s</id>" % escape(item["guid"]),
+             "<title>%s</title>" % escape(item.get("title", "")),
+             "<link rel=\"alternate\" type=\"text/html\" href=%s/>" %
+             quoteattr(page_url(base, item["archetype"]["href"])),
+             "<published>%s</published>" % escape(published),
+             "<updated>%s</updated>" % escape(updated)]
+    parts.extend("<author><name>%s</name></author>" % escape(name)
+                 for name in authors(item.get("attributions")))
+    if item.get("description"):
+        parts.append("<summary>%s</summary>" % escape(item["description"]))
+    category = item.get("category", {}).get("name")
+    if category:
+        parts.append("<category term=%s/>" % quoteattr(category))
+    parts.append("</entry>\n")
+    return "".join(parts)
+
+
+def write_json_feed(store, site, path: Path, url, size=FEED_SIZE,
+                    digest=None, until=None) -> tuple:
+    """Write a JSON Feed of the newest `size` Items in `store` published
+    at or before `until` to `path`, whose URL is `url`. `site` is the
+    "site" section of the config. Returns (path, digest, written)."""
+    base = site.get("base", "")
+    feed = {"version": JSON_FEED_VERSION, "title": site.get("title", ""),
+            "home_page_url": base, "feed_url": url}
+    if site.get("description"):
+        feed["description"] = site["description"]
+    names = authors(site.get("attributions"))
+    if names:
+        feed["authors"] = [{"name": name} for name in names]
+    out = StreamedFile(path, digest)
+    try:
+        # The feed's own fields, then its items one at a time
+        head = json.dumps(feed, sort_keys=True)[:-1]
+        out.write((head + ', "items": [').encode(UTF8))
+        separator = "\n"
+        for item in newest_items(store, size, until):
+            out.write((separator + json.dumps(
+                _json_entry(item, base), sort_keys=True)).encode(UTF8))
+            separator = ",\n"
+        out.write(b"\n]}\n")
+    except BaseException:
+        out.abort()
+        raise
+    return out.close()
+
+
+def _json_entry(item, base) -> dict:
+    entry = {"id": item["guid"],
+             "url": page_url(base, item["archetype"]["href"]),
+             "title": item.get("title", ""),
+             "date_published": item["published"],
+             "date_modified": item.get("updated") or item["published"]}
+    names = authors(item.get("attributions"))
+    if names:
+        entry["authors"] = [{"name": name} for name in names]
+    if item.get("description"):
+        entry["summary"] = item["description"]
+    category = item.get("category", {}).get("name")
+    if category:
+        entry["tags"] = [category]
+    return entry
+
+
+def write_feeds(config, store, digest=None, until=None) -> list:
+    """Write what the "feeds" section of the config asks for into the build
+    root: a "sitemap", an "atom" feed and a "json" feed, each given as a path
+    relative to the root, with "size" entries in each feed. Items published
+    after `until` are left out. Returns (path, digest, written) for every
+    file written."""
+    settings = config.get("feeds") or {}
+    site = config.get("site", {})
+    base = site.get("base", "")
+    root = Path(config["options"]["root"])
+    size = int(settings.get("size") or FEED_SIZE)
+    results = []
+    if settings.get("sitemap"):
+        results.extend(write_sitemap(
+            store, base, root / settings["sitemap"],
+            uri.urljoin(base, uri.quote(settings["sitemap"])), digest,
+            until=until))
+    for name, write in (("atom", write_atom), ("json", write_json_feed)):
+        if settings.get(name):
+            results.append(write(
+                store, site, root / settings[name],
+                uri.urljoin(base, uri.quote(settings[name])), size, digest,
+                until))
+    return results
@@ -0,0 +1,104 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Memoized code highlighting.
+
+The codehilite extension runs Pygments over every code block of every
+document converted, and the same snippets turn up in many documents. Here
+each highlighted block is remembered by a digest of its code and every
+setting that affects the result: in memory for the rest of the build, and
+on disk, in the Markdown cache, for later builds.
+
+Both codehilite and fenced_code (part of extra) make their CodeHilite
+objects by name, so `install` points those names at a subclass that asks
+the cache first.
+"""
+import json
+import time
+
+import markdown.extensions.codehilite as codehilite
+import markdown.extensions.fenced_code as fenced_code
+
+from webquills.manifest import digest_parts
+from webquills.mdcache import library_versions
+
+
+class CachedCodeHilite(codehilite.CodeHilite):
+    # The HighlightCache in use, if any
+    cache = None
+
+    def hilite(self):
+        if self.cache is None:
+            return super(CachedCodeHilite, self).hilite()
+        return self.cache.hilite(self)
+
+
+def install(cache):
+    """Highlight code blocks in this process through `cache`, a
+    HighlightCache, or directly with Pygments if it is None."""
+    codehilite.CodeHilite = CachedCodeHilite
+    fenced_code.CodeHilite = CachedCodeHilite
+    CachedCodeHilite.cache = cache
+
+
+class HighlightCache(object):
+    """
+    Highlighted HTML of code blocks. Entries are kept in memory and, if
+    given a MarkdownCache `store`, on disk. Each entry records how long
+    highlighting took, so `stats` can say how much time the cache saved.
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        # Markdown and Pygments both shape the HTML of a block
+        self.versions = digest_parts(*library_versions())
+        self.memory = {}
+        self.stats = {}
+        self.reset()
+
+    def reset(self):
+        """Forget what is in memory, and zero the stats."""
+        self.memory.clear()
+        self.stats.update(blocks=0, hits=0, saved=0.0)
+
+    def key(self, code) -> str:
+        # hilite() strips the code the same way before using it
+        settings = [code.src.strip("\n"), code.lang, code.linenums,
+                    code.guess_lang, code.css_class, code.style,
+                    code.noclasses, code.tab_length, code.hl_lines,
+                    code.use_pygments]
+        return digest_parts("highlight", self.versions, json.dumps(settings))
+
+    def hilite(self, code) -> str:
+        """Highlight a CodeHilite block, or find it already highlighted."""
+        self.stats["blocks"] += 1
+        key = self.key(code)
+        entry = self.memory.get(key)
+        if entry is None and self.store is not None:
+            entry = self.store.get(key)
+        if entry is not None:
+            self.memory[key] = entry
+            self.stats["hits"] += 1
+            self.stats["saved"] += entry["seconds"]
+            return entry["html"]
+        start = time.perf_counter()
+        html = super(CachedCodeHilite, code).hilite()
+        entry = {"html": html, "seconds": time.perf_counter() - start}
+        self.memory[key] = entry
+        if self.store is not None:
+            self.store.put(key, entry)
+        return html
@@ -0,0 +1,455 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+The site index in a SQLite database, for sites too big to load whole.
+
+Items are read from the database only when a template asks for them. Catalog
+queries of the common shapes (see `webquills.query.plan`): filtering on
+itemtype prefix, category, dates and the like, sorting by a field and taking
+a slice, run as SQL against indexed columns, so a Catalog showing the ten
+newest Articles reads ten Items. Any other query runs on the whole index
+loaded into memory, with the same results as the JSON store would give.
+"""
+import json
+import sqlite3
+from collections.abc import Mapping
+from pathlib import Path
+
+from webquills import util
+from webquills.indexer import CATALOG, UTF8, IndexStore, epoch, indexable
+from webquills.manifest import digest_bytes, digest_parts
+from webquills.query import Versioned
+
+BACKENDS = ("json", "sqlite")
+DATABASE = "index.sqlite"
+
+# Item fields with a column of their own, which queries can be pushed down
+# on: field path -> (column, holds numbers)
+COLUMNS = {
+    "guid": ("guid", False),
+    "archetype.href": ("href", False),
+    "itemtype": ("itemtype", False),
+    "title": ("title", False),
+    "slug": ("slug", False),
+    "category.name": ("category", False),
+    "created": ("created", False),
+    "published": ("published", False),
+    "updated": ("updated", False),
+    "epoch.created": ("epoch_created", True),
+    "epoch.published": ("epoch_published", True),
+    "epoch.updated": ("epoch_updated", True),
+}
+_FIELDS = list(COLUMNS)[1:]  # guid has a column already
+# Bit of the "odd" mask for each field: set when an Item's value is of a
+# type its column cannot hold (e.g. a list for a title), in which case
+# queries on that field are left to JMESPath.
+_BITS = {field: 1 << i for i, field in enumerate(_FIELDS)}
+
+# Bump when the tables change; the index is then rebuilt from scratch
+SCHEMA_VERSION = 1
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    guid TEXT PRIMARY KEY,
+    sort_time REAL NOT NULL,
+    published_time REAL NOT NULL,
+    odd INTEGER NOT NULL,
+    %s,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_order ON items (sort_time DESC, guid DESC);
+CREATE INDEX IF NOT EXISTS items_published ON items (published_time);
+CREATE INDEX IF NOT EXISTS items_href ON items (href);
+CREATE INDEX IF NOT EXISTS items_itemtype ON items (itemtype);
+CREATE INDEX IF NOT EXISTS items_category ON items (category);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+""" % ",\n    ".join(
+    "%s %s" % (COLUMNS[field][0], "REAL" if COLUMNS[field][1] else "TEXT")
+    for field in _FIELDS)
+
+# The order of Items in the index: newest first by updated time
+NATURAL_ORDER = "sort_time DESC, guid DESC"
+
+
+def index_backend(config) -> str:
+    return config.get("options", {}).get("index") or "json"
+
+
+def index_file(directory, backend="json") -> Path:
+    """The file whose digest stands for the whole stored index."""
+    return Path(directory) / (DATABASE if backend == "sqlite" else CATALOG)
+
+
+def open_store(directory, backend="json", readonly=False):
+    """An IndexStore or SqliteIndexStore for the index in `directory`."""
+    if backend not in BACKENDS:
+        raise ValueError("Unknown index backend %r, expected one of %s" % (
+            backend, ", ".join(BACKENDS)))
+    if backend == "sqlite":
+        return SqliteIndexStore(directory, readonly=readonly)
+    return IndexStore(directory)
+
+
+def _lookup(item, field):
+    value = item
+    for name in field.split("."):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _columns(item):
+    """Column values and the odd mask for an Item."""
+    values = []
+    odd = 0
+    for field in _FIELDS:
+        value = _lookup(item, field)
+        numeric = COLUMNS[field][1]
+        if value is not None and not (
+                _is_number(value) if numeric else isinstance(value, str)):
+            odd |= _BITS[field]
+            value = None
+        values.append(value)
+    return values, odd
+
+
+class SqliteIndexStore(object):
+    """
+    The site index as rows of a SQLite table, one per Item, with the fields
+    catalogs query most often in indexed columns of their own. It has the
+    same interface as IndexStore, and its `as_dict` result loads Items
+    lazily.
+    """
+
+    def __init__(self, directory: Path, readonly=False):
+        self.directory = Path(directory)
+        self.indexfile = self.directory / DATABASE
+        self.readonly = readonly
+        self._db = None
+        self._dirty = False
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            if self.readonly and self.indexfile.exists():
+                self._db = sqlite3.connect(
+                    self.indexfile.resolve().as_uri() + "?mode=ro", uri=True)
+                return self._db
+            if self.readonly:  # nothing indexed yet
+                self._db = sqlite3.connect(":memory:")
+            else:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self._db = sqlite3.connect(str(self.indexfile))
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self._db.executescript("DROP TABLE IF EXISTS items;"
+                                       "DROP TABLE IF EXISTS meta;")
+                self._db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+                self._dirty = True
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    @property
+    def version(self) -> str:
+        """Changes whenever the saved contents of the index change."""
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else digest_parts()
+
+    def _changed(self, *parts):
+        # The version is a chain of digests of every change made
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)",
+                        (digest_parts(self.version, *parts),))
+        self._dirty = True
+
+    def clear(self):
+        """Empty the index."""
+        if self.db.execute("DELETE FROM items").rowcount:
+            self._changed("clear")
+
+    def apply(self, delta):
+        db = self.db
+        for href in delta.tombstones:
+            guids = [row[0] for row in db.execute(
+                "SELECT guid FROM items WHERE href = ?", (href,))]
+            if guids:
+                db.execute("DELETE FROM items WHERE href = ?", (href,))
+                self._changed("delete", *guids)
+        for guid, item in delta.upserts.items():
+            if not indexable(item):  # see build_delta
+                continue
+            data = json.dumps(item, cls=util.SmartJSONEncoder,
+                              sort_keys=True)
+            row = db.execute("SELECT data FROM items WHERE guid = ?",
+                             (guid,)).fetchone()
+            if row and row[0] == data:
+                continue
+            published = epoch(item)
+            updated = epoch(item, "updated") if item.get("updated") \
+                else published
+            values, odd = _columns(item)
+            db.execute(
+                "INSERT OR REPLACE INTO items VALUES (%s)" % ", ".join(
+                    "?" * (len(values) + 5)),
+                [guid, updated, published, odd] + values + [data])
+            self._changed("upsert", guid, digest_bytes(data.encode(UTF8)))
+
+    def save(self):
+        """Commit changes. Returns the paths written."""
+        if not self._dirty:
+            return []
+        self.db.commit()
+        self._dirty = False
+        return [self.indexfile]
+
+    def files(self):
+        """Every file that makes up the stored index."""
+        return [self.indexfile]
+
+    def count(self, until=None) -> int:
+        """Number of Items published at or before `until`."""
+        where, params = _published(until)
+        return self.db.execute("SELECT count(*) FROM items WHERE " + where,
+                               params).fetchone()[0]
+
+    def newest(self, n=None, field="updated", until=None) -> list:
+        """The guids of the `n` most recent Items by `field`, ignoring any
+        published after `until`."""
+        column = "sort_time" if field == "updated" else "published_time"
+        where, params = _published(until)
+        return [row[0] for row in self.db.execute(
+            "SELECT guid FROM items WHERE %s ORDER BY %s DESC, guid DESC "
+            "LIMIT ?" % (where, column), params + [-1 if n is None else n])]
+
+    def hrefs(self, field="updated", until=None):
+        """(archetype href, epoch) of every Item published at or before
+        `until`, newest first by `field`, streamed from the database."""
+        column = "sort_time" if field == "updated" else "published_time"
+        where, params = _published(until)
+        return self.db.execute("SELECT href, %s FROM items WHERE %s ORDER BY "
+                               "%s DESC, guid DESC" % (column, where, column),
+                               params)
+
+    def item(self, guid) -> dict:
+        row = self.db.execute("SELECT data FROM items WHERE guid = ?",
+                              (guid,)).fetchone()
+        if row is None:
+            raise KeyError(guid)
+        return json.loads(row[0])
+
+    def view_version(self, until=None) -> str:
+        """Changes whenever the Items published at or before `until`
+        change: when the index does, or when one comes due."""
+        if until is None:
+            return self.version
+        return digest_parts(self.version, self.count(until))
+
+    def as_dict(self, until=None):
+        """The index in the form templates expect, leaving out Items
+        published after `until`, with Items loaded from the database as
+        they are asked for. Tagged like IndexStore's."""
+        version = self.view_version(until)
+        items = SqliteItems(self.db, version, until)
+        return SqliteIndex({"Items": items, "totalResults": len(items)},
+                           query_version=version)
+
+
+class SqliteIndex(Versioned):
+    """The Index of a SqliteIndexStore. Queries that cannot be pushed down
+    run on a copy with every Item loaded."""
+
+    def materialize(self):
+        return Versioned(self, Items=self["Items"].materialize(),
+                         query_version=self.query_version)
+
+
+class SqliteItems(Mapping):
+    """
+    Items by guid, newest first, read from the database on demand. Items
+    published after `until` are left out. Offers queries to the database
+    first; see `webquills.query`.
+    """
+
+    def __init__(self, db, version, until=None):
+        self.db = db
+        self.query_version = version
+        self.scope, self.params = _published(until)
+        self._materialized = None
+
+    def __getitem__(self, guid):
+        row = self.db.execute(
+            "SELECT data FROM items WHERE guid = ? AND " + self.scope,
+            [guid] + self.params).fetchone()
+        if row is None:
+            raise KeyError(guid)
+        return json.loads(row[0])
+
+    def __contains__(self, guid):
+        return self.db.execute(
+            "SELECT 1 FROM items WHERE guid = ? AND " + self.scope,
+            [guid] + self.params).fetchone() is not None
+
+    def __iter__(self):
+        for row in self.db.execute(
+                "SELECT guid FROM items WHERE %s ORDER BY %s" % (
+                    self.scope, NATURAL_ORDER), self.params):
+            yield row[0]
+
+    def __len__(self):
+        return self.db.execute(
+            "SELECT count(*) FROM items WHERE " + self.scope,
+            self.params).fetchone()[0]
+
+    def items(self):
+        for row in self.db.execute(
+                "SELECT guid, data FROM items WHERE %s ORDER BY %s" % (
+                    self.scope, NATURAL_ORDER), self.params):
+            yield row[0], json.loads(row[1])
+
+    def values(self):
+        for _, item in self.items():
+            yield item
+
+    def materialize(self) -> Versioned:
+        """Every Item, as the JSON store would give them."""
+        if self._materialized is None:
+            self._materialized = Versioned(self.items(),
+                                           query_version=self.query_version)
+        return self._materialized
+
+    def pushdown(self, plan, count=False):
+        """Run a query Plan as SQL, returning its results or, with `count`,
+        how many there are. Returns NotImplemented if the plan uses fields
+        without columns, or if the Items it touches hold values that SQL
+        would treat differently from JMESPath."""
+        try:
+            where, params, mask, prefixed = _where(plan.where)
+            where = "%s AND %s" % (self.scope, where)
+            params = self.params + params
+            order = []
+            sorted_on = []
+            for field, descending in plan.order:
+                direction = " DESC" if descending else ""
+                if field is None:
+                    order.append(NATURAL_ORDER.replace(
+                        " DESC", "" if descending else " DESC"))
+                    continue
+                column = _column(field)
+                mask |= _BITS.get(field, 0)
+                sorted_on.append(column)
+                order.append(column + direction)
+        except _Declined:
+            return NotImplemented
+
+        # JMESPath raises on starts_with(null) and on sorting by null, and
+        # gives other answers for odd values, so leave those to it.
+        checks = ["odd & %d" % mask] if mask else []
+        checks += ["%s IS NULL" % column for column in prefixed]
+        if sorted_on:
+            checks.append("(%s) AND (%s)" % (where, " OR ".join(
+                "%s IS NULL" % column for column in sorted_on)))
+        if checks and self.db.execute(
+                "SELECT EXISTS (SELECT 1 FROM items WHERE %s)" % " OR ".join(
+                    "(%s)" % check for check in checks),
+                params if sorted_on else []).fetchone()[0]:
+            return NotImplemented
+
+        limit = -1 if plan.stop is None else max(0, plan.stop - plan.start)
+        if count:
+            return self.db.execute(
+                "SELECT count(*) FROM (SELECT 1 FROM items WHERE %s "
+                "LIMIT ? OFFSET ?)" % where,
+                params + [limit, plan.start]).fetchone()[0]
+        rows = self.db.execute(
+            "SELECT data FROM items WHERE %s ORDER BY %s LIMIT ? OFFSET ?" % (
+                where, ", ".join(order)),
+            params + [limit, plan.start])
+        found = [json.loads(row[0]) for row in rows]
+        if plan.single:
+            return found[0] if found else None
+        return found
+
+
+class _Declined(Exception):
+    pass
+
+
+def _column(field):
+    if field not in COLUMNS:
+        raise _Declined()
+    return COLUMNS[field][0]
+
+
+def _published(until):
+    """SQL condition and parameters for Items published at or before
+    `until`, or every Item if it is None."""
+    if until is None:
+        return "1", []
+    return "published_time <= ?", [until]
+
+
+def _where(condition):
+    """SQL for a Plan condition that is 0 or 1 (never NULL) for every row,
+    as JMESPath's truthiness of the condition would be. Returns the SQL,
+    its parameters, the odd mask of the fields used and the columns tested
+    with starts_with."""
+    if condition is None:
+        return "1", [], 0, []
+    op = condition[0]
+    if op in ("and", "or"):
+        left, right = _where(condition[1]), _where(condition[2])
+        return ("(%s %s %s)" % (left[0], op.upper(), right[0]),
+                left[1] + right[1], left[2] | right[2], left[3] + right[3])
+    if op == "not":
+        sql, params, mask, prefixed = _where(condition[1])
+        return "(NOT %s)" % sql, params, mask, prefixed
+
+    field = condition[1]
+    column = _column(field)
+    numeric = COLUMNS[field][1]
+    mask = _BITS.get(field, 0)
+    if op == "truthy":
+        # JMESPath treats "" as false, but every number as true
+        if numeric:
+            return "(%s IS NOT NULL)" % column, [], mask, []
+        return "COALESCE(%s != '', 0)" % column, [], mask, []
+
+    value = condition[2]
+    if numeric != _is_number(value):
+        raise _Declined()
+    if op == "starts_with":
+        return ("(substr(%s, 1, ?) = ?)" % column, [len(value), value],
+                mask, [column])
+    if op in ("eq", "ne"):
+        return ("(%s IS %s?)" % (column, "" if op == "eq" else "NOT "),
+                [value], mask, [])
+    # JMESPath orders strings by code point, as SQLite's default BINARY
+    # collation does by comparing their UTF-8 bytes
+    sql = {"lt": "<", "lte": "<=", "gt": ">", "gte": ">="}[op]
+    return "COALESCE(%s %s ?, 0)" % (column, sql), [value], mask, []
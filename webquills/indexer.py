@@ -13,21 +13,61 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
+import bisect
+import gc
+import json
+import time
+from itertools import islice
+from pathlib import Path
+
 import arrow
+import webquills.profile as profile
 from webquills import util
+from webquills.manifest import digest_bytes, digest_parts
+from webquills.query import Versioned
+
+UTF8 = "utf-8"
+CATALOG = "_catalog.json"
+# Bump when the layout of the stored index changes, to force a full reindex
+INDEX_FORMAT = 2
+
+
+def epoch(item, field="published"):
+    """An Item date as seconds since the Unix epoch. Raises KeyError if the
+    Item has no such date."""
+    seconds = item.get("epoch", {}).get(field)
+    if seconds is None:
+        # Archetypes converted before epochs were recorded
+        seconds = util.epoch_seconds(arrow.get(item[field]).datetime)
+    return seconds
+
+
+def indexable(item) -> bool:
+    """True if `item` is an Item the index can hold: one with a guid, an
+    archetype href and dates it can be ordered by."""
+    try:
+        if not isinstance(item["guid"], str) or \
+                not isinstance(item["archetype"]["href"], str):
+            return False
+        epoch(item)
+        if item.get("updated"):
+            epoch(item, "updated")
+    except (KeyError, TypeError, ValueError):  # arrow raises ValueErrors
+        return False
+    return True
 
 
 def add_to_index(index, *args, include_future=False):
     logger = util.getLogger()
     index.setdefault("Items", {})
-    now = arrow.now()
+    now = time.time()
     for archetype in args:
         # Rather than validate every one against schema, just duck-type
         try:
             item = archetype["Item"]
-            pub_date = arrow.get(item['published'])
-            if not include_future and pub_date > now:
-                logger.info("Skipping %s, future publish at %s" % (item['archetype']['href'], pub_date))
+            if not include_future and epoch(item) > now:
+                logger.info("Skipping %s, future publish at %s" % (
+                    item['archetype']['href'], item['published']))
                 continue
             index["Items"][item["guid"]] = item
         except KeyError:  # ignore inputs that don't conform
@@ -35,3 +75,311 @@ def add_to_index(index, *args, include_future=False):
 
     index["totalResults"] = len(index["Items"])
     return index
+
+
+def load_json(text):
+    """json.loads, with the collector paused. Decoding the catalog of a big
+    site makes enough objects to set off full collections, each of which
+    walks every object the build holds."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return json.loads(text)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def shard_for(item) -> str:
+    """Name of the index shard an item is stored in: its publication month."""
+    return str(item.get("published", ""))[:7] or "undated"
+
+
+class IndexDelta(object):
+    """
+    A batch of changes to apply to an IndexStore: Items to insert or replace,
+    keyed by guid, and tombstones for the archetype hrefs that went away.
+    Deltas built from separate batches of archetypes can be merged.
+    """
+
+    def __init__(self):
+        self.upserts = {}
+        self.tombstones = {}  # used as an ordered set
+
+    def upsert(self, item):
+        self.upserts[item["guid"]] = item
+
+    def delete(self, href):
+        self.tombstones[href] = True
+
+    def merge(self, other):
+        self.upserts.update(other.upserts)
+        self.tombstones.update(other.tombstones)
+        return self
+
+    def __len__(self):
+        return len(self.upserts) + len(self.tombstones)
+
+
+def build_delta(paths) -> IndexDelta:
+    """Read archetype files and collect their index changes. Items due to
+    be published in the future are indexed too; stores leave them out of
+    what they show until their time comes (see `IndexStore.as_dict`)."""
+    logger = util.getLogger()
+    delta = IndexDelta()
+    for path in paths:
+        with profile.span(str(path), "index"):
+            archetype = json.loads(Path(path).read_text(encoding=UTF8))
+            # Rather than validate every one against schema, just duck-type
+            item = archetype.get("Item") if isinstance(archetype, dict) \
+                else None
+            if indexable(item):
+                delta.upsert(item)
+                continue
+            logger.warning("Not indexing %s, not an Item with a guid, "
+                           "archetype href and published date" % path)
+            # Drop whatever it held before, if we can tell
+            try:
+                delta.delete(item["archetype"]["href"])
+            except (KeyError, TypeError):
+                pass
+    return delta
+
+
+class DateView(object):
+    """
+    Guids kept sorted by one of their Items' dates, so that "newest N" and
+    "published before T" are answered with a bisect, not a parse and sort
+    of the whole index.
+    """
+
+    # Sorts after any guid, for bisecting on a time alone
+    _last = "\U0010ffff"
+
+    def __init__(self, entries=()):
+        self.entries = sorted(entries)  # (epoch, guid)
+
+    def add(self, when, guid):
+        bisect.insort(self.entries, (when, guid))
+
+    def remove(self, when, guid):
+        i = bisect.bisect_left(self.entries, (when, guid))
+        if i < len(self.entries) and self.entries[i] == (when, guid):
+            del self.entries[i]
+
+    def count(self, until=None) -> int:
+        """Number of guids dated at or before `until`."""
+        if until is None:
+            return len(self.entries)
+        return bisect.bisect_right(self.entries, (until, self._last))
+
+    def newest(self, n=None, until=None) -> list:
+        """Up to `n` guids dated at or before `until`, newest first."""
+        end = self.count(until)
+        start = 0 if n is None else max(0, end - n)
+        return [guid for _, guid in reversed(self.entries[start:end])]
+
+    def after(self, until) -> set:
+        """The guids dated after `until`."""
+        return {guid for _, guid in self.entries[self.count(until):]}
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class IndexStore(object):
+    """
+    The site index, stored as one JSON shard per month of publication plus a
+    small catalog mapping each guid to its shard and archetype href.
+
+    Shards are loaded only when a change touches them, and only changed
+    shards are written back, so the cost of an update follows the size of
+    the change rather than the size of the site. The catalog also keeps each
+    Item's published and updated times, from which the date views are built
+    without loading any shards.
+    """
+
+    date_fields = ("published", "updated")
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.catalogfile = self.directory / CATALOG
+        self._catalog = None
+        self._catalog_text = None
+        self._shards = {}
+        self._dirty = set()
+        self._views = {}
+
+    @property
+    def catalog(self) -> dict:
+        if self._catalog is None:
+            try:
+                self._catalog_text = self.catalogfile.read_text(encoding=UTF8)
+                self._catalog = load_json(self._catalog_text)
+            except (OSError, ValueError):
+                self._catalog = None
+            if not self._catalog or \
+                    self._catalog.get("format") != INDEX_FORMAT:
+                self._catalog = {"format": INDEX_FORMAT, "items": {},
+                                 "shards": {}}
+        return self._catalog
+
+    def view(self, field="updated") -> DateView:
+        """Guids ordered by "published" or "updated" time."""
+        if field not in self._views:
+            i = self.date_fields.index(field)
+            self._views[field] = DateView(
+                (entry[2 + i], guid)
+                for guid, entry in self.catalog["items"].items())
+        return self._views[field]
+
+    def count(self, until=None) -> int:
+        """Number of Items published at or before `until`."""
+        return self.view("published").count(until)
+
+    def _newest(self, field, until):
+        # (epoch, guid) newest first by `field`, leaving out Items published
+        # after `until`. Those are few, so they are found by a bisect.
+        hidden = () if until is None else self.view("published").after(until)
+        for when, guid in reversed(self.view(field).entries):
+            if guid not in hidden:
+                yield when, guid
+
+    def newest(self, n=None, field="updated", until=None) -> list:
+        """The guids of the `n` most recent Items by `field`, ignoring any
+        published after `until`."""
+        if field == "published" or until is None:
+            return self.view(field).newest(n, until)
+        guids = (guid for _, guid in self._newest(field, until))
+        return list(guids if n is None else islice(guids, n))
+
+    def hrefs(self, field="updated", until=None):
+        """(archetype href, epoch) of every Item published at or before
+        `until`, newest first by `field`. Read from the catalog alone,
+        without loading any shards."""
+        items = self.catalog["items"]
+        if until is None:  # nothing to leave out
+            newest = reversed(self.view(field).entries)
+        else:
+            newest = self._newest(field, until)
+        for when, guid in newest:
+            yield items[guid][1], when
+
+    def item(self, guid) -> dict:
+        return self.shard(self.catalog["items"][guid][0])[guid]
+
+    def shard_path(self, name) -> Path:
+        return self.directory / (name + ".json")
+
+    def shard(self, name) -> dict:
+        if name not in self._shards:
+            try:
+                self._shards[name] = load_json(
+                    self.shard_path(name).read_text(encoding=UTF8))
+            except (OSError, ValueError):
+                self._shards[name] = {}
+        return self._shards[name]
+
+    def clear(self):
+        """Empty the index. Every shard will be rewritten on save."""
+        for name in self.catalog["shards"]:
+            self._shards[name] = {}
+            self._dirty.add(name)
+        self.catalog["items"] = {}
+        self.catalog["shards"] = {}
+        self._views = {}
+
+    def _remove(self, guid):
+        entry = self.catalog["items"].pop(guid)
+        self.shard(entry[0]).pop(guid, None)
+        self._dirty.add(entry[0])
+        for i, name in enumerate(self.date_fields):
+            if name in self._views:
+                self._views[name].remove(entry[2 + i], guid)
+
+    def apply(self, delta: IndexDelta):
+        items = self.catalog["items"]
+        if delta.tombstones:
+            by_href = {entry[1]: guid for guid, entry in items.items()}
+            for href in delta.tombstones:
+                if href in by_href:
+                    self._remove(by_href[href])
+        for guid, item in delta.upserts.items():
+            if not indexable(item):  # see build_delta
+                continue
+            name = shard_for(item)
+            if guid in items:
+                self._remove(guid)
+            published = epoch(item)
+            updated = epoch(item, "updated") if item.get("updated") \
+                else published
+            dates = [published, updated]
+            self.shard(name)[guid] = item
+            items[guid] = [name, item["archetype"]["href"]] + dates
+            self._dirty.add(name)
+            for i, field in enumerate(self.date_fields):
+                if field in self._views:
+                    self._views[field].add(dates[i], guid)
+
+    def save(self):
+        """Write changed shards and the catalog. Returns the paths written."""
+        written = []
+        shards = self.catalog["shards"]
+        for name in sorted(self._dirty):
+            path = self.shard_path(name)
+            items = self._shards[name]
+            if not items:
+                if path.exists():
+                    path.unlink()
+                shards.pop(name, None)
+                continue
+            data = json.dumps(items, cls=util.SmartJSONEncoder,
+                              sort_keys=True).encode(UTF8)
+            digest = digest_bytes(data)
+            if shards.get(name) == digest and path.exists():
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(data)
+            shards[name] = digest
+            written.append(path)
+        self._dirty.clear()
+
+        self.catalog["totalResults"] = len(self.catalog["items"])
+        text = json.dumps(self.catalog, sort_keys=True)
+        if text != self._catalog_text or not self.catalogfile.exists():
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self.catalogfile.write_text(text, encoding=UTF8)
+            self._catalog_text = text
+            written.append(self.catalogfile)
+        return written
+
+    def files(self):
+        """Every file that makes up the stored index."""
+        return [self.catalogfile] + [self.shard_path(name)
+                                     for name in sorted(self.catalog["shards"])]
+
+    @property
+    def version(self) -> str:
+        """Changes whenever the saved contents of the index change."""
+        return digest_parts(*sorted(self.catalog["shards"].items()))
+
+    def view_version(self, until=None) -> str:
+        """Changes whenever the Items published at or before `until`
+        change: when the index does, or when one comes due."""
+        if until is None:
+            return self.version
+        return digest_parts(self.version, self.count(until))
+
+    def as_dict(self, until=None) -> dict:
+        """The whole index in the form templates expect, leaving out Items
+        published after `until`. Loads every shard. Items are ordered newest
+        first by updated time. The result is tagged with the version of
+        what it shows, so that queries against it are cached for the rest
+        of the build."""
+        version = self.view_version(until)
+        shards = self.catalog["items"]
+        items = Versioned(((guid, self.shard(shards[guid][0])[guid])
+                           for guid in self.newest(until=until)),
+                          query_version=version)
+        return Versioned({"Items": items, "totalResults": len(items)},
+                         query_version=version)
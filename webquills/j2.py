@@ -14,20 +14,27 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 #
+import json
 import urllib.parse as uri
 from pathlib import Path
 
 import jinja2
-import jmespath
+from jinja2 import meta
 
+import webquills.profile as profile
+import webquills.query
+from webquills.context import freeze, thaw
 from webquills.util import getLogger
 
 
+@profile.spanned("jmes", "filter")
 def jmes(struct, query):
-    # Reverses order of arguments for use as filter inside Jinja templates
-    return jmespath.search(query, struct)
+    # Reverses order of arguments for use as filter inside Jinja templates.
+    # Results may be shared with other renders, so hand them out read-only.
+    return freeze(webquills.query.search(query, thaw(struct)))
 
 
+@profile.spanned("absolute", "filter")
 def absolute(relative, base):
     return uri.urljoin(base, relative)
 
@@ -36,15 +43,153 @@ def with_suffix(filename, suffix):
     return Path(filename).with_suffix(suffix)
 
 
+# Long-lived Jinja environments, keyed by template configuration. Reusing the
+# environment keeps Jinja's compiled template cache warm across renders.
+_environments = {}
+# (config key, candidate names) -> name of first existing template, or None
+_selected_templates = {}
+# (itemtype, scribes, overrides) -> templates_from_context result
+_context_templates = {}
+# (config key, template name) -> names it references, see template_references
+_template_references = {}
+
+
+def _config_key(config):
+    return json.dumps(config.get("jinja2", {}), sort_keys=True)
+
+
+def clear_caches():
+    """Forget all cached environments and template lookups."""
+    _environments.clear()
+    _context_templates.clear()
+    forget_templates()
+
+
+def forget_templates():
+    """Forget which templates exist and what they reference, after the
+    template dir changed. Environments stay warm: Jinja itself reloads
+    templates whose files were modified."""
+    _selected_templates.clear()
+    _template_references.clear()
+
+
+class TracingLoader(jinja2.FileSystemLoader):
+    """
+    A FileSystemLoader whose templates each time their renders when
+    profiling, whether asked for by name, included or extended. Blocks
+    count toward the template whose layout runs them.
+    """
+
+    def load(self, environment, name, globals=None):
+        template = super(TracingLoader, self).load(environment, name, globals)
+        template.root_render_func = _traced(template.name,
+                                            template.root_render_func)
+        return template
+
+
+def _traced(name, render):
+    def root_render_func(context):
+        if not profile.enabled():
+            return render(context)
+        return _spanned(name, render(context))
+    return root_render_func
+
+
+def _spanned(name, events):
+    with profile.span(name, "template"):
+        yield from events
+
+
+def get_environment(config):
+    """Return the shared Jinja environment for this template configuration."""
+    key = _config_key(config)
+    jinja = _environments.get(key)
+    if jinja is None:
+        # TODO Hard-coded FSLoader very limiting. Allow other loaders by
+        # config. Certainly we will want package loader, possibly S3 loader.
+        jinja = jinja2.Environment(
+            loader=TracingLoader(config["jinja2"]["templatedir"]))
+        jinja.filters["jmes"] = jmes
+        jinja.filters["absolute"] = absolute
+        jinja.filters["with_suffix"] = with_suffix
+        # Let tojson see through the read-only views in render contexts
+        jinja.policies["json.dumps_kwargs"] = {"sort_keys": True,
+                                               "default": thaw}
+        _environments[key] = jinja
+    return jinja
+
+
+def get_or_select_template(config, templatenames):
+    """Like Environment.get_or_select_template, but remembers which candidate
+    names exist, so missing candidates are only looked up once."""
+    jinja = get_environment(config)
+    if isinstance(templatenames, str):
+        return jinja.get_template(templatenames)
+
+    names = tuple(templatenames)
+    key = (_config_key(config), names)
+    try:
+        name = _selected_templates[key]
+    except KeyError:
+        name = None
+        for candidate in names:
+            try:
+                jinja.get_template(candidate)
+            except jinja2.TemplateNotFound:
+                continue
+            name = candidate
+            break
+        _selected_templates[key] = name
+    if name is None:
+        raise jinja2.TemplatesNotFound(names)
+    return jinja.get_template(name)
+
+
+def template_references(config, name):
+    """Return the set of template names that `name` pulls in through extends,
+    include or import, recursively, including `name` itself. Returns None if
+    any reference is computed at render time and so cannot be known."""
+    jinja = get_environment(config)
+    key = (_config_key(config), name)
+    if key in _template_references:
+        return _template_references[key]
+
+    found = set()
+    pending = [name]
+    while pending:
+        current = pending.pop()
+        if current in found:
+            continue
+        found.add(current)
+        source = jinja.loader.get_source(jinja, current)[0]
+        for ref in meta.find_referenced_templates(jinja.parse(source)):
+            if ref is None:
+                found = None
+                break
+            pending.append(ref)
+        if found is None:
+            break
+    _template_references[key] = found
+    return found
+
+
+def template_dependencies(config, templatenames):
+    """Return the template names an output rendered from `templatenames`
+    depends on: the candidates passed over (so that creating one is noticed)
+    plus everything the selected template references. Returns None if the
+    selected template has references that cannot be known in advance."""
+    template = get_or_select_template(config, templatenames)
+    refs = template_references(config, template.name)
+    if refs is None:
+        return None
+    if isinstance(templatenames, str):
+        return refs
+    names = list(templatenames)
+    return refs.union(names[:names.index(template.name)])
+
+
 def render(config, context, templatename):
-    # TODO Hard-coded FSLoader very limiting. Allow other loaders by config.
-    # Certainly we will want package loader, possibly S3 loader.
-    jinja = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(config["jinja2"]["templatedir"]))
-    jinja.filters["jmes"] = jmes
-    jinja.filters["absolute"] = absolute
-    jinja.filters["with_suffix"] = with_suffix
-    template = jinja.get_or_select_template(templatename)
+    template = get_or_select_template(config, templatename)
     return template.render(context)
 
 
@@ -54,15 +199,22 @@ def templates_from_context(ctx):
     # possible template names. The first template in this list found to exist
     # will be used to render an output with that extension.
     # Default HTML templates will be added.
-    templates = ctx.get("jinja2_templates", {})
-    pieces = ctx["Item"]["itemtype"].split("/")
-    logger = getLogger()
-    logger.debug("templates from context: " + repr(pieces))
-    while pieces:
-        for extension in ctx["Webquills"]["scribes"]:
-            filename = "_".join(pieces) + "." + extension + ".j2"
-            templates.setdefault(extension, []).append(filename)
-        pieces.pop()
-    # TODO Allow template overrides
-    logger.debug("templates from context: " + repr(templates))
-    return templates
+    overrides = thaw(ctx.get("jinja2_templates", {}))
+    key = (ctx["Item"]["itemtype"], tuple(ctx["Webquills"]["scribes"]),
+           json.dumps(overrides, sort_keys=True))
+    templates = _context_templates.get(key)
+    if templates is None:
+        templates = {ext: list(names) for ext, names in overrides.items()}
+        pieces = ctx["Item"]["itemtype"].split("/")
+        logger = getLogger()
+        logger.debug("templates from context: " + repr(pieces))
+        while pieces:
+            for extension in ctx["Webquills"]["scribes"]:
+                filename = "_".join(pieces) + "." + extension + ".j2"
+                templates.setdefault(extension, []).append(filename)
+            pieces.pop()
+        # TODO Allow template overrides
+        logger.debug("templates from context: " + repr(templates))
+        _context_templates[key] = templates
+    # Callers get their own lists so the cached copy stays pristine
+    return {ext: list(names) for ext, names in templates.items()}
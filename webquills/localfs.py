@@ -15,20 +15,125 @@
 #   limitations under the License.
 #
 import json
-import shutil
+import os
+import stat
 from pathlib import Path
 
+from webquills.copier import CopyEngine
+from webquills.indexdb import index_backend, index_file
+from webquills.indexer import INDEX_FORMAT
+from webquills.manifest import (BuildManifest, config_digest, digest_bytes,
+                                digest_parts)
+from webquills.snapshot import LiveTree, TreeSnapshot
 from webquills.util import SmartJSONEncoder
 
 UTF8 = "utf-8"
 
 
+# Build state kept under the build root, see webquills.manifest
+MANIFEST = Path(".webquills") / "manifest.sqlite"
+
+
 class LocalArchivist(object):
 
     def __init__(self, config):
         self.config = config
         self.root = Path(config["options"]["root"])
         self.source_dir = Path(config["options"]["source"])
+        self.indexdir = self.root / "_index"
+        self.indexfile = index_file(self.indexdir, index_backend(config))
+        self._manifest = None
+        self._copier = None
+        self.tree = LiveTree(self.root, skip=self._is_state)
+        self.sources = LiveTree(self.source_dir)
+        self._config_version = None
+        self._template_version = None
+        self._template_digests = {}
+        # The EmbedCache conversions render embeds from, if any
+        self.embeds = None
+        # Version of the index as the site shows it, see Builder.scope_index
+        self.index_view = None
+
+    @property
+    def manifest(self) -> BuildManifest:
+        # Opened on first use, so commands that never build leave no trace
+        if self._manifest is None:
+            self._manifest = BuildManifest(self.root / MANIFEST)
+            self._manifest.stat = self.stat
+        return self._manifest
+
+    def scan(self):
+        """Snapshot the source and build trees, each in a single walk. Until
+        the next scan, every question about files in them is answered from
+        the snapshots, which the archivist keeps up to date as it writes."""
+        self.sources = TreeSnapshot(self.source_dir)
+        self.tree = TreeSnapshot(self.root, skip=self._is_state)
+
+    def stat(self, path):
+        return self.tree.stat(path, fallback=self.sources.stat)
+
+    def _is_state(self, entry) -> bool:
+        # Build state, including the Markdown cache, is not part of the site
+        return entry.path == str(self.root / MANIFEST.parent)
+
+    def commit(self):
+        if self._manifest is not None:
+            self._manifest.commit()
+
+    def config_version(self) -> str:
+        """Digest of the configuration that shapes every build product."""
+        if self._config_version is None:
+            self._config_version = config_digest(self.config)
+        return self._config_version
+
+    def index_version(self) -> str:
+        """Changes when the index must be rebuilt from scratch: when the
+        config or the layout of the stored index changes."""
+        return digest_parts(self.config_version(), INDEX_FORMAT)
+
+    def template_version(self) -> str:
+        """Digest of every file in the template dir."""
+        if self._template_version is None:
+            parts = []
+            templatedir = self.config.get("jinja2", {}).get("templatedir")
+            if templatedir:
+                templatedir = Path(templatedir)
+                for path in sorted(templatedir.glob("**/*")):
+                    if path.is_file():
+                        parts.append(path.relative_to(templatedir))
+                        parts.append(self.manifest.digest(path))
+            self._template_version = digest_parts(*parts)
+        return self._template_version
+
+    def dependency_digest(self, dependency: str):
+        """Current digest of a named render dependency. Names are
+        "file:<path relative to root>", "template:<template name>",
+        "templates" (the whole template dir), "config" or "index"."""
+        kind, _, name = dependency.partition(":")
+        if kind == "file":
+            return self.manifest.digest(self.root / name)
+        elif kind == "template":
+            if name not in self._template_digests:
+                templatedir = Path(self.config["jinja2"]["templatedir"])
+                self._template_digests[name] = self.manifest.digest(
+                    templatedir / name)
+            return self._template_digests[name]
+        elif kind == "templates":
+            return self.template_version()
+        elif kind == "config":
+            return self.config_version()
+        elif kind == "index":
+            return self.index_view or self.manifest.digest(self.indexfile)
+        raise ValueError("Unknown dependency: %s" % dependency)
+
+    def _dependency_inputs(self, dependencies) -> str:
+        parts = []
+        for dependency in sorted(dependencies):
+            parts += [dependency, self.dependency_digest(dependency)]
+        return digest_parts(*parts)
+
+    def key(self, path: Path) -> str:
+        return str(path.relative_to(self.root))
 
     def load_json(self, path: Path, default=None):
         try:
@@ -40,71 +145,398 @@ class LocalArchivist(object):
     def load_text(self, path: Path) -> str:
         return path.read_text(encoding=UTF8)
 
-    def newer(self, inpath: Path, than: Path = None) -> bool:
-        if than is None:
-            return True
-        try:
-            src = inpath.stat().st_mtime
-            dest = than.stat().st_mtime
-            return src > dest
-        except FileNotFoundError:
-            return True
+    def differs(self, inpath: Path, than: Path) -> bool:
+        """True if the two files do not have the same content."""
+        return self.manifest.digest(inpath) != self.manifest.digest(than)
 
-    def write_text(self, path: Path, text: str):
-        path.parent.mkdir(parents=True, exists_ok=True)
-        return path.write_text(text, encoding=UTF8)
+    def write_text(self, path: Path, text: str) -> bool:
+        """Write text to path, unless it already holds exactly that text.
+        Returns True if the file was written. The text is written under a
+        temporary name and renamed into place, so a file hardlinked to a
+        source by the copier is replaced rather than written through."""
+        data = text.encode(UTF8)
+        digest = digest_bytes(data)
+        if self.manifest.digest(path) == digest:
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(".%s.%d.tmp" % (path.name, os.getpid()))
+        try:
+            tmp.write_bytes(data)
+            os.replace(str(tmp), str(path))
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+        self.tree.update(path)
+        self.manifest.remember(path, digest)
+        return True
 
-    def write_json(self, path: Path, struct: dict, pretty=False):
+    def write_json(self, path: Path, struct: dict, pretty=False) -> bool:
         args = {"cls": SmartJSONEncoder}
         if pretty:
             args.update({"indent": 2, "sort_keys": True})
+        return self.write_text(path, json.dumps(struct, **args))
 
-        path.parent.mkdir(parents=True, exist_ok=True)
-        return path.write_text(json.dumps(struct, **args), encoding=UTF8)
+    @property
+    def copier(self) -> CopyEngine:
+        """Copies sources into the build root. Configured by the "copy"
+        option (copy, hardlink or reflink) and "checksum", which compares
+        file contents instead of size and mtime."""
+        if self._copier is None:
+            options = self.config["options"]
+            self._copier = CopyEngine(
+                mode=options.get("copy") or "copy",
+                checksum=bool(options.get("checksum")),
+                digest=self.manifest.digest)
+        return self._copier
 
-    def gather_sources(self):
-        sourcedir = self.source_dir
+    def gather_sources(self, paths=None):
+        """Copy changed files from the source dir into the build root.
+        `paths` limits this to some source files; by default the whole
+        source tree is scanned. Returns the build root paths that changed.
+        Counts of files copied and skipped are in `copier.stats`."""
+        sourcedir = str(self.source_dir)
         destdir = self.root
-        for src in sourcedir.glob("**/*"):
-            dest = destdir/src.relative_to(sourcedir)
-            if src.is_dir():
-                dest.mkdir(parents=True, exist_ok=True)
-            elif self.newer(src, than=dest):
-                dest.parent.mkdir(parents=True, exist_ok=True)
-                shutil.copy2(str(src), str(dest))
-
-    def sources_needing_update(self):
-        builddir = self.root
+        copier = self.copier
+        copier.reset_stats()
+        if paths is None:
+            files = []
+            for relpath, st in self.sources.items():
+                dest = destdir / relpath
+                if not stat.S_ISDIR(st.st_mode):
+                    files.append((os.path.join(sourcedir, relpath),
+                                  str(dest), st))
+                elif not self.tree.exists(dest):
+                    dest.mkdir(parents=True, exist_ok=True)
+                    self.tree.update(dest)
+        else:
+            files = [(str(src),
+                      str(destdir / os.path.relpath(str(src), sourcedir)),
+                      None) for src in paths if not Path(src).is_dir()]
+        results = copier.sync(files, stat=self.tree.stat)
+
+        # A hard linked file edited in place changes without being copied,
+        # so compare against what was gathered last time, too.
+        gathered = self.manifest.inputs("gather")
+        changed = []
+        for dest, st, written in results:
+            key = self.key(dest)
+            signature = digest_parts(st.st_size, st.st_mtime_ns)
+            if written:
+                self.tree.update(dest)
+            if written or gathered.get(key) != signature:
+                self.manifest.record("gather", key, signature)
+                changed.append(dest)
+        return changed
+
+    def _unlink(self, paths):
+        for path in paths:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            self.tree.update(path)
+
+    def prune_sources(self):
+        """Remove files gathered from sources that have since been deleted,
+        and the archetypes converted from them. Returns the removed paths."""
+        removed = []
+        for key in self.manifest.keys("gather"):
+            if not self.sources.exists(self.source_dir / key):
+                self._unlink([self.root / key])
+                self.manifest.forget("gather", key)
+                removed.append(self.root / key)
+        for key in self.manifest.keys("convert"):
+            if not self.tree.exists(self.root / key):
+                outputs = self.manifest.outputs("convert", key)
+                self._unlink(outputs)
+                self.manifest.forget("convert", key)
+                removed.extend(outputs)
+        return removed
+
+    def prune_archetypes(self):
+        """Remove outputs rendered from archetypes that no longer exist.
+        Returns the keys of deleted archetypes that need to leave the index."""
+        for key in self.manifest.keys("render"):
+            if not self.tree.exists(self.root / key):
+                self._unlink_rendered(self.manifest.outputs("render", key))
+                self.manifest.forget("render", key)
+        gone = [key for key in self.manifest.keys("index")
+                if not self.tree.exists(self.root / key)]
+        return [key for key in gone if self.root / key != self.indexfile]
+
+    def _convert_inputs(self, src: Path, embeds=None) -> str:
+        # `embeds` are the embeds found in src, by default those recorded
+        # when it was last converted. Their responses are part of the
+        # inputs, so a source is converted again when one is resolved or
+        # refreshed.
+        if embeds is None:
+            embeds = self.manifest.dependencies("convert", self.key(src))
+        parts = [self.manifest.digest(src), self.config_version()]
+        if embeds and self.embeds is not None:
+            parts.append(self.embeds.digest_embeds(
+                [tuple(json.loads(name)) for name in sorted(embeds)]))
+        return digest_parts(*parts)
+
+    def converted_embeds(self) -> list:
+        """(url, max_width, max_height) of every embed in the sources
+        converted so far."""
+        return [tuple(json.loads(name))
+                for name in self.manifest.dependency_names("convert")]
+
+    def sources_needing_update(self, candidates=None):
+        """Markdown files in the build root that need converting. Only the
+        `candidates` are considered, if given."""
+        if candidates is None:
+            candidates = self.tree.files(".md")
         needs_update = []
-        for src in builddir.glob("**/*.md"):
-            if not src.is_file():
+        for src in candidates:
+            if not self.tree.is_file(src):
                 continue
-            dest = src.with_suffix(".json")
-            if self.newer(src, than=dest):
+            inputs = self._convert_inputs(src)
+            if not self.manifest.is_current("convert", self.key(src), inputs):
                 needs_update.append(src)
         return needs_update
 
-    def archetypes_needing_indexing(self):
-        builddir = self.root
-        index = builddir/"_index.json"
+    def mark_converted(self, src: Path, target: Path, embeds=()):
+        """Record that `src` was converted to `target`, rendering the
+        (url, max_width, max_height) `embeds`."""
+        key = self.key(src)
+        # If the category or slug changed, the old archetype is now stale
+        stale = [path for path in self.manifest.outputs("convert", key)
+                 if path != target]
+        self._unlink(stale)
+        names = sorted({json.dumps(list(embed)) for embed in embeds})
+        self.manifest.record("convert", key,
+                             self._convert_inputs(src, names), [target],
+                             names)
+
+    def gather_products(self, other):
+        """Copy the archetypes converted in `other`, the LocalArchivist of a
+        build root made from the same sources and conversion settings, for
+        every source here that needs converting. They are recorded as if
+        converted here. Returns the archetypes that were copied."""
+        pairs = []
+        files = []
+        for src in self.sources_needing_update():
+            key = self.key(src)
+            theirs = other.root / key
+            # Left to be tried again if it failed to convert over there
+            if not other.manifest.is_current("convert", key,
+                                             other._convert_inputs(theirs)):
+                continue
+            for target in other.manifest.outputs("convert", key):
+                dest = self.root / other.key(target)
+                pairs.append((src, dest))
+                files.append((str(target), str(dest), None))
+        for dest, st, written in self.copier.sync(files, stat=self.tree.stat):
+            if written:
+                self.tree.update(dest)
+        for src, dest in pairs:
+            self.mark_converted(src, dest, [
+                json.loads(name) for name in other.manifest.dependencies(
+                    "convert", self.key(src)) or ()])
+        return [dest for _, dest in pairs]
+
+    def gather_index(self, other, files):
+        """Copy the stored index of `other`, which is in `files`, into this
+        build root, removing what is left of the index copied last time.
+        Returns the copies."""
+        copies = [self.root / other.key(path) for path in files]
+        previous = self.manifest.outputs("index", self.key(self.indexfile))
+        self._unlink([path for path in previous if path not in copies])
+        pairs = [(str(path), str(dest), None)
+                 for path, dest in zip(files, copies)]
+        for dest, st, written in self.copier.sync(pairs, stat=self.tree.stat):
+            if written:
+                self.tree.update(dest)
+        return copies
+
+    def _archetypes(self, candidates=None):
+        if candidates is None:
+            candidates = self.tree.files(".json")
+        # A JSON Feed is written into the root, but is no archetype
+        feeds = set(self.manifest.outputs("feeds", "feeds"))
+        for src in candidates:
+            if not self.tree.is_file(src) or self.indexdir in src.parents or \
+                    src in feeds:
+                continue
+            yield src
+
+    def index_is_current(self) -> bool:
+        """False if the stored index is missing or was changed behind our
+        back, in which case everything must be indexed again."""
+        return self.manifest.is_current(
+            "index", self.key(self.indexfile), self.index_version())
+
+    def archetypes_needing_indexing(self, candidates=None):
+        """Archetypes that need (re-)indexing. Only the `candidates` are
+        considered, if given."""
+        index_ok = self.index_is_current()
         needs_update = []
-        for src in builddir.glob("**/*.json"):
-            if not src.is_file() or src == index:
+        for src in self._archetypes(candidates):
+            if index_ok and self.manifest.is_current(
+                    "index", self.key(src), self.manifest.digest(src)):
                 continue
-            if self.newer(src, than=index):
+            needs_update.append(src)
+        return needs_update
+
+    def mark_indexed(self, files, removed=(), outputs=()):
+        """Record that `files` were indexed and the archetypes with keys in
+        `removed` dropped from the index, which is stored in `outputs`."""
+        for src in files:
+            self.manifest.record("index", self.key(src),
+                                 self.manifest.digest(src))
+        for key in removed:
+            self.manifest.forget("index", key)
+        for path in outputs:  # written by the IndexStore
+            self.tree.update(path)
+        self.manifest.record("index", self.key(self.indexfile),
+                             self.index_version(), outputs)
+
+    def archetypes_needing_render(self, candidates=None):
+        """Archetypes whose outputs need rendering. Only the `candidates`
+        are considered, if given."""
+        # Each output records what it was rendered from: its archetype, the
+        # config, the templates it used and, for Catalogs, the index. It is
+        # current if none of those have changed since.
+        needs_update = []
+        for src in self._archetypes(candidates):
+            key = self.key(src)
+            dependencies = self.manifest.dependencies("render", key)
+            if dependencies is None or not self.manifest.is_current(
+                    "render", key, self._dependency_inputs(dependencies)):
                 needs_update.append(src)
         return needs_update
 
-    def archetypes_needing_render(self):
-        # - (if webquills.ini changed, rebuild all)
-        # - (if the index changed, rebuild all Catalogs)
-        # otherwise calculate each output file, and compared timestamps
-        # Fuck it, this is kinda hard. For now, just render everything. -VV
-        builddir = self.root
-        index = builddir/"_index.json"
+    def may_use_index(self, paths) -> bool:
+        """True if rendering any of `paths` could read the index: if its
+        last render did, or it was never rendered."""
+        rendered = set(self.manifest.keys("render"))
+        users = set(self.manifest.dependents("render", "index"))
+        return any(key in users or key not in rendered
+                   for key in map(self.key, paths))
+
+    def dependents(self, dependency: str):
+        """Archetypes whose last render depended on `dependency`."""
+        return [self.root / key for key in
+                self.manifest.dependents("render", dependency)]
+
+    def forget_templates(self):
+        """Drop cached template digests, after templates have changed."""
+        self._template_version = None
+        self._template_digests = {}
+
+    def mark_rendered(self, src: Path, outputs, templates=(),
+                      uses_index=False, pages=None):
+        """Record the outputs rendered from `src`. `templates` names every
+        template they used, or is None if that could not be determined.
+        `pages` maps each page of a paginated Catalog to a digest of what it
+        lists. Outputs of the last render that were not written this time
+        (e.g. pages past the new last page) are deleted."""
+        key = self.key(src)
+        dependencies = {"file:" + key, "config"}
+        if templates is None:
+            dependencies.add("templates")
+        else:
+            dependencies.update("template:" + name for name in templates)
+        if uses_index:
+            dependencies.add("index")
+        previous = self.manifest.outputs("render", key)
+        self.manifest.record("render", key,
+                             self._dependency_inputs(dependencies), outputs,
+                             dependencies)
+        base = self._dependency_inputs(dependencies - {"index"})
+        for path, digest in (pages or {}).items():
+            self.manifest.record("page", self.key(path),
+                                 digest_parts(base, digest), [path])
+        self._unlink_rendered([path for path in previous
+                               if path not in outputs])
+
+    def rendered_pages(self, src: Path):
+        """For a paginated Catalog: a digest of what its last render
+        depended on other than the index, and a map of each page still on
+        disk as rendered to the digest recorded for it. Pages whose
+        recorded digest matches the base combined with what they list now
+        are unchanged. None for anything never rendered from the index."""
+        key = self.key(src)
+        dependencies = self.manifest.dependencies("render", key)
+        if not dependencies or "index" not in dependencies:
+            return None
+        recorded = self.manifest.inputs("page")
+        pages = {}
+        for path in self.manifest.outputs("render", key):
+            inputs = recorded.get(self.key(path))
+            if inputs and self.manifest.is_current("page", self.key(path),
+                                                   inputs):
+                pages[path] = inputs
+        if not pages:
+            return None
+        return (self._dependency_inputs(set(dependencies) - {"index"}),
+                pages)
+
+    def _unlink_rendered(self, paths):
+        self._unlink(paths)
+        for path in paths:
+            self.manifest.forget("page", self.key(path))
+
+    def _feeds_inputs(self, index_version) -> str:
+        return digest_parts(index_version, self.config_version())
+
+    def feeds_are_current(self, index_version) -> bool:
+        """True if the sitemap and feeds were written from this version of
+        the index and the config, and are unchanged since."""
+        return self.manifest.is_current("feeds", "feeds",
+                                        self._feeds_inputs(index_version))
+
+    def mark_syndicated(self, index_version, results):
+        """Record the sitemap and feed files written, as (path, digest,
+        written) tuples, and delete those of the last time that were not
+        written again (e.g. sitemap parts no longer needed). Returns the
+        deleted paths."""
+        paths = [path for path, _, _ in results]
+        previous = self.manifest.outputs("feeds", "feeds")
+        stale = [path for path in previous if path not in paths]
+        self._unlink(stale)
+        if not paths:
+            if previous:
+                self.manifest.forget("feeds", "feeds")
+            return stale
+        for path, digest, written in results:
+            if written:
+                self.tree.update(path)
+                self.manifest.remember(path, digest)
+        self.manifest.record("feeds", "feeds",
+                             self._feeds_inputs(index_version), paths)
+        return stale
+
+    def files_needing_compression(self, suffixes):
+        """Files in the build root with one of the `suffixes` whose content
+        changed since their compressed siblings were written."""
         needs_update = []
-        for src in builddir.glob("**/*.json"):
-            if not src.is_file() or src == index:
+        for path in self.tree.files():
+            if not path.name.endswith(suffixes) or \
+                    self.indexdir in path.parents or \
+                    self.root / MANIFEST.parent in path.parents:
                 continue
-            needs_update.append(src)
+            if not self.manifest.is_current("compress", self.key(path),
+                                            self.manifest.digest(path)):
+                needs_update.append(path)
         return needs_update
+
+    def mark_compressed(self, src: Path, outputs):
+        for path in outputs:
+            self.tree.update(path)
+        self.manifest.record("compress", self.key(src),
+                             self.manifest.digest(src), outputs)
+
+    def prune_compressed(self):
+        """Remove compressed siblings of files that no longer exist."""
+        removed = []
+        for key in self.manifest.keys("compress"):
+            if not self.tree.exists(self.root / key):
+                outputs = self.manifest.outputs("compress", key)
+                self._unlink(outputs)
+                self.manifest.forget("compress", key)
+                removed.extend(outputs)
+        return removed
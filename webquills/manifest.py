@@ -0,0 +1,209 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+# Command line options that change how a build runs, but not what it produces
+TRANSIENT_OPTIONS = ("jobs", "outfile", "verbose", "interval", "copy",
+                     "checksum", "precompress", "cache-dir", "cache-size",
+                     "offline", "embed-dir", "embed-fixtures", "embed-ttl",
+                     "profile", "env", "dev")
+
+# Bump when the tables change. The manifest is only a cache, so an
+# out-of-date one is simply dropped and rebuilt.
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS products (
+    stage TEXT NOT NULL,
+    key TEXT NOT NULL,
+    inputs TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    dependencies TEXT NOT NULL,
+    PRIMARY KEY (stage, key)
+);
+"""
+
+
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def digest_parts(*parts) -> str:
+    """Combine several digests (or other strings) into one."""
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def config_digest(config) -> str:
+    options = {k: v for k, v in config.get("options", {}).items()
+               if k not in TRANSIENT_OPTIONS}
+    stable = dict(config, options=options)
+    return digest_bytes(json.dumps(stable, sort_keys=True,
+                                   default=str).encode("utf-8"))
+
+
+class BuildManifest(object):
+    """
+    Persistent record of what the last build consumed and produced.
+
+    File digests are cached against size and mtime, so a file is only read
+    (and hashed) when its stat information changes. Each product of a build
+    stage is recorded with a digest of the inputs that produced it and the
+    digests of the files it wrote. A product is current when its inputs are
+    unchanged and its outputs are still on disk as written.
+    """
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(str(path))
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != SCHEMA_VERSION:
+            self.db.executescript("DROP TABLE IF EXISTS files;"
+                                  "DROP TABLE IF EXISTS products;")
+            self.db.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        self.db.executescript(SCHEMA)
+        # How to stat a file; see LocalArchivist.scan
+        self.stat = os.stat
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def digest(self, path: Path):
+        """Content digest of a file, or None if it does not exist."""
+        key = os.path.abspath(str(path))
+        try:
+            st = self.stat(key)
+        except FileNotFoundError:
+            return None
+        row = self.db.execute(
+            "SELECT size, mtime_ns, digest FROM files WHERE path = ?",
+            (key,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+
+        h = hashlib.sha1()
+        with open(key, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self._store(key, st, digest)
+        return digest
+
+    def remember(self, path: Path, digest: str):
+        """Record the digest of a file just written, saving a re-read."""
+        key = os.path.abspath(str(path))
+        self._store(key, self.stat(key), digest)
+
+    def _store(self, key, st, digest):
+        self.db.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+            (key, st.st_size, st.st_mtime_ns, digest))
+
+    def is_current(self, stage: str, key: str, *inputs) -> bool:
+        """True if `key` was produced from any of the candidate `inputs`
+        digests and all of its outputs are unchanged on disk."""
+        row = self.db.execute(
+            "SELECT inputs, outputs FROM products WHERE stage = ? AND key = ?",
+            (stage, key)).fetchone()
+        if row is None or row[0] not in inputs:
+            return False
+        for path, digest in json.loads(row[1]).items():
+            if self.digest(Path(path)) != digest:
+                return False
+        return True
+
+    def keys(self, stage: str):
+        """Keys of every product recorded for a stage."""
+        return [row[0] for row in self.db.execute(
+            "SELECT key FROM products WHERE stage = ? ORDER BY key",
+            (stage,))]
+
+    def inputs(self, stage: str) -> dict:
+        """Map of key to the inputs recorded for every product of a stage,
+        fetched in one query."""
+        return dict(self.db.execute(
+            "SELECT key, inputs FROM products WHERE stage = ?", (stage,)))
+
+    def products(self, stage: str) -> dict:
+        """Map of key to (inputs, {output path: digest}) for every product
+        of a stage, fetched in one query."""
+        return {key: (inputs, json.loads(outputs)) for key, inputs, outputs
+                in self.db.execute("SELECT key, inputs, outputs FROM products"
+                                   " WHERE stage = ?", (stage,))}
+
+    def outputs(self, stage: str, key: str):
+        """Paths of the files written for `key`, empty if none recorded."""
+        row = self.db.execute(
+            "SELECT outputs FROM products WHERE stage = ? AND key = ?",
+            (stage, key)).fetchone()
+        return [] if row is None else [Path(p) for p in json.loads(row[0])]
+
+    def forget(self, stage: str, key: str):
+        self.db.execute("DELETE FROM products WHERE stage = ? AND key = ?",
+                        (stage, key))
+
+    def dependents(self, stage: str, dependency: str):
+        """Keys of the products of a stage that depend on `dependency`."""
+        # The quoted name is looked for as is: LIKE would take "_" and "%"
+        # in it as wildcards, and ignore case.
+        return [row[0] for row in self.db.execute(
+            "SELECT key FROM products WHERE stage = ? AND "
+            "instr(dependencies, ?) ORDER BY key",
+            (stage, json.dumps(dependency)))]
+
+    def dependencies(self, stage: str, key: str):
+        """Names of the dependencies recorded for `key`, or None."""
+        row = self.db.execute(
+            "SELECT dependencies FROM products WHERE stage = ? AND key = ?",
+            (stage, key)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def dependency_names(self, stage: str) -> list:
+        """Every dependency named by the products of a stage, sorted."""
+        names = set()
+        for row in self.db.execute(
+                "SELECT dependencies FROM products WHERE stage = ? AND "
+                "dependencies != '[]'", (stage,)):
+            names.update(json.loads(row[0]))
+        return sorted(names)
+
+    def record(self, stage: str, key: str, inputs: str, outputs=(),
+               dependencies=()):
+        """Record that `key` was produced from `inputs`, writing `outputs`.
+        `dependencies` optionally names what `inputs` was computed from."""
+        written = {str(path): self.digest(path) for path in outputs}
+        self.db.execute(
+            "INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)",
+            (stage, key, inputs, json.dumps(written, sort_keys=True),
+             json.dumps(sorted(dependencies))))
@@ -0,0 +1,144 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+A persistent cache of Markdown conversions.
+
+Converting the Markdown body of a source, with code highlighting and oEmbed
+lookups, is most of the cost of converting it. The result depends only on
+the body, the extensions and their settings, and the versions of the
+libraries doing the work, so it is kept on disk under a digest of all of
+them. A clean build of mostly unchanged content then converts almost
+nothing: keep the cache directory somewhere that outlives the build
+directory (e.g. in a CI cache) to get the benefit there too.
+
+Entries are small JSON files named by their digest. Reading one marks it as
+recently used; `prune` deletes the least recently used entries until the
+cache fits its size limit.
+"""
+import json
+import os
+from importlib import metadata
+from pathlib import Path
+
+from webquills.manifest import digest_parts
+
+# Bump when the entry layout changes
+CACHE_FORMAT = 1
+
+# Libraries whose version can change what a conversion produces
+LIBRARIES = ("Markdown", "Pygments", "pyembed", "pyembed-markdown")
+
+DEFAULT_SIZE = 256  # MB
+
+
+def library_versions() -> list:
+    versions = []
+    for name in LIBRARIES:
+        try:
+            versions.append("%s %s" % (name, metadata.version(name)))
+        except metadata.PackageNotFoundError:
+            versions.append(name + " missing")
+    return versions
+
+
+def markdown_cache(config):
+    """The MarkdownCache the config asks for: options "cache-dir" (by
+    default, under the build root) and "cache-size" in megabytes."""
+    options = config["options"]
+    directory = options.get("cache-dir") or \
+        Path(options["root"]) / ".webquills" / "markdown"
+    size = float(options.get("cache-size") or DEFAULT_SIZE)
+    return MarkdownCache(directory, max_bytes=int(size * 2 ** 20))
+
+
+class MarkdownCache(object):
+    """
+    Converted HTML and table of contents, by digest of the Markdown text and
+    a `fingerprint` of the converter. Safe to share between processes:
+    entries are written under a temporary name and renamed into place.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_SIZE * 2 ** 20):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0}
+
+    def key(self, text, fingerprint) -> str:
+        return digest_parts(CACHE_FORMAT, fingerprint, text)
+
+    def path(self, key) -> Path:
+        return self.directory / key[:2] / (key + ".json")
+
+    def get(self, key):
+        """The entry stored under `key`, or None."""
+        path = self.path(key)
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+            os.utime(str(path))  # recently used
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(".%s.%d.tmp" % (path.name, os.getpid()))
+        try:
+            tmp.write_text(json.dumps(entry), encoding="utf-8")
+            os.replace(str(tmp), str(path))
+        except OSError:  # a cache that can't be written is just slower
+            if tmp.exists():
+                tmp.unlink()
+
+    def convert(self, converter, text, fingerprint) -> dict:
+        """Convert `text` with a Markdown `converter`, or find it already
+        converted. Returns a dict with "html" and "toc"."""
+        key = self.key(text, fingerprint)
+        entry = self.get(key)
+        if entry is not None:
+            self.stats["hits"] += 1
+            return entry
+        self.stats["misses"] += 1
+        html = converter.reset().convert(text)
+        entry = {"html": html, "toc": getattr(converter, "toc", "")}
+        self.put(key, entry)
+        return entry
+
+    def prune(self) -> int:
+        """Delete least recently used entries until the cache is no bigger
+        than `max_bytes`. Returns the number deleted."""
+        entries = []
+        total = 0
+        for sub in self.directory.glob("??"):
+            for path in sub.glob("*.json"):
+                try:
+                    st = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+                total += st.st_size
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
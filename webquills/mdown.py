@@ -15,79 +15,71 @@
 #   limitations under the License.
 #
 import datetime
+import json
 import re
 import string
-import uuid
-from collections import OrderedDict
 
 import arrow
 import markdown
 import yaml
 from dateutil.parser import parse as parse_date
 from dateutil.tz import tzlocal
-from markdown.extensions.toc import TocExtension
-
-category_seo_msg = '''
-For SEO, please assign a keyword-rich category like "keyword/seo" above.
-It will be used to generate a URL. Category will be inferred from the
-file path otherwise. Recommendations:
-
-Title: <75 characters
-Url: <90 characters (category + slug)
-Description: <160 characters
-'''
-
-catalog_preamble = """
-Webquills:
-    scribes: [html, atom]
-Catalog:
-    queries:
-        - "* | [?starts_with(itemtype, `Item/Page/Article`)]| reverse(sort_by(@, &updated))"
-""".strip()
+import webquills.highlight as highlight
+from webquills.embeds import EmbedExtension
+from webquills.manifest import digest_parts
+from webquills.mdcache import library_versions
+from webquills.util import epoch_seconds
 
 md = None
 
 
-def new_markdown(config, item_type, title=None, **kwargs):
-    """quill new <itemtype> [<title>]
-
-        Generates a new markdown file from a template based on the requested
-        item type. Prints to STDOUT, redirect it where you want it. Types
-        supported are anything that has a JSON schema in the webquills.schemas
-        package. If supplied, <title> will be added to the metadata.
-        """
-    # Some defaults
-    timezone = config.get("site", {}).get("timezone", tzlocal())
-    now = arrow.now(timezone).isoformat().replace("+00:00", "Z")
-    text = ""
-    metas = OrderedDict(itemtype=item_type,
-                        guid='"urn:UUID:' + str(uuid.uuid4()) + '"')
-    metas.update(kwargs)
-    metas.setdefault("created", now)
-    metas.setdefault("updated", now)
-    metas.setdefault("published", now)
-
-    if 'category' not in metas:
-        text += category_seo_msg
-
-    if title:
-        metas["title"] = '"' + title + '"'
-    else:
-        text += "\nYou need to set a title. It's a required field!\n"
-    # Once again pyyaml is trying to be far too clever and cluttering output,
-    # so we do this the old fashioned way. -VV 2016-10-23
-    out = "---\n"
-    out += "Item:\n"
-    for key, value in metas.items():
-        out += "    %s: %s\n" % (key, value)
-    if item_type.startswith("Item/Page/Catalog"):
-        out += catalog_preamble + "\n"
-    out += "...\n"
-    out += text
-    return out
-
-
-def md2archetype(config, intext: str):
+EXTENSIONS = [
+    'markdown.extensions.extra',
+    'markdown.extensions.admonition',
+    'markdown.extensions.codehilite',
+    'markdown.extensions.sane_lists',
+    'markdown.extensions.toc',  # replaces headerId
+    'pyembed.markdown'
+]
+EXTENSION_CONFIGS = {'markdown.extensions.toc': {'permalink': True}}
+
+_fingerprint = None
+
+
+def new_converter(config=None, embeds=None, highlights=None):
+    """Return a new Markdown instance configured with the webquills extensions.
+
+    Markdown instances carry per-document state, so each thread or process
+    doing conversions needs one of its own. If an EmbedCache `embeds` is
+    given, embeds are rendered from it rather than fetched while converting.
+    If a HighlightCache `highlights` is given, code blocks are highlighted
+    through it, by every converter in the process.
+    """
+    if highlights is not None:
+        highlight.install(highlights)
+    extensions = EXTENSIONS
+    if embeds is not None:
+        extensions = [EmbedExtension(embeds) if ext == 'pyembed.markdown'
+                      else ext for ext in EXTENSIONS]
+    converter = markdown.Markdown(extensions=extensions,
+                                  extension_configs=EXTENSION_CONFIGS,
+                                  output_format='html5', lazy_ol=False)
+    converter.embeds = embeds
+    return converter
+
+
+def converter_fingerprint() -> str:
+    """Digest of everything besides the text that shapes converted HTML:
+    the extensions, their settings and the library versions."""
+    global _fingerprint
+    if _fingerprint is None:
+        _fingerprint = digest_parts(
+            json.dumps([EXTENSIONS, EXTENSION_CONFIGS], sort_keys=True),
+            *library_versions())
+    return _fingerprint
+
+
+def md2archetype(config, intext: str, converter=None, cache=None):
     """
     Markdown to JSON.
 
@@ -100,17 +92,10 @@ def md2archetype(config, intext: str):
     """
     # Cache at module level to save setup on multiple calls
     global md
-    if md is None:
-        extensions = [
-            'markdown.extensions.extra',
-            'markdown.extensions.admonition',
-            'markdown.extensions.codehilite',
-            'markdown.extensions.sane_lists',
-            TocExtension(permalink=True),  # replaces headerId
-            'pyembed.markdown'
-        ]
-        md = markdown.Markdown(extensions=extensions, output_format='html5',
-                               lazy_ol=False)
+    if converter is None:
+        if md is None:
+            md = new_converter(config)
+        converter = md
 
     # Clean the input and check for yaml front matter
     mdtext = intext.strip()
@@ -131,7 +116,15 @@ def md2archetype(config, intext: str):
             metadata = frontmatter
             metadata.setdefault("itemtype", "Item/Page/Article")
 
-    html = md.convert(mdtext)
+    if cache is not None:
+        fingerprint = converter_fingerprint()
+        embeds = getattr(converter, "embeds", None)
+        if embeds is not None:
+            fingerprint = digest_parts(fingerprint, embeds.digest(mdtext))
+        html = cache.convert(converter, mdtext, fingerprint)["html"]
+    else:
+        # Reset so state (footnotes, toc ids) never leaks between documents
+        html = converter.reset().convert(mdtext)
     # TODO (Someday) Extract headline from the HTML body for meta
 
     zone = config.get("site", {}).get("timezone", tzlocal())
@@ -139,6 +132,7 @@ def md2archetype(config, intext: str):
     # cleanup or is hard to encode using markdown's simple format.
     itemmeta = {}
     catalog_meta = {}
+    dates = {}  # normalized date string -> datetime
     for key, value in metadata.items():
         key = key.lower()
         if key in ['created', 'date', 'published', 'updated']:
@@ -153,6 +147,7 @@ def md2archetype(config, intext: str):
             if key == 'date':  # Legacy DC.date, convert to specific
                 key = 'published'
             itemmeta[key] = dt.isoformat().replace("+00:00", "Z")
+            dates[itemmeta[key]] = dt.datetime
 
         elif key == 'itemtype':
             itemmeta[key] = string.capwords(value, '/')
@@ -163,6 +158,11 @@ def md2archetype(config, intext: str):
     itemmeta['published'] = itemmeta.get(
         'published') or itemmeta.get('updated')
     itemmeta['updated'] = itemmeta.get('updated') or itemmeta.get('published')
+    # Numeric copies of the dates, so the index can filter and sort on them
+    # without parsing dates again.
+    itemmeta['epoch'] = {key: epoch_seconds(dates[itemmeta[key]])
+                         for key in ('created', 'published', 'updated')
+                         if itemmeta.get(key)}
     # hard coded defaults: markdown typically represents HTML pages
     itemmeta.setdefault("contenttype", "text/html; charset=utf-8")
     itemmeta.setdefault("itemtype", "Item/Page")
@@ -0,0 +1,82 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Skeleton Markdown sources for quill new. Kept apart from webquills.mdown so
+that making one doesn't load the Markdown converter.
+"""
+import uuid
+from collections import OrderedDict
+
+import arrow
+from dateutil.tz import tzlocal
+
+category_seo_msg = '''
+For SEO, please assign a keyword-rich category like "keyword/seo" above.
+It will be used to generate a URL. Category will be inferred from the
+file path otherwise. Recommendations:
+
+Title: <75 characters
+Url: <90 characters (category + slug)
+Description: <160 characters
+'''
+
+catalog_preamble = """
+Webquills:
+    scribes: [html, atom]
+Catalog:
+    queries:
+        - "* | [?starts_with(itemtype, `Item/Page/Article`)]"
+""".strip()
+
+
+def new_markdown(config, item_type, title=None, **kwargs):
+    """quill new <itemtype> [<title>]
+
+        Generates a new markdown file from a template based on the requested
+        item type. Prints to STDOUT, redirect it where you want it. Types
+        supported are anything that has a JSON schema in the webquills.schemas
+        package. If supplied, <title> will be added to the metadata.
+        """
+    # Some defaults
+    timezone = config.get("site", {}).get("timezone", tzlocal())
+    now = arrow.now(timezone).isoformat().replace("+00:00", "Z")
+    text = ""
+    metas = OrderedDict(itemtype=item_type,
+                        guid='"urn:UUID:' + str(uuid.uuid4()) + '"')
+    metas.update(kwargs)
+    metas.setdefault("created", now)
+    metas.setdefault("updated", now)
+    metas.setdefault("published", now)
+
+    if 'category' not in metas:
+        text += category_seo_msg
+
+    if title:
+        metas["title"] = '"' + title + '"'
+    else:
+        text += "\nYou need to set a title. It's a required field!\n"
+    # Once again pyyaml is trying to be far too clever and cluttering output,
+    # so we do this the old fashioned way. -VV 2016-10-23
+    out = "---\n"
+    out += "Item:\n"
+    for key, value in metas.items():
+        out += "    %s: %s\n" % (key, value)
+    if item_type.startswith("Item/Page/Catalog"):
+        out += catalog_preamble + "\n"
+    out += "...\n"
+    out += text
+    return out
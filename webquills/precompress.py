@@ -0,0 +1,77 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Precompressed siblings of text outputs, for servers that can send a
+foo.html.gz (or foo.html.br) in place of foo.html without compressing on
+every request.
+
+Gzip output has a zero mtime and no file name in its header, and brotli has
+neither, so the same input always yields the same bytes. Brotli is used if
+the optional `brotli` package is installed.
+"""
+import os
+
+from webquills.util import gzip_file
+
+try:
+    import brotli
+except ImportError:  # optional dependency
+    brotli = None
+
+SUFFIXES = (".html", ".atom", ".json", ".css", ".js")
+
+# Encoding name -> file name suffix
+ENCODINGS = {"gzip": ".gz", "br": ".br"}
+
+
+def available_encodings():
+    return ["gzip", "br"] if brotli is not None else ["gzip"]
+
+
+def brotli_file(src, dest, quality=11):
+    """Brotli compress the file `src` into `dest` a chunk at a time."""
+    compressor = brotli.Compressor(quality=quality)
+    with open(str(src), "rb") as fin, open(str(dest), "wb") as fout:
+        for chunk in iter(lambda: fin.read(1 << 16), b""):
+            fout.write(compressor.process(chunk))
+        fout.write(compressor.finish())
+
+
+def compressed_path(path, encoding):
+    return path.with_name(path.name + ENCODINGS[encoding])
+
+
+def precompress(path, encodings=("gzip",)):
+    """Write a compressed sibling of `path` for each encoding. Each is
+    written under a temporary name and renamed into place. Returns the
+    paths written."""
+    written = []
+    for encoding in encodings:
+        dest = compressed_path(path, encoding)
+        tmp = dest.with_name("." + dest.name + ".tmp")
+        try:
+            if encoding == "gzip":
+                gzip_file(path, tmp)
+            else:
+                brotli_file(path, tmp)
+            os.replace(str(tmp), str(dest))
+        except BaseException:
+            if tmp.exists():
+                tmp.unlink()
+            raise
+        written.append(dest)
+    return written
@@ -0,0 +1,184 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Where does the build spend its time?
+
+The pipeline marks its hot paths with `span` (per stage, per file, per
+template and per template filter) and tallies events with `count`. Both do
+nothing but test a global unless a Profiler has been switched on with
+`enable`, as `quill build --profile` does. The Profiler can then write the
+spans as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev)
+and summarize the most expensive ones.
+
+Only this process is profiled: with -j above 1, the work done in worker
+processes shows up as the stage that waited for it.
+"""
+import json
+import os
+import threading
+import time
+from functools import wraps
+from pathlib import Path
+
+_profiler = None
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_span = _NoSpan()
+
+
+def enabled() -> bool:
+    return _profiler is not None
+
+
+def span(name, cat="build"):
+    """A context manager timing a span of work, if profiling."""
+    if _profiler is None:
+        return _no_span
+    return _profiler.span(name, cat)
+
+
+def spanned(name, cat="build"):
+    """Decorate a function so every call of it is a span."""
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return func(*args, **kwargs)
+            with _profiler.span(name, cat):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, n=1):
+    """Add `n` to a counter, if profiling."""
+    if _profiler is not None:
+        _profiler.counters[name] = _profiler.counters.get(name, 0) + n
+
+
+def enable():
+    """Start profiling. Returns the Profiler."""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """Stop profiling. Returns the Profiler that was in use, if any."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+
+class _Span(object):
+    __slots__ = ("profiler", "name", "cat", "start", "children")
+
+    def __init__(self, profiler, name, cat):
+        self.profiler = profiler
+        self.name = name
+        self.cat = cat
+
+    def __enter__(self):
+        self.children = 0
+        self.profiler._stack().append(self)
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        duration = time.perf_counter_ns() - self.start
+        stack = self.profiler._stack()
+        stack.pop()
+        if stack:
+            stack[-1].children += duration
+        self.profiler.events.append(
+            (self.name, self.cat, self.start, duration,
+             duration - self.children, threading.get_ident()))
+        return False
+
+
+class Profiler(object):
+    """
+    Spans recorded as (name, category, start, duration, self time, thread)
+    in nanoseconds, where self time leaves out nested spans. Counters are
+    a dict of name to number.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.counters = {}
+        self.origin = time.perf_counter_ns()
+        self._local = threading.local()
+
+    def _stack(self) -> list:
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def span(self, name, cat="build"):
+        return _Span(self, name, cat)
+
+    def chrome_trace(self) -> dict:
+        """The spans and counters in Chrome's trace event format."""
+        pid = os.getpid()
+        trace = [{"name": name, "cat": cat, "ph": "X", "pid": pid,
+                  "tid": tid, "ts": (start - self.origin) / 1000,
+                  "dur": duration / 1000}
+                 for name, cat, start, duration, _, tid in self.events]
+        end = max([e["ts"] + e["dur"] for e in trace] or [0])
+        trace.extend({"name": name, "ph": "C", "pid": pid, "ts": end,
+                      "args": {"value": value}}
+                     for name, value in sorted(self.counters.items()))
+        return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+    def write_trace(self, path):
+        Path(path).write_text(json.dumps(self.chrome_trace()),
+                              encoding="utf-8")
+
+    def totals(self) -> list:
+        """(category, name, calls, total, self time) per distinct span,
+        times in seconds, most self time first."""
+        totals = {}
+        for name, cat, _, duration, own, _ in self.events:
+            entry = totals.setdefault((cat, name), [0, 0, 0])
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += own
+        rows = [(cat, name, calls, total / 1e9, own / 1e9)
+                for (cat, name), (calls, total, own) in totals.items()]
+        return sorted(rows, key=lambda row: (-row[4], row[0], row[1]))
+
+    def summary(self, top=20) -> str:
+        """A table of the `top` spans by self time, then the counters."""
+        lines = ["%-8s %-44s %7s %9s %9s" % ("category", "span", "calls",
+                                             "total s", "self s")]
+        for cat, name, calls, total, own in self.totals()[:top]:
+            if len(name) > 44:
+                name = "..." + name[-41:]
+            lines.append("%-8s %-44s %7d %9.3f %9.3f" % (
+                cat, name, calls, total, own))
+        for name, value in sorted(self.counters.items()):
+            lines.append("%-53s %7d" % (name, value))
+        return "\n".join(lines)
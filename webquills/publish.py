@@ -0,0 +1,271 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Publish a build directory to an S3 bucket.
+
+Only objects whose content differs from the bucket are uploaded. The remote
+ETag of a simple upload is the MD5 of its body, so comparing it with the MD5
+of what we would upload tells us whether anything changed without
+downloading anything.
+"""
+import hashlib
+import json
+import mimetypes
+import os
+import urllib.parse as uri
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import boto3
+from botocore.config import Config
+
+from webquills.localfs import MANIFEST
+from webquills.manifest import BuildManifest, digest_bytes
+from webquills.util import getLogger, gzip
+
+mimetypes.add_type("application/atom+xml", ".atom")
+mimetypes.add_type("text/markdown", ".md")
+
+# Build state that is not part of the web site
+PRIVATE = (".webquills", "_index")
+
+# Content types worth compressing before upload
+COMPRESSIBLE = {
+    "application/atom+xml", "application/javascript", "application/json",
+    "application/xml", "image/svg+xml", "text/css", "text/html",
+    "text/javascript", "text/markdown", "text/plain", "text/xml",
+}
+
+# `body` holds what plan() compressed to compare with the bucket, so that
+# it is not compressed again for the upload; otherwise None.
+Upload = namedtuple("Upload", "key path headers body")
+
+
+class S3Bucket(object):
+    """One S3 bucket, reached through a client with a connection pool big
+    enough for `connections` concurrent requests."""
+
+    def __init__(self, name, prefix="", connections=10, endpoint_url=None):
+        self.name = name
+        self.prefix = prefix
+        self.client = boto3.client(
+            "s3", endpoint_url=endpoint_url,
+            config=Config(max_pool_connections=connections))
+
+    def etags(self) -> dict:
+        """Map of key to ETag for every object under the prefix."""
+        etags = {}
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.name, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                etags[obj["Key"]] = obj["ETag"].strip('"')
+        return etags
+
+    def put(self, key, body: bytes, **headers):
+        self.client.put_object(Bucket=self.name, Key=key, Body=body,
+                               **headers)
+
+
+class LocalBucket(object):
+    """A stand-in for an S3 bucket backed by a local directory. Each object
+    is stored as a file, with its headers in a JSON file alongside."""
+
+    metadir = ".s3meta"
+
+    def __init__(self, directory, prefix=""):
+        self.directory = Path(directory)
+        self.prefix = prefix
+
+    def etags(self) -> dict:
+        etags = {}
+        if not self.directory.exists():
+            return etags
+        for path in self.directory.glob("**/*"):
+            key = path.relative_to(self.directory).as_posix()
+            if path.is_file() and not key.startswith(self.metadir) and \
+                    key.startswith(self.prefix):
+                etags[key] = hashlib.md5(path.read_bytes()).hexdigest()
+        return etags
+
+    def put(self, key, body: bytes, **headers):
+        path = self.directory / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(body)
+        meta = self.directory / self.metadir / (key + ".json")
+        meta.parent.mkdir(parents=True, exist_ok=True)
+        meta.write_text(json.dumps(headers, sort_keys=True), encoding="utf-8")
+
+    def headers(self, key) -> dict:
+        meta = self.directory / self.metadir / (key + ".json")
+        return json.loads(meta.read_text(encoding="utf-8"))
+
+
+def open_bucket(destination, connections=10, endpoint_url=None):
+    """Return a bucket for an "s3://bucket/prefix" URL, or a LocalBucket for
+    anything else, which is taken to be a directory."""
+    url = uri.urlparse(destination)
+    if url.scheme == "s3":
+        prefix = url.path.lstrip("/")
+        if prefix and not prefix.endswith("/"):
+            prefix += "/"
+        return S3Bucket(url.netloc, prefix, connections=connections,
+                        endpoint_url=endpoint_url)
+    return LocalBucket(destination)
+
+
+def headers_for(path: Path, compress=False) -> dict:
+    """S3 headers for a file. Text types get an explicit charset."""
+    content_type, encoding = mimetypes.guess_type(str(path))
+    content_type = content_type or "application/octet-stream"
+    headers = {}
+    if compress and content_type in COMPRESSIBLE and encoding is None:
+        headers["ContentEncoding"] = "gzip"
+    elif encoding:
+        headers["ContentEncoding"] = encoding
+    if content_type.startswith("text/") or content_type in COMPRESSIBLE:
+        content_type += "; charset=utf-8"
+    headers["ContentType"] = content_type
+    return headers
+
+
+class Publisher(object):
+    """
+    Uploads the files under `root` that differ from what is in `bucket`,
+    many at a time. With `compress`, text files are uploaded gzipped with a
+    fixed mtime, so the same input always yields the same body and ETag.
+    A .gz sibling written by precompress holds those same bytes, and is
+    used instead of compressing the file again when the build manifest
+    shows it was written from the file as it is now.
+    """
+
+    def __init__(self, bucket, root: Path, jobs=10, compress=False):
+        self.bucket = bucket
+        self.root = Path(root)
+        self.jobs = jobs
+        self.compress = compress
+        self.siblings = self.recorded_siblings()
+
+    def recorded_siblings(self) -> dict:
+        """Map of the key of each file with a .gz sibling to the digests of
+        the file and the sibling, as recorded when the sibling was written.
+        Read once, as the manifest cannot be shared between threads."""
+        path = self.root / MANIFEST
+        if not self.compress or not path.exists():
+            return {}
+        manifest = BuildManifest(path)
+        try:
+            products = manifest.products("compress")
+        finally:
+            manifest.close()
+        siblings = {}
+        for key, (inputs, outputs) in products.items():
+            for output, digest in outputs.items():
+                if output.endswith(".gz"):
+                    siblings[key] = (inputs, digest)
+        return siblings
+
+    def files(self):
+        for dirpath, dirnames, filenames in os.walk(str(self.root)):
+            if dirpath == str(self.root):
+                dirnames[:] = [d for d in dirnames if d not in PRIVATE]
+            dirnames.sort()
+            for name in sorted(filenames):
+                yield Path(dirpath) / name
+
+    def compresses(self, upload: Upload) -> bool:
+        """True if the file is gzipped for upload, rather than sent as is
+        (as a .gz file already compressed is)."""
+        return upload.headers.get("ContentEncoding") == "gzip" and \
+            upload.path.suffix != ".gz"
+
+    def body(self, upload: Upload) -> bytes:
+        if upload.body is not None:
+            return upload.body
+        if not self.compresses(upload):
+            return upload.path.read_bytes()
+        data = upload.path.read_bytes()
+        recorded = self.siblings.get(str(upload.path.relative_to(self.root)))
+        if recorded and recorded[0] == digest_bytes(data):
+            sibling = upload.path.with_name(upload.path.name + ".gz")
+            try:
+                body = sibling.read_bytes()
+            except OSError:  # removed since
+                body = None
+            if body is not None and digest_bytes(body) == recorded[1]:
+                return body
+        return gzip(data, mtime=0)
+
+    def _check(self, upload: Upload, etag):
+        """The Upload to make, or None if `etag` shows the bucket has the
+        body already."""
+        if not etag:
+            return upload
+        body = self.body(upload)
+        if etag == hashlib.md5(body).hexdigest():
+            return None
+        return upload._replace(body=body) if self.compresses(upload) \
+            else upload
+
+    def plan(self):
+        """Return the Uploads needed, and the number of files unchanged.
+        Files are compared with the bucket many at a time; hashlib and zlib
+        release the GIL, so threads use every core."""
+        remote = self.bucket.etags()
+        checks = []
+        for path in self.files():
+            key = self.bucket.prefix + \
+                path.relative_to(self.root).as_posix()
+            checks.append((Upload(key, path, headers_for(path, self.compress),
+                                  None), remote.get(key)))
+        with ThreadPoolExecutor(self.jobs) as pool:
+            results = list(pool.map(lambda check: self._check(*check),
+                                    checks))
+        uploads = [upload for upload in results if upload is not None]
+        return uploads, len(results) - len(uploads)
+
+    def _put(self, upload: Upload):
+        body = self.body(upload)
+        self.bucket.put(upload.key, body, **upload.headers)
+        return len(body)
+
+    def publish(self, dry_run=False) -> dict:
+        """Upload changed files. Returns counts, plus a list of the keys
+        that failed to upload with the reason."""
+        logger = getLogger()
+        uploads, unchanged = self.plan()
+        stats = {"uploaded": 0, "bytes": 0, "unchanged": unchanged,
+                 "failed": []}
+        if dry_run:
+            for upload in uploads:
+                logger.info("Would upload %s" % upload.key)
+            return stats
+
+        with ThreadPoolExecutor(self.jobs) as pool:
+            futures = [(upload, pool.submit(self._put, upload))
+                       for upload in uploads]
+            for upload, future in futures:
+                try:
+                    size = future.result()
+                except Exception as e:  # Reported per key, like renders
+                    logger.error("%s: %s" % (upload.key, e))
+                    stats["failed"].append((upload.key, str(e)))
+                    continue
+                logger.info("Uploaded %s" % upload.key)
+                stats["uploaded"] += 1
+                stats["bytes"] += size
+        return stats
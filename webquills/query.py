@@ -0,0 +1,433 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Compiled and memoized JMESPath queries.
+
+Every expression is parsed once per process. Queries against data that
+carries a version tag (see `Versioned`) are also memoized by (expression,
+version), so every Catalog and template asking the same question of the
+same index shares one result. `search_slice` and `count` answer the
+questions a paginated Catalog asks without sorting every result.
+
+Data with a `pushdown` method (such as the Items of an index kept in
+SQLite) is offered a `Plan` of the query first, so common catalog queries
+can run inside the store. Otherwise, data with a `materialize` method is
+replaced by its result, and the query runs on that as usual.
+"""
+import heapq
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from operator import itemgetter
+
+import jmespath
+
+# How many data versions to keep results for. A build only ever sees one
+# index version; a long-running process moves from one to the next.
+MAX_VERSIONS = 4
+
+stats = {"compiled": 0, "hits": 0, "misses": 0, "pushed": 0}
+_compiled = {}
+_plans = {}
+_results = OrderedDict()  # version -> {expression: result}
+
+
+class Versioned(dict):
+    """A dict tagged with a version. The tag must change whenever the
+    contents do, because query results are cached against it."""
+
+    def __init__(self, *args, query_version=None, **kwargs):
+        super(Versioned, self).__init__(*args, **kwargs)
+        self.query_version = query_version
+
+
+def compile(expression):
+    parsed = _compiled.get(expression)
+    if parsed is None:
+        parsed = jmespath.compile(expression)
+        _compiled[expression] = parsed
+        stats["compiled"] += 1
+    return parsed
+
+
+# A query over the values of a mapping of Items, as:
+#   where: a condition tree of tuples, or None for every Item. Conditions
+#     are ("and"|"or", a, b), ("not", a), ("truthy", field) and
+#     (op, field, literal) for op in starts_with, eq, ne, lt, lte, gt, gte.
+#   order: (field, descending) pairs, most significant first. A field of
+#     None stands for the mapping's own order.
+#   start, stop: the slice of the ordered results wanted. stop may be None.
+#   single: True if the query wants one Item (or null), not a list.
+# Fields are dotted paths, e.g. "category.name".
+Plan = namedtuple("Plan", "where order start stop single")
+
+
+class _Unsupported(Exception):
+    pass
+
+
+def plan(expression):
+    """A Plan for an expression of the shape
+    `* | [?condition] | sort_by(@, &field) | reverse(@) | [start:stop]`
+    (any of the later stages optional, in any sensible order), or None if
+    the expression has some other shape."""
+    if expression not in _plans:
+        try:
+            _plans[expression] = _plan(_stages(compile(expression).parsed))
+        except _Unsupported:
+            _plans[expression] = None
+    return _plans[expression]
+
+
+def _is(node, kind, *children):
+    return node["type"] == kind and all(
+        node["children"][i]["type"] == child
+        for i, child in enumerate(children))
+
+
+def _stages(node):
+    if node["type"] == "pipe":
+        return _stages(node["children"][0]) + _stages(node["children"][1])
+    if _is(node, "value_projection", "identity", "identity"):
+        return [("values",)]
+    if _is(node, "filter_projection", "identity", "identity"):
+        return [("filter", _condition(node["children"][2]))]
+    if _is(node, "projection", "index_expression", "identity"):
+        left, right = node["children"][0]["children"]
+        if right["type"] == "slice":
+            return _before(left) + [("slice",) + tuple(right["children"])]
+    if _is(node, "index_expression") and \
+            node["children"][1]["type"] == "index":
+        return _before(node["children"][0]) + [
+            ("index", node["children"][1]["value"])]
+    if node["type"] == "function_expression":
+        args = node["children"]
+        before = _before(args[0])
+        if node["value"] == "reverse" and len(args) == 1:
+            return before + [("reverse",)]
+        if node["value"] == "sort_by" and len(args) == 2 and \
+                args[1]["type"] == "expref":
+            return before + [("sort", _field(args[1]["children"][0]))]
+    raise _Unsupported()
+
+
+def _before(node):
+    # The stages feeding a subscript or function argument
+    if node["type"] in ("identity", "current"):
+        return []
+    return _stages(node)
+
+
+def _field(node):
+    if node["type"] == "field":
+        return node["value"]
+    if node["type"] == "subexpression":
+        return ".".join(_field(child) for child in node["children"])
+    raise _Unsupported()
+
+
+_flipped = {"eq": "eq", "ne": "ne", "lt": "gt", "lte": "gte", "gt": "lt",
+            "gte": "lte"}
+
+
+def _literal(node):
+    value = node["value"]
+    if node["type"] != "literal" or isinstance(value, bool) or \
+            not isinstance(value, (str, int, float)):
+        raise _Unsupported()
+    return value
+
+
+def _condition(node):
+    kind = node["type"]
+    if kind in ("and_expression", "or_expression"):
+        return (kind[:-11],) + tuple(_condition(child)
+                                     for child in node["children"])
+    if kind == "not_expression":
+        return ("not", _condition(node["children"][0]))
+    if kind in ("field", "subexpression"):
+        return ("truthy", _field(node))
+    if kind == "comparator" and node["value"] in _flipped:
+        left, right = node["children"]
+        if left["type"] == "literal":
+            return (_flipped[node["value"]], _field(right), _literal(left))
+        return (node["value"], _field(left), _literal(right))
+    if kind == "function_expression" and node["value"] == "starts_with":
+        field, prefix = node["children"]
+        prefix = _literal(prefix)
+        if isinstance(prefix, str):
+            return ("starts_with", _field(field), prefix)
+    raise _Unsupported()
+
+
+def _plan(stages):
+    if not stages or stages[0] != ("values",):
+        raise _Unsupported()
+    where = None
+    order = ((None, False),)
+    start, stop = 0, None
+    sliced = single = False
+    for stage in stages[1:]:
+        kind = stage[0]
+        if single or (sliced and kind in ("filter", "sort", "reverse")):
+            raise _Unsupported()
+        if kind == "filter":
+            where = stage[1] if where is None else ("and", where, stage[1])
+        elif kind == "sort":
+            order = ((stage[1], False),) + order
+        elif kind == "reverse":
+            order = tuple((field, not desc) for field, desc in order)
+        elif kind == "slice":
+            first, last, step = stage[1:]
+            if any(n is not None and (not isinstance(n, int) or n < 0)
+                   for n in (first, last)) or step not in (None, 1):
+                raise _Unsupported()
+            end = None if last is None else start + last
+            start += first or 0
+            if stop is None or (end is not None and end < stop):
+                stop = end
+            sliced = True
+        elif kind == "index":
+            if stage[1] < 0:
+                raise _Unsupported()
+            start += stage[1]
+            if stop is None or start + 1 < stop:
+                stop = start + 1
+            single = True
+        else:
+            raise _Unsupported()
+    return Plan(where, order, start, stop, single)
+
+
+def _evaluate(expression, data):
+    pushdown = getattr(data, "pushdown", None)
+    if pushdown is not None and plan(expression) is not None:
+        result = pushdown(plan(expression))
+        if result is not NotImplemented:
+            stats["pushed"] += 1
+            return result
+    if hasattr(data, "materialize"):
+        data = data.materialize()
+    return compile(expression).search(data)
+
+
+def _cached(key, data, evaluate):
+    version = getattr(data, "query_version", None)
+    if version is None:
+        return evaluate()
+
+    results = _results.get(version)
+    if results is None:
+        results = _results[version] = {}
+        while len(_results) > MAX_VERSIONS:
+            _results.popitem(last=False)
+    if key in results:
+        stats["hits"] += 1
+        return results[key]
+    stats["misses"] += 1
+    result = results[key] = evaluate()
+    return result
+
+
+def search(expression, data):
+    return _cached(expression, data, lambda: _evaluate(expression, data))
+
+
+def _false(value):
+    # What JMESPath filters treat as false
+    return value is None or value is False or value in ("", [], {})
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _lookup(value, field):
+    for name in field.split("."):
+        value = value.get(name) if isinstance(value, dict) else None
+    return value
+
+
+def _predicate(where):
+    """A Python function of an Item that is true where JMESPath's filter
+    would be. Raises _Unsupported from inside for an Item on which JMESPath
+    would raise."""
+    if where is None:
+        return lambda value: True
+    op = where[0]
+    if op in ("and", "or"):
+        left, right = _predicate(where[1]), _predicate(where[2])
+        if op == "and":
+            return lambda value: left(value) and right(value)
+        return lambda value: left(value) or right(value)
+    if op == "not":
+        inner = _predicate(where[1])
+        return lambda value: not inner(value)
+    field = where[1]
+    if op == "truthy":
+        return lambda value: not _false(_lookup(value, field))
+    literal = where[2]
+    if op == "starts_with":
+        def starts_with(value):
+            subject = _lookup(value, field)
+            if not isinstance(subject, str):
+                raise _Unsupported()
+            return subject.startswith(literal)
+        return starts_with
+    if op in ("eq", "ne"):
+        # Like JMESPath, never equate true and 1 or false and 0
+        special = _is_number(literal) and literal in (0, 1)
+
+        def equals(value):
+            subject = _lookup(value, field)
+            if special and isinstance(subject, bool):
+                return False
+            return subject == literal
+        if op == "eq":
+            return equals
+        return lambda value: not equals(value)
+    compare = {"lt": lambda a, b: a < b, "lte": lambda a, b: a <= b,
+               "gt": lambda a, b: a > b, "gte": lambda a, b: a >= b}[op]
+
+    def ordered(value):
+        subject = _lookup(value, field)
+        if not (_is_number(subject) or isinstance(subject, str)):
+            return False
+        return compare(subject, literal)
+    return ordered
+
+
+def _matching(query_plan, data):
+    """(position, value) for each value of `data` the plan's filter keeps."""
+    keep = _predicate(query_plan.where)
+    for position, value in enumerate(data.values()):
+        if keep(value):
+            yield position, value
+
+
+def _listed(result):
+    if isinstance(result, list):
+        return result
+    return [] if result is None else [result]
+
+
+def _within(query_plan, start, stop):
+    """The plan for items start:stop of the plan's own results."""
+    first = query_plan.start + start
+    last = query_plan.start + stop
+    if query_plan.stop is not None:
+        last = min(last, query_plan.stop)
+    return query_plan._replace(start=min(first, last), stop=last)
+
+
+def _top(query_plan, data):
+    """The results of a plan over an in-memory mapping, picking the top
+    `stop` with a heap rather than sorting them all. None if that would not
+    give what JMESPath does."""
+    order = query_plan.order
+    descending = order[0][1]
+    if any(desc != descending for _, desc in order):
+        return None
+    if order == ((None, False),):  # the mapping's own order: no sort at all
+        found = islice(_matching(query_plan, data), query_plan.stop)
+        return [value for _, value in found][query_plan.start:]
+
+    candidates = []
+    kinds = [set() for _ in order]
+    for position, value in _matching(query_plan, data):
+        key = []
+        for i, (field, _) in enumerate(order):
+            if field is None:
+                key.append(position)
+                continue
+            part = _lookup(value, field)
+            kinds[i].add(str if isinstance(part, str) else
+                         float if _is_number(part) else None)
+            key.append(part)
+        candidates.append((tuple(key), value))
+    # sort_by only sorts all strings or all numbers; leave errors to it
+    if any(None in kind or len(kind) > 1 for kind in kinds):
+        return None
+    pick = heapq.nlargest if descending else heapq.nsmallest
+    top = pick(query_plan.stop, candidates, key=itemgetter(0))
+    return [value for _, value in top[query_plan.start:]]
+
+
+def search_slice(expression, data, start, stop):
+    """`search(expression, data)[start:stop]`, treating a result that is
+    not a list as a list of one (or none, for null). If the whole result is
+    not already cached, queries that `plan` understands are pushed down, or
+    if they start at the first result, answered with a heap."""
+    def evaluate():
+        version = getattr(data, "query_version", None)
+        if expression in _results.get(version, ()):
+            return _listed(search(expression, data))[start:stop]
+        query_plan = plan(expression)
+        if query_plan is not None and not query_plan.single:
+            query_plan = _within(query_plan, start, stop)
+            pushdown = getattr(data, "pushdown", None)
+            if pushdown is not None:
+                result = pushdown(query_plan)
+                if result is not NotImplemented:
+                    stats["pushed"] += 1
+                    return result
+            # Later pages are cheaper cut from one full sort, shared by all
+            if query_plan.start == 0:
+                values = data.materialize() \
+                    if hasattr(data, "materialize") else data
+                try:
+                    result = _top(query_plan, values)
+                except _Unsupported:
+                    result = None
+                if result is not None:
+                    return result
+        return _listed(search(expression, data))[start:stop]
+    return _cached(("slice", expression, start, stop), data, evaluate)
+
+
+def count(expression, data) -> int:
+    """The length of `search(expression, data)` (0 for null, 1 for any
+    other result that is not a list), without sorting when the query has a
+    shape `plan` understands."""
+    def evaluate():
+        query_plan = plan(expression)
+        if query_plan is not None and not query_plan.single:
+            pushdown = getattr(data, "pushdown", None)
+            if pushdown is not None:
+                found = pushdown(query_plan, count=True)
+                if found is not NotImplemented:
+                    stats["pushed"] += 1
+                    return found
+            values = data.materialize() if hasattr(data, "materialize") \
+                else data
+            try:
+                found = sum(1 for _ in _matching(query_plan, values))
+            except _Unsupported:
+                return len(_listed(search(expression, data)))
+            if query_plan.stop is not None:
+                found = min(found, query_plan.stop)
+            return max(0, found - query_plan.start)
+        return len(_listed(search(expression, data)))
+    return _cached(("count", expression), data, evaluate)
+
+
+def clear():
+    """Forget all compiled expressions, cached results and counters."""
+    _compiled.clear()
+    _plans.clear()
+    _results.clear()
+    for key in stats:
+        stats[key] = 0
@@ -19,44 +19,96 @@ WebQuills command line interface.
 
 Usage:
     quill new [-o OUTFILE] ITEMTYPE [TITLE]
-    quill build [-v] [-r ROOT] [-t DIR] [-s SRCDIR] [--dev]
+    quill build [-v] [-r ROOT] [-t DIR] [-s SRCDIR] [-j N] [--dev]
+                [--copy=MODE] [--checksum] [--precompress] [--index=BACKEND]
+                [--cache-dir=DIR] [--offline] [--embed-fixtures=DIR]
+                [--profile=TRACE] [--env=NAME]...
+    quill watch [-v] [-r ROOT] [-t DIR] [-s SRCDIR] [-j N] [--dev]
+                [--copy=MODE] [--checksum] [--precompress] [--index=BACKEND]
+                [--cache-dir=DIR] [--offline] [--embed-fixtures=DIR]
+                [--interval=SECONDS]
+    quill publish [-v] [-r ROOT] [-j N] [--gzip] [--dry-run] [--endpoint=URL]
+                  DEST
     quill putS3redirects [-v] [-r ROOT] REDIR_FILE
     quill config [-v] [QUERY]
+    quill bench [-v] [-j N] [-n COUNT] [--catalogs=N] [--depth=N]
+                [-o OUTFILE] [--compare=FILE] [--tolerance=PERCENT]
 
 Options:
+    --cache-dir=DIR         Where to keep converted Markdown between builds.
+                            Defaults to .webquills/markdown in the build
+                            directory.
+    --catalogs=N            Number of Catalogs in the benchmark site.
+                            Defaults to 5.
+    --checksum              Compare source files by content rather than by
+                            size and modification time.
+    --compare=FILE          Benchmark results to compare with. Exit with an
+                            error if any stage got slower than --tolerance.
+    --copy=MODE             How source files get into the build directory:
+                            copy, hardlink or reflink. Links fall back to
+                            copying where the filesystem can't link.
+                            Defaults to copy.
+    --depth=N               How deep benchmark templates extend each other.
+                            Defaults to 3.
     --dev                   Development mode. Ignore future publish restriction
                             and include all items.
+    --dry-run               Show what would be uploaded, but upload nothing.
+    --embed-fixtures=DIR    Directory of saved oEmbed responses, laid out like
+                            the embed cache, used before the cache.
+    --endpoint=URL          S3 endpoint URL, e.g. for a local S3 stand-in.
+    --env=NAME              Build for an environment defined in
+                            webquills.yml. Repeat to build several at once:
+                            Markdown is converted and indexed only for the
+                            first, and rendered for each.
+    --gzip                  Upload text files gzip compressed.
+    --index=BACKEND         How the site index is stored: json, or sqlite
+                            for large sites. Defaults to json.
+    --interval=SECONDS      How often watch checks for changes, when polling.
+                            [default: 0.5]
+    -j --jobs=N             Number of worker processes to use for building.
+                            Use 0 for one per CPU. Defaults to 1. For publish,
+                            the number of concurrent uploads (default 10).
+    -n --count=COUNT        Number of articles in the benchmark site.
+                            Defaults to 1000.
     -o --outfile=OUTFILE    File to write output. Defaults to STDOUT.
                             If the destination file exists, it will be
                             overwritten.
+    --offline               Never fetch oEmbed responses. Embeds come from
+                            the fixtures or the cache, or become links.
+    --precompress           Also write .gz (and .br, if brotli is installed)
+                            copies of html, atom, json, css and js files.
+    --profile=TRACE         Time each stage, file, template and filter, write
+                            the timings to TRACE as a Chrome trace, and
+                            print the most expensive.
     -r --root=ROOT          The destination build directory. All calculated
                             paths will be relative to this directory.
     -s --source=SRCDIR      The directory from which to read source files
                             (markdown, etc.)
+    --tolerance=PERCENT     How much slower than --compare a stage may get.
+                            Defaults to 10.
     -t --templatedir=DIR    Directory where templates are stored. TEMPLATE
                             path should be relative to this.
     -v --verbose            Verbose logging
 
 """
-import copy
 from pathlib import Path
 
-import boto3
-import jmespath
-import jsonschema
-import webquills.indexer as indexer
-import webquills.j2 as j2
 import yaml
 from docopt import docopt
-from webquills.localfs import LocalArchivist
-from webquills.mdown import md2archetype, new_markdown
-import webquills.util as util
 
+# Each command imports what it needs when it runs, so that quick commands
+# like config and new don't pay for loading the whole build pipeline.
 
 UTF8 = "utf-8"
 
+ITEM_TYPES = {
+    "article": "Item/Page/Article",
+    "page": "Item/Page",
+    "catalog": "Item/Page/Catalog"
+}
 
-def configure(args):
+
+def configure(args, env=None):
     with open("webquills.yml") as f:
         cfg = yaml.load(f, Loader=yaml.BaseLoader)
     cfg.setdefault("markdown", {})
@@ -64,118 +116,178 @@ def configure(args):
     cfg.setdefault("options", {})
     cfg.setdefault("site", {})
 
+    # An environment overrides sections of the config, and its other
+    # settings (e.g. root) are options. The command line still wins.
+    if env is not None:
+        for key, value in cfg["environments"][env].items():
+            if isinstance(value, dict):
+                cfg.setdefault(key, {}).update(value)
+            else:
+                cfg["options"][key] = value
+
     for key, value in args.items():
         if key.startswith("--") and value is not None:
             cfg["options"][key[2:]] = value
     return cfg
 
 
+def run_bench(param) -> int:
+    import logging
+    import webquills.bench as bench
+    import webquills.util as util
+    logger = util.getLogger()
+    # Per-file build logging would swamp the timings
+    logger.setLevel(logging.INFO if param["--verbose"] else logging.WARNING)
+    results = bench.run(count=int(param["--count"] or 1000),
+                        catalogs=int(param["--catalogs"] or 5),
+                        depth=int(param["--depth"] or 3),
+                        jobs=int(param["--jobs"] or 1))
+    print(bench.format_results(results))
+    if param["--outfile"]:
+        bench.save(results, param["--outfile"])
+    if param["--compare"]:
+        tolerance = float(param["--tolerance"] or 10) / 100
+        found = bench.regressions(results, bench.load(param["--compare"]),
+                                  tolerance)
+        for message in found:
+            logger.error(message)
+        if found:
+            return 1
+    return 0
+
+
+def run_build(param, cfg) -> int:
+    import webquills.build as build
+    import webquills.profile as profile
+    import webquills.util as util
+    logger = util.getLogger(cfg)
+    configs = []
+    for env in dict.fromkeys(param["--env"]):
+        if env not in cfg.get("environments", {}):
+            logger.error("No environment %s in webquills.yml" % env)
+            return 1
+        configs.append((env, configure(param, env)))
+    roots = [config["options"]["root"] for _, config in configs]
+    for root in roots:
+        if "://" in root:
+            logger.error("Can't build into %s, which is not a local "
+                         "directory. Use quill publish to upload." % root)
+            return 1
+    if len(set(roots)) < len(roots):
+        logger.error("Environments built together need roots of their own")
+        return 1
+
+    profiler = profile.enable() if param["--profile"] else None
+    if configs:
+        failed = [src for paths in build.build_environments(
+            configs, include_future=param['--dev']).values() for src in paths]
+    else:
+        builder = build.Builder(cfg, include_future=param['--dev'])
+        failed = builder.build()
+    if profiler:
+        profile.disable()
+        profiler.write_trace(param["--profile"])
+        print(profiler.summary())
+    return 1 if failed else 0
+
+
+def run_watch(param, cfg) -> int:
+    import webquills.build as build
+    import webquills.util as util
+    import webquills.watch as watch
+    util.getLogger(cfg)
+    builder = build.Builder(cfg, include_future=param['--dev'])
+    try:
+        watch.watch(builder, interval=float(param["--interval"]))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def run_new(param, cfg) -> int:
+    from webquills.newitem import new_markdown
+    # TODO (someday) Prompt user for metadata values
+    doc = new_markdown(cfg, ITEM_TYPES[param['ITEMTYPE'].lower()],
+                       title=param['TITLE'])
+    # Prepare the output file handle
+    if param['--outfile']:
+        dest = Path(param["--outfile"])
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        dest.write_text(doc, encoding=UTF8)
+    else:
+        print(doc)
+    return 0
+
+
+def run_config(param, cfg) -> int:
+    out = repr(cfg)
+    if param["QUERY"]:
+        import jmespath
+        out = repr(jmespath.search(param["QUERY"], cfg))
+    out = out.strip().strip('"\'')
+    print(out)
+    return 0
+
+
+def run_publish(param, cfg) -> int:
+    import webquills.publish as publish
+    import webquills.util as util
+    logger = util.getLogger(cfg)
+    # DEST is s3://bucket/prefix, or a directory standing in for one
+    jobs = int(cfg["options"].get("jobs") or 0)
+    if jobs < 1:  # 0 means one per CPU when building; here, the default
+        jobs = 10
+    bucket = publish.open_bucket(param["DEST"], connections=jobs,
+                                 endpoint_url=param["--endpoint"])
+    publisher = publish.Publisher(bucket, Path(cfg["options"]["root"]),
+                                  jobs=jobs, compress=param["--gzip"])
+    stats = publisher.publish(dry_run=param["--dry-run"])
+    logger.info("Uploaded %(uploaded)d files (%(bytes)d bytes), "
+                "%(unchanged)d unchanged" % stats)
+    if stats["failed"]:
+        logger.error("%d files failed to upload" % len(stats["failed"]))
+        return 1
+    return 0
+
+
+def run_putS3redirects(param, cfg) -> int:
+    import boto3
+    import webquills.util as util
+    logger = util.getLogger(cfg)
+    if not cfg["root"].startswith("s3"):
+        logger.error("Root is not an S3 bucket!")
+        return 1
+    with open(param["REDIR_FILE"]) as f:
+        redirs = yaml.load(f, Loader=yaml.BaseLoader)
+    s3 = boto3.client('s3')
+    for redir in redirs["redirects"]:
+        s3.put_object(Bucket=cfg["options"]["root"],
+                      Key=redir["from"],
+                      WebSiteRedirect=redir["to"]
+                      )
+    return 0
+
+
+COMMANDS = {
+    "build": run_build,
+    "watch": run_watch,
+    "new": run_new,
+    "config": run_config,
+    "publish": run_publish,
+    "putS3redirects": run_putS3redirects,
+}
+
+
 # MAIN: Dispatch to individual handlers
 def main():
     param = docopt(__doc__)
+    if param["bench"]:
+        # Makes its own site, so needs no webquills.yml
+        exit(run_bench(param))
     cfg = configure(param)
-    logger = util.getLogger(cfg)
-    item_types = {
-        "article": "Item/Page/Article",
-        "page": "Item/Page",
-        "catalog": "Item/Page/Catalog"
-    }
-    arch = LocalArchivist(cfg)
-    schema = util.Schematist(cfg)
-
-    if param["build"]:
-        # 1. cp any files from srcdir needing update to root
-        arch.gather_sources()
-        # 2. find root sources needing JSON; md2json them
-        for src in arch.sources_needing_update():
-            logger.info("Updating source: %s" % src)
-            archetype = md2archetype(cfg, src.read_text(encoding=UTF8))
-            schema.apply_defaults(archetype, src)
-
-            # FIXME Because done before validation, category may not be right
-            # type. Gives confusing error message.
-            target = schema.root / archetype["Item"]["category"]["label"] / \
-                archetype["Item"]["slug"]
-            target = target.with_suffix(".json")
-            archetype["Item"]["archetype"] = {
-                "href": "/" + str(target.relative_to(arch.root)),
-                "rel": "wq:archetype"
-            }
-            archetype["Item"]["source"] = {
-                "href": "/" + str(src.relative_to(arch.root)),
-                "rel": "wq:source"
-            }
-
-            try:
-                schema.validate(archetype)
-            except jsonschema.ValidationError as e:
-                logger.info(str(e))
-                logger.error("%s: %s at %s" % (src, e.message, e.path))
-                logger.debug(archetype)
-                continue
-            arch.write_json(target, archetype)
-
-        # 3. find json files needing indexing; index them
-        indexfile = arch.root / "_index.json"
-        index = arch.load_json(indexfile, default={})
-        for file in arch.archetypes_needing_indexing():
-            logger.info("Indexing %s" % file)
-            indexer.add_to_index(index, arch.load_json(file),
-                                 include_future=param['--dev'])
-        arch.write_json(indexfile, index)
-
-        # 4. find any json files needing outputs
-        base_context = copy.deepcopy(cfg)
-        for file in arch.archetypes_needing_render():
-            logger.info("Rendering %s" % file)
-            item = arch.load_json(file)
-            if "Item" not in item:
-                logger.warning("Skipping non-Item JSON file: %s" % file)
-                continue
-            context = copy.deepcopy(base_context)
-            context.update(item)
-            if item["Item"]["itemtype"].startswith("Item/Page/Catalog"):
-                context["Index"] = index
-
-            outputs = j2.templates_from_context(context)
-            for extension, templatelist in outputs.items():
-                # Allows items to override output format, or request
-                # additional formats
-                if extension not in context["Webquills"]["scribes"]:
-                    continue
-                out = j2.render(cfg, context, templatelist)
-                file.with_suffix(
-                    '.' + extension).write_text(out, encoding=UTF8)
-
-    elif param['new']:
-        # TODO (someday) Prompt user for metadata values
-        doc = new_markdown(cfg, item_types[param['ITEMTYPE'].lower()],
-                           title=param['TITLE'])
-        # Prepare the output file handle
-        if param['--outfile']:
-            dest = Path(param["--outfile"])
-            dest.parent.mkdir(parents=True, exist_ok=True)
-            dest.write_text(doc, encoding=UTF8)
-        else:
-            print(doc)
-
-    elif param["config"]:
-        out = repr(cfg)
-        if param["QUERY"]:
-            out = repr(jmespath.search(param["QUERY"], cfg))
-        out = out.strip().strip('"\'')
-        print(out)
-
-    elif param["putS3redirects"]:
-        out = repr(cfg)
-        if not cfg["root"].startswith("s3"):
-            logger.error("Root is not an S3 bucket!")
-            exit(1)
-        with open(param["REDIR_FILE"]) as f:
-            redirs = yaml.load(f, Loader=yaml.BaseLoader)
-        s3 = boto3.client('s3')
-        for redir in redirs["redirects"]:
-            s3.put_object(Bucket=cfg["options"]["root"],
-                          Key=redir["from"],
-                          WebSiteRedirect=redir["to"]
-                          )
+    for command, handler in COMMANDS.items():
+        if param[command]:
+            status = handler(param, cfg)
+            if status:
+                exit(status)
+            return
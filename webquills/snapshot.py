@@ -0,0 +1,121 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+What is in a directory tree, from one walk.
+
+Each build stage asks the same questions of the build root: which files end
+in .md or .json, does this one exist, what are its size and mtime. Asking
+the filesystem every time costs a stat per question, which adds up on large
+trees and network filesystems. A TreeSnapshot walks the tree once and
+answers from memory, and is told about every file the build writes or
+deletes so that it stays true.
+
+LiveTree has the same interface but asks the filesystem every time, for
+code that works on a tree without taking a snapshot first.
+"""
+import errno
+import os
+import stat
+from pathlib import Path
+
+from webquills.copier import scan
+
+
+class LiveTree(object):
+
+    def __init__(self, root, skip=None):
+        self.root = Path(root)
+        self.skip = skip
+
+    def stat(self, path, fallback=os.stat):
+        return os.stat(str(path))
+
+    def exists(self, path) -> bool:
+        try:
+            self.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def is_file(self, path) -> bool:
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def items(self):
+        """(path relative to root, stat) for every entry in the tree."""
+        return [(relpath, entry.stat())
+                for relpath, entry in scan(self.root, self.skip)]
+
+    def files(self, suffix=""):
+        """Sorted paths of the files whose names end with `suffix`."""
+        return sorted(self.root / relpath for relpath, st in self.items()
+                      if relpath.endswith(suffix) and stat.S_ISREG(st.st_mode))
+
+    def update(self, path):
+        """Note that `path` was just written or deleted."""
+        pass
+
+
+class TreeSnapshot(LiveTree):
+    """
+    Path, size, mtime and kind of everything under `root`, as stat results,
+    from a single os.scandir walk. Paths outside the root are passed to
+    `fallback` by `stat`. Directories matching `skip`, a function of a
+    DirEntry, are left out.
+    """
+
+    def __init__(self, root, skip=None):
+        super(TreeSnapshot, self).__init__(root, skip)
+        self._base = os.path.abspath(str(root))
+        self.entries = dict(super(TreeSnapshot, self).items())
+
+    def _relpath(self, path):
+        path = os.path.abspath(str(path))
+        if path == self._base:
+            return ""
+        if path.startswith(self._base + os.sep):
+            return path[len(self._base) + 1:]
+        return None
+
+    def stat(self, path, fallback=os.stat):
+        relpath = self._relpath(path)
+        if relpath is None:
+            return fallback(str(path))
+        try:
+            return self.entries[relpath]
+        except KeyError:
+            raise FileNotFoundError(errno.ENOENT, "No such file", str(path))
+
+    def items(self):
+        return list(self.entries.items())
+
+    def update(self, path):
+        relpath = self._relpath(path)
+        if not relpath:
+            return
+        try:
+            self.entries[relpath] = os.stat(str(path))
+        except FileNotFoundError:
+            self.entries.pop(relpath, None)
+            return
+        # A new file may have brought new directories with it
+        parent = os.path.dirname(relpath)
+        while parent and parent not in self.entries:
+            self.entries[parent] = os.stat(os.path.join(self._base, parent))
+            parent = os.path.dirname(parent)
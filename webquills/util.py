@@ -18,16 +18,18 @@ import copy
 import datetime
 import logging
 import json
+import shutil
 from gzip import GzipFile
 from io import BytesIO
 
 import colorlog
-import jmespath
 import jsonschema
 import pkg_resources
 import slugify as sluglib
 from pathlib import Path
 
+import webquills.query as query
+
 
 class SmartJSONEncoder(json.JSONEncoder):
     """
@@ -53,8 +55,42 @@ class SmartJSONEncoder(json.JSONEncoder):
             return super(SmartJSONEncoder, self).default(o)
 
 
+def epoch_seconds(dt: datetime.datetime):
+    """Seconds since the Unix epoch for an aware datetime. Whole seconds come
+    back as an int, so they serialize without a trailing ".0"."""
+    seconds = dt.timestamp()
+    return int(seconds) if seconds.is_integer() else seconds
+
+
+def inline_refs(schema: dict) -> dict:
+    """Return a copy of schema with local "#/..." references replaced by the
+    definitions they point to, so validation never has to resolve them.
+    Recursive references are left in place."""
+    def lookup(pointer):
+        node = schema
+        for part in pointer.lstrip("#/").split("/"):
+            node = node[part.replace("~1", "/").replace("~0", "~")]
+        return node
+
+    def resolve(node, seen):
+        if isinstance(node, list):
+            return [resolve(value, seen) for value in node]
+        if not isinstance(node, dict):
+            return node
+        ref = node.get("$ref")
+        if isinstance(ref, str) and ref.startswith("#/") and ref not in seen \
+                and len(node) == 1:
+            return resolve(lookup(ref), seen | {ref})
+        return {key: resolve(value, seen) for key, value in node.items()}
+
+    return resolve(schema, frozenset())
+
+
 class Schematist(object):
 
+    # If there is an author, that's the default copyright holder.
+    author_query = "[?role=='author']|[0]"
+
     def __init__(self, config):
         self.config = config
         self.root = Path(config.get("options", {}).get("root", ""))
@@ -63,13 +99,23 @@ class Schematist(object):
         with open(schemafile, encoding="utf-8") as f:
             self.itemschema = json.load(f)
 
+        # Check the schema and build the validator once, not per item
+        cls = jsonschema.validators.validator_for(self.itemschema)
+        cls.check_schema(self.itemschema)
+        self.validator = cls(inline_refs(self.itemschema))
+
+        # Only mutable defaults need copying into each item
+        self.defaults = [
+            (key, value, isinstance(value, (dict, list)))
+            for key, value in self.config.get("item_defaults", {}).items()]
+        self.author = query.compile(self.author_query)
+
     def apply_defaults(self, archetype: dict, path: Path) -> dict:
         logger = getLogger()
         meta = archetype["Item"]
-        configured_default = copy.deepcopy(
-            self.config.get("item_defaults", {}))
-        for key, value in configured_default.items():
-            meta.setdefault(key, value)
+        for key, value, mutable in self.defaults:
+            if key not in meta:
+                meta[key] = copy.deepcopy(value) if mutable else value
 
         default_cat = {"label": str(path.parent.relative_to(self.root))}
         if default_cat["label"] == ".":
@@ -82,8 +128,7 @@ class Schematist(object):
         meta.setdefault("links", [])
         # If there is an author, that's the default copyright holder.
         try:
-            author = jmespath.search("[?role==`author`]|[0]",
-                                     meta["attributions"])
+            author = self.author.search(meta["attributions"])
             meta.setdefault("copyright_holder", author)
         except KeyError:
             # no author
@@ -101,9 +146,20 @@ class Schematist(object):
         archetype["Webquills"].setdefault("scribes", ["html"])
 
     def validate(self, struct):
-        jsonschema.validate(struct, self.itemschema)  # Raises ValidationError
+        # Same error jsonschema.validate would raise, without rebuilding
+        # and re-checking the validator on every call.
+        error = jsonschema.exceptions.best_match(
+            self.validator.iter_errors(struct))
+        if error is not None:
+            raise error  # Raises ValidationError
         return True
 
+    def validate_many(self, archetypes) -> list:
+        """Validate several archetypes at once. Returns one list of
+        ValidationErrors per archetype, empty for those that are valid."""
+        return [list(self.validator.iter_errors(struct))
+                for struct in archetypes]
+
 
 # Ugh! Why does logging have to be so damned hard?
 logger = None
@@ -137,6 +193,15 @@ def gzip(content, filename=None, compresslevel=9, mtime=None):
     return gzbuffer.getvalue()
 
 
+def gzip_file(src, dest, compresslevel=9, mtime=0):
+    """Gzip the file `src` into `dest` a chunk at a time. With a fixed
+    `mtime` and no file name in the header, the output depends only on the
+    input bytes, and matches gzip(content, mtime=mtime)."""
+    with open(str(src), "rb") as fin, open(str(dest), "wb") as fout:
+        with GzipFile("", "wb", compresslevel, fout, mtime) as gz:
+            shutil.copyfileobj(fin, gz, 1 << 16)
+
+
 def gunzip(gzcontent):
     gzbuffer = BytesIO(gzcontent)
     return GzipFile(None, 'rb', fileobj=gzbuffer).read()
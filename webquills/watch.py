@@ -0,0 +1,181 @@
+# vim: set fileencoding=utf-8 :
+#
+#   Copyright 2016 Vince Veselosky and contributors
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+#
+"""
+Keep a build up to date as files change.
+
+Uses filesystem events from the optional `watchdog` package when it is
+installed (inotify on Linux), and falls back to polling otherwise.
+"""
+import os
+import threading
+import time
+from pathlib import Path
+
+from webquills.util import getLogger
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # optional dependency
+    Observer = None
+
+
+def ignored(path) -> bool:
+    """Editor droppings and hidden files."""
+    name = os.path.basename(str(path))
+    return name.startswith(".") or name.endswith("~") or name.endswith(".swp")
+
+
+class PollingWatcher(object):
+    """Finds changed files by comparing stat snapshots of some directories."""
+
+    def __init__(self, directories, interval=0.5):
+        self.directories = [str(d) for d in directories]
+        self.interval = interval
+        self.state = self.snapshot()
+
+    def snapshot(self) -> dict:
+        state = {}
+        pending = list(self.directories)
+        while pending:
+            try:
+                entries = list(os.scandir(pending.pop()))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                else:
+                    st = entry.stat()
+                    state[entry.path] = (st.st_size, st.st_mtime_ns)
+        return state
+
+    def poll(self) -> set:
+        state = self.snapshot()
+        changed = {path for path in state.keys() | self.state.keys()
+                   if state.get(path) != self.state.get(path)}
+        self.state = state
+        return changed
+
+    def wait(self) -> set:
+        """Block until something changes, then until things settle down.
+        Returns the paths that changed."""
+        changed = set()
+        while True:
+            time.sleep(self.interval)
+            more = self.poll()
+            if more:
+                changed |= more
+            elif changed:
+                return {Path(p) for p in changed if not ignored(p)}
+
+    def stop(self):
+        pass
+
+
+class EventWatcher(object):
+    """Collects changed paths from watchdog filesystem events."""
+
+    def __init__(self, directories, interval=0.5):
+        self.interval = interval
+        self.changed = set()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.observer = Observer()
+        handler = FileSystemEventHandler()
+        handler.on_any_event = self._on_event
+        for directory in directories:
+            self.observer.schedule(handler, str(directory), recursive=True)
+        self.observer.start()
+
+    def _on_event(self, event):
+        if event.is_directory:
+            return
+        with self.lock:
+            self.changed.add(event.src_path)
+            if getattr(event, "dest_path", None):
+                self.changed.add(event.dest_path)
+        self.event.set()
+
+    def wait(self) -> set:
+        while True:
+            self.event.wait()
+            # Let a burst of events (e.g. an editor's save dance) finish
+            while self.event.wait(self.interval):
+                self.event.clear()
+                time.sleep(self.interval)
+            with self.lock:
+                changed, self.changed = self.changed, set()
+            changed = {Path(p) for p in changed if not ignored(p)}
+            if changed:
+                return changed
+
+    def stop(self):
+        self.observer.stop()
+        self.observer.join()
+
+
+def make_watcher(directories, interval=0.5):
+    if Observer is None:
+        return PollingWatcher(directories, interval)
+    return EventWatcher(directories, interval)
+
+
+def split_changes(changed, source_dir: Path, template_dir):
+    """Sort changed paths into source files and template names."""
+    sources, templates = [], []
+    source_dir = os.path.abspath(str(source_dir))
+    if template_dir:
+        template_dir = os.path.abspath(str(template_dir))
+    for path in sorted(changed):
+        path = os.path.abspath(str(path))
+        if template_dir and path.startswith(template_dir + os.sep):
+            name = os.path.relpath(path, template_dir)
+            templates.append(name.replace(os.sep, "/"))
+        elif path.startswith(source_dir + os.sep):
+            sources.append(Path(path))
+    return sources, templates
+
+
+def watch(builder, interval=0.5):
+    """Build once, then rebuild whatever changes, until interrupted."""
+    logger = getLogger()
+    source_dir = builder.arch.source_dir
+    template_dir = builder.config.get("jinja2", {}).get("templatedir")
+    directories = [d for d in (source_dir, template_dir) if d]
+    watcher = make_watcher(directories, interval)
+    try:
+        builder.build()
+        logger.info("Watching %s for changes" % ", ".join(
+            str(d) for d in directories))
+        while True:
+            changed = watcher.wait()
+            start = time.perf_counter()
+            sources, templates = split_changes(changed, source_dir,
+                                               template_dir)
+            try:
+                builder.update(sources, templates)
+            except Exception:  # e.g. a source saved half written
+                # Nothing that failed was recorded as built, so the next
+                # save of the file tries it again
+                logger.exception("Rebuild failed after changes to %s" % (
+                    ", ".join(str(path) for path in sorted(changed))))
+                continue
+            logger.info("Rebuilt %d changed files in %.3fs" % (
+                len(sources) + len(templates), time.perf_counter() - start))
+    finally:
+        watcher.stop()